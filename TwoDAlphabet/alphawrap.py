@@ -1,8 +1,8 @@
 from collections import OrderedDict
 from TwoDAlphabet.helpers import roofit_form_to_TF1
 from ROOT import RooRealVar, RooFormulaVar, RooArgList, RooParametricHist2D, RooConstVar, TFormula, RooAddition
-from TwoDAlphabet.binning import copy_hist_with_new_bins
-import itertools
+from TwoDAlphabet.binning import copy_hist_with_new_bins, get_hist_arrays
+import itertools, numpy, re
 # import numpy as np
 # from numpy.lib.function_base import piecewise
 
@@ -26,6 +26,7 @@ class Generic2D(object):
         binArgLists (dict): Dict mapping of the subspaces (LOW, SIG, HIGH) to the RooArgList of the RooAbsArgs in the subspace.
         rph (dict): Dict mapping of the subspaces (LOW, SIG, HIGH) to the RooParametricHist2D objects of the subspaces.
         forcePositive (bool): Option to ensure bin values cannot be negative.
+        funcs (list): ParametricFunctions that the object was built from (tracked through `_manipulate`).
     '''
     
     def __init__(self,name,binning,forcePositive=True):
@@ -43,8 +44,24 @@ class Generic2D(object):
         self.binArgLists = {c:None for c in _subspace}
         self.rph = {c:None for c in _subspace}
         self.forcePositive = forcePositive
+        self.funcs = []
         self._varStorage = [] # only used by AddShapeTemplates
 
+    def _binNames(self,cat):
+        '''Names of the bin variables of a subspace, ordered as they are
+        given to the RooParametricHist2D (x changing fastest).
+
+        Args:
+            cat (str): One of "LOW", "SIG", or "HIGH".
+
+        Returns:
+            list(str): Bin variable names.
+        '''
+        cat_name = self.name+'_'+cat
+        return ['%s_bin_%s-%s'%(cat_name,xbin,ybin)
+                for ybin in range(1,len(self.binning.ybinList))
+                for xbin in range(1,len(self.binning.xbinByCat[cat]))]
+
     def _manipulate(self,name,other,operator=''):
         '''Base method to create a new Generic2D object. When combining
         `self` and `other`, a new set of RooFormulaVars will be created for
@@ -66,17 +83,12 @@ class Generic2D(object):
         '''
         out = Generic2D(name,self.binning,self.forcePositive)
         for cat in _subspace:
-            new_cat_name = name+'_'+cat
-            for ybin in range(1,len(self.binning.ybinList)):
-                for xbin in range(1,len(self.binning.xbinByCat[cat])):
-                    new_bin_name   = '%s_bin_%s-%s'%(new_cat_name,xbin,ybin)
-                    self_bin_name  = new_bin_name.replace(new_cat_name, self.name+'_'+cat)
-                    other_bin_name = new_bin_name.replace(new_cat_name, other.name+'_'+cat)
-                    out.binVars[new_bin_name] = RooFormulaVar(
-                                                    new_bin_name, new_bin_name, '@0%s@1'%operator,
-                                                    RooArgList(
-                                                        self.binVars[self_bin_name],
-                                                        other.binVars[other_bin_name]))
+            for new_bin_name, self_bin_name, other_bin_name in zip(out._binNames(cat), self._binNames(cat), other._binNames(cat)):
+                out.binVars[new_bin_name] = RooFormulaVar(
+                                                new_bin_name, new_bin_name, '@0%s@1'%operator,
+                                                RooArgList(
+                                                    self.binVars[self_bin_name],
+                                                    other.binVars[other_bin_name]))
 
         all_nuisances = self.nuisances+other.nuisances
         for nuisance in all_nuisances:
@@ -84,6 +96,7 @@ class Generic2D(object):
                 raise RuntimeError('Already tracking nuisance %s. Printing all nuisances...\n\t'%(nuisance['name'],all_nuisances))
 
             out.nuisances.append(nuisance)
+        out.funcs = self.funcs+other.funcs
 
         return out
 
@@ -146,10 +159,8 @@ class Generic2D(object):
             obj_name = '%s_%s'%(name if name != '' else self.name, cat)
 
             self.binArgLists[cat] = RooArgList()
-            for ybin in range(1,len(self.binning.ybinList)):
-                for xbin in range(1,len(self.binning.xbinByCat[cat])):
-                    bin_name   = '%s_bin_%s-%s'%(cat_name,xbin,ybin)
-                    self.binArgLists[cat].add(self.binVars[bin_name])
+            for bin_name in self._binNames(cat):
+                self.binArgLists[cat].add(self.binVars[bin_name])
 
             out_rph[cat] = RooParametricHist2D(
                         obj_name, obj_name,
@@ -227,43 +238,58 @@ class ParametricFunction(Generic2D):
         super(ParametricFunction,self).__init__(name,binning,forcePositive)
         self.formula = formula
         self.nuisances = self._createFuncVars(constraints)
+        self.funcs = [self]
         self.arglist = RooArgList()
         for n in self.nuisances: self.arglist.add(n['obj'])
 
+        # Every bin shares one formula string (x and y are passed as RooConstVars)
+        # so that TFormula only parses and JIT-compiles it once.
+        self.compiledFormula, uses_x, uses_y = self._formulaWithXYArgs()
+        if forcePositive: self.compiledFormula = "max(1e-9,%s)"%(self.compiledFormula)
+
+        yConsts = {}
+        for ybin in range(1,len(self.binning.ybinList)):
+            yConsts[ybin] = RooConstVar('%s_y%s'%(name,ybin), '%s_y%s'%(name,ybin), self.mappedBinCenter(1,ybin,'LOW')[1])
+        self._varStorage.extend(yConsts.values())
+
         for cat in _subspace:
             cat_name = name+'_'+cat
+            xConsts = {}
+            for xbin in range(1,len(self.binning.xbinByCat[cat])):
+                xConsts[xbin] = RooConstVar('%s_x%s'%(cat_name,xbin), '%s_x%s'%(cat_name,xbin), self.mappedBinCenter(xbin,1,cat)[0])
+            self._varStorage.extend(xConsts.values())
+
             for ybin in range(1,len(self.binning.ybinList)):
                 for xbin in range(1,len(self.binning.xbinByCat[cat])):
                     bin_name = '%s_bin_%s-%s'%(cat_name,xbin,ybin)
-                    xConst,yConst = self.mappedBinCenter(xbin,ybin,cat)
-                    if forcePositive: final_formula = "max(1e-9,%s)"%(self._replaceXY(xConst,yConst))
-                    else:             final_formula = self._replaceXY(xConst,yConst)
+                    bin_args = RooArgList(self.arglist)
+                    if uses_x: bin_args.add(xConsts[xbin])
+                    if uses_y: bin_args.add(yConsts[ybin])
 
                     self.binVars[bin_name] = RooFormulaVar(
                         bin_name, bin_name,
-                        final_formula,
-                        self.arglist
+                        self.compiledFormula,
+                        bin_args
                     )
 
-    def _replaceXY(self,x,y):
-        '''Find and replace "x" and "y" in the input formula
-        with this method's arguments (floats) which should
-        correspond to bin centers.
-
-        Args:
-            x (float): Value along x axis to evaluate.
-            y (float): Value along y axis to evaluate.
+    def _formulaWithXYArgs(self):
+        '''Replace "x" and "y" in the input formula with references to
+        two extra arguments which follow the formula parameters (ie. "@N" and "@N+1"
+        for N parameters, or only "@N" if one of the two is not used).
 
         Returns:
-            str: Formula with "x" and "y" replaced by provided numerical values.
+            tuple(str, bool, bool): New formula and whether "x" and "y" are used, respectively.
         '''
         f = self.formula.replace(' ','')
-        f = f.replace('+x','+%s'%x).replace('+y','+%s'%y)
-        f = f.replace('*x','*%s'%x).replace('*y','*%s'%y)
-        f = f.replace('-x','-%s'%x).replace('-y','-%s'%y)
-        f = f.replace('/x','/%s'%x).replace('/y','/%s'%y)
-        f = f.replace('(x','(%s'%x).replace('(y','(%s'%y)
-        return f
+        npars = len(self.nuisances)
+        out = {}
+        for var in ['x','y']:
+            pattern = r'(?<![\w.@])%s(?!\w)'%var
+            out[var] = re.search(pattern, f) != None
+            if out[var]:
+                f = re.sub(pattern, '@%s'%npars, f)
+                npars += 1
+        return f, out['x'], out['y']
 
     def getNparams(self):
         '''Get the number of parameters in the formula (not counting "x" or "y").
@@ -327,6 +353,21 @@ class ParametricFunction(Generic2D):
 
         return x_center_mapped,y_center_mapped
 
+    def Evaluate(self,params=None):
+        '''Evaluate the function in every bin of the full space with NumPy
+        (see `eval_transfer_func`) rather than through the RooFit objects.
+
+        Args:
+            params (array-like, optional): Parameter vector or N x p matrix of parameter samples.
+                Defaults to None in which case the current values of the parameters are used.
+
+        Returns:
+            numpy.ndarray: Values indexed as [ybin-1][xbin-1] (with an extra leading sample axis for a matrix input).
+        '''
+        if params is None:
+            params = [n['obj'].getValV() for n in self.nuisances]
+        return eval_transfer_func(self.formula, self.binning, params, self.forcePositive)
+
     def setFuncParam(self,parIdx,value):
         '''Set the value of a given ROOT.RooRealVar object within a ParametricFunction
 
@@ -372,15 +413,17 @@ class BinnedDistribution(Generic2D):
         for cat in _subspace:
             cat_name = name+'_'+cat
             cat_hist = copy_hist_with_new_bins(cat_name,'X',inhist,self.binning.xbinByCat[cat])
-            for ybin in range(1,cat_hist.GetNbinsY()+1):
-                for xbin in range(1,cat_hist.GetNbinsX()+1):
-                    bin_name = '%s_bin_%s-%s'%(cat_name,xbin,ybin)
-                    if constant or self._nSurroundingZeros(cat_hist,xbin,ybin) > 7:
-                        self.binVars[bin_name] = RooConstVar(bin_name, bin_name, cat_hist.GetBinContent(xbin,ybin))
-                    else:
-                        self.binVars[bin_name] = RooRealVar(bin_name, bin_name, max(5,cat_hist.GetBinContent(xbin,ybin)), 1e-6, 1e6)
-                        self.nuisances.append({'name':bin_name, 'constraint':'flatParam', 'obj': self.binVars[bin_name]})
-                    self._varStorage.append(self.binVars[bin_name]) # For safety if we add shape templates            
+            content, _ = get_hist_arrays(cat_hist)
+            is_const = self._surroundingZeros(content) > 7
+            if constant: is_const[:] = True
+            # Arrays are [ybin][xbin] without under/overflow so they flatten in the same order as _binNames
+            for bin_name, val, const in zip(self._binNames(cat), content[1:-1,1:-1].ravel(), is_const.ravel()):
+                if const:
+                    self.binVars[bin_name] = RooConstVar(bin_name, bin_name, val)
+                else:
+                    self.binVars[bin_name] = RooRealVar(bin_name, bin_name, max(5,val), 1e-6, 1e6)
+                    self.nuisances.append({'name':bin_name, 'constraint':'flatParam', 'obj': self.binVars[bin_name]})
+                self._varStorage.append(self.binVars[bin_name]) # For safety if we add shape templates            
                      
     def AddShapeTemplates(self,nuis_name,up_shape,down_shape,constraint="param 1 0"):
         '''Add variation shape templates that are used to create a map between
@@ -433,16 +476,118 @@ class BinnedDistribution(Generic2D):
     def KDESmooth(self):
         raise NotImplementedError()
 
-    def _nSurroundingZeros(self,hist,xbin,ybin):
-        nzeros = 0
-        if hist.GetBinContent(xbin,ybin) > 0:
-            nzeros = 0
-        else:
-            for pair in itertools.product([xbin,xbin-1,xbin+1],[ybin-1,ybin,ybin+1]):
-                if hist.GetBinContent(pair[0],pair[1]) <= 0:
-                    nzeros += 1
+    def _surroundingZeros(self,content):
+        '''For every bin, count the bins in the surrounding 3x3 block (including itself
+        and the under/overflow) with content <= 0. Bins with positive content get a count of 0.
+
+        Args:
+            content (numpy.ndarray): Bin contents indexed as [ybin][xbin], including under/overflow.
+
+        Returns:
+            numpy.ndarray: Counts indexed as [ybin-1][xbin-1] (ie. without under/overflow).
+        '''
+        ny, nx = content.shape[0]-2, content.shape[1]-2
+        empty = (content <= 0).astype(int)
+        nzeros = numpy.zeros((ny,nx), dtype=int)
+        for dy, dx in itertools.product([0,1,2],[0,1,2]):
+            nzeros += empty[dy:dy+ny, dx:dx+nx]
+        nzeros[content[1:-1,1:-1] > 0] = 0
         return nzeros
 
+_numpy_formula_funcs = {
+    'exp': numpy.exp, 'log': numpy.log, 'log10': numpy.log10, 'sqrt': numpy.sqrt,
+    'pow': numpy.power, 'abs': numpy.abs, 'fabs': numpy.abs,
+    'max': numpy.maximum, 'min': numpy.minimum,
+    'sin': numpy.sin, 'cos': numpy.cos, 'tan': numpy.tan, 'tanh': numpy.tanh
+}
+
+def _formula_to_numpy(formula):
+    '''Convert a RooFit formula (parameters as @N, axes as "x" and "y") to a Python
+    expression where the parameters are rows of the array `p`.
+
+    Args:
+        formula (str): RooFit formula string.
+
+    Returns:
+        str: Python expression.
+    '''
+    f = formula.replace(' ','').replace('^','**')
+    return re.sub(r'@(\d+)', r'p[\1]', f)
+
+def _mapped_bin_centers(binning):
+    '''Centers of the bins of the full space with the axes mapped to [0,1]
+    (see `ParametricFunction.mappedBinCenter`).
+
+    Args:
+        binning (Binning): Binning object.
+
+    Returns:
+        tuple(numpy.ndarray): x and y bin centers.
+    '''
+    out = []
+    for edges in [numpy.array(binning.xbinList,dtype='d'), numpy.array(binning.ybinList,dtype='d')]:
+        centers = (edges[:-1]+edges[1:])/2.
+        out.append((centers-edges[0])/(edges[-1]-edges[0]))
+    return out[0], out[1]
+
+def eval_transfer_func(formula, binning, params, forcePositive=True):
+    '''Evaluate a ParametricFunction formula in every bin of the full space
+    (LOW, SIG, and HIGH concatenated along x) for one parameter vector or for many
+    samples of the parameters at once. The bin centers are mapped to [0,1] as
+    is done when building the RooFit objects.
+
+    Args:
+        formula (str): RooFit formula string (see ParametricFunction).
+        binning (Binning): Binning object.
+        params (array-like): Parameter vector (length p) or N x p matrix of parameter samples.
+        forcePositive (bool, optional): Lower bound the values by 1e-9. Defaults to True.
+
+    Raises:
+        ValueError: If the formula references more parameters than are provided.
+
+    Returns:
+        numpy.ndarray: Values indexed as [ybin-1][xbin-1] for a vector input or
+            as [sample][ybin-1][xbin-1] for a matrix input.
+    '''
+    params = numpy.asarray(params, dtype='d')
+    single = params.ndim == 1
+    params = numpy.atleast_2d(params)
+
+    npars_needed = max([int(i)+1 for i in re.findall(r'@(\d+)',formula)]+[0])
+    if params.shape[1] < npars_needed:
+        raise ValueError('Formula "%s" needs %s parameters but only %s were provided.'%(formula,npars_needed,params.shape[1]))
+
+    x, y = _mapped_bin_centers(binning)
+    namespace = dict(_numpy_formula_funcs)
+    namespace.update({
+        'x': x[numpy.newaxis, numpy.newaxis, :],
+        'y': y[numpy.newaxis, :, numpy.newaxis],
+        'p': params.T[:, :, numpy.newaxis, numpy.newaxis]
+    })
+    vals = eval(_formula_to_numpy(formula), {'__builtins__': {}}, namespace)
+    vals = numpy.array(numpy.broadcast_to(vals, (params.shape[0], len(y), len(x))), dtype='d')
+
+    if forcePositive:
+        vals = numpy.maximum(vals, 1e-9)
+
+    return vals[0] if single else vals
+
+def transfer_func_bands(formula, binning, param_samples, forcePositive=True):
+    '''Evaluate a ParametricFunction formula for N samples of its parameters
+    (ex. drawn from the fit covariance) and summarize the per-bin distribution.
+
+    Args:
+        formula (str): RooFit formula string (see ParametricFunction).
+        binning (Binning): Binning object.
+        param_samples (array-like): N x p matrix of parameter samples.
+        forcePositive (bool, optional): Lower bound the values by 1e-9. Defaults to True.
+
+    Returns:
+        tuple(numpy.ndarray): Per-bin mean and RMS, indexed as [ybin-1][xbin-1].
+    '''
+    vals = eval_transfer_func(formula, binning, numpy.atleast_2d(param_samples), forcePositive)
+    return vals.mean(axis=0), vals.std(axis=0)
+
 def singleBinInterp(name, nuis, binVar, upVal, downVal, forcePositive):
     '''Create a RooFormulaVar containing the nuisance parameter that can
     morph the initial `binVar` value between the values of `upVal` and `downVal`.
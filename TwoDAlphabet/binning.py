@@ -1,5 +1,4 @@
-import ROOT, array
-from math import sqrt
+import ROOT, array, numpy
 
 class Binning:
     '''Class to handle information on and manipulations of binning schemes.'''
@@ -336,6 +335,116 @@ def histlist_to_binlist(XYZ,histList):
     binList = [get_bins_from_hist(XYZ,h) for h in histList]
     return concat_bin_lists(binList)
 
+_array_dtypes = [('TArrayF','f4'),('TArrayD','f8'),('TArrayI','i4'),('TArrayS','i2'),('TArrayC','i1')]
+
+def _buffer_to_numpy(buf,n,dtype):
+    if hasattr(buf,'SetSize'): # legacy PyROOT buffers do not know their own length
+        buf.SetSize(n)
+    return numpy.frombuffer(buf,dtype=dtype,count=n).copy()
+
+def get_hist_arrays(h):
+    '''Read the bin contents and bin errors of a histogram into numpy arrays
+    in one pass instead of calling GetBinContent/GetBinError per bin.
+    Arrays include the underflow and overflow bins and, for a TH2, are indexed
+    as [ybin][xbin] so that they can be addressed with the usual ROOT bin numbers.
+
+    Args:
+        h (TH1): Input 1D or 2D histogram.
+
+    Raises:
+        TypeError: If the histogram storage type is not recognized or the histogram is 3D.
+
+    Returns:
+        tuple(numpy.ndarray): Bin contents and bin errors.
+    '''
+    if h.GetDimension() == 1:
+        shape = (h.GetNbinsX()+2,)
+    elif h.GetDimension() == 2:
+        shape = (h.GetNbinsY()+2, h.GetNbinsX()+2)
+    else:
+        raise TypeError('Only 1D and 2D histograms can be converted to arrays.')
+
+    dtype = None
+    for tarray,npdtype in _array_dtypes:
+        if h.InheritsFrom(tarray):
+            dtype = npdtype
+            break
+    if dtype == None:
+        raise TypeError('Storage type of histogram %s (%s) is not supported.'%(h.GetName(),h.ClassName()))
+
+    ncells = h.GetNcells()
+    content = _buffer_to_numpy(h.GetArray(),ncells,dtype).astype('d')
+    if h.GetSumw2N() > 0:
+        errors = numpy.sqrt(_buffer_to_numpy(h.GetSumw2().GetArray(),ncells,'f8'))
+    else:
+        errors = numpy.sqrt(numpy.abs(content))
+
+    return content.reshape(shape), errors.reshape(shape)
+
+def set_hist_arrays(h,content,errors):
+    '''Write bin contents and bin errors into a histogram in bulk.
+    The arrays must have the same shape as those returned by get_hist_arrays
+    (ie. include underflow and overflow).
+
+    Args:
+        h (TH1): Histogram to modify in-place.
+        content (numpy.ndarray): New bin contents.
+        errors (numpy.ndarray): New bin errors.
+
+    Raises:
+        ValueError: If the array sizes do not match the number of cells in the histogram.
+
+    Returns:
+        TH1: The modified histogram.
+    '''
+    ncells = h.GetNcells()
+    if numpy.size(content) != ncells or numpy.size(errors) != ncells:
+        raise ValueError('Arrays of size %s and %s cannot be written to histogram %s with %s cells.'%(numpy.size(content),numpy.size(errors),h.GetName(),ncells))
+
+    h.SetContent(array.array('d',numpy.ravel(content).astype('d').tolist()))
+    if h.GetSumw2N() == 0:
+        h.Sumw2()
+    h.GetSumw2().Set(ncells,array.array('d',(numpy.ravel(errors).astype('d')**2).tolist()))
+    return h
+
+def rebin_matrix(XorY,old_bins,new_bins):
+    '''Build the matrix which merges bins along one axis from the `old_bins`
+    edges into the `new_bins` edges. Element [i][j] is 1 if old bin i (indexed from 0)
+    falls into new bin j and 0 otherwise. Old bins outside the new range are dropped.
+
+    Args:
+        XorY (str): Axis name, only used for error messages.
+        old_bins (list(float)): Input bin edges.
+        new_bins (list(float)): Output bin edges.
+
+    Raises:
+        ValueError: If any new bin edge would split an old bin.
+
+    Returns:
+        numpy.ndarray: Matrix of shape (len(old_bins)-1, len(new_bins)-1).
+    '''
+    old_bins = numpy.asarray(old_bins,dtype='d')
+    new_bins = numpy.asarray(new_bins,dtype='d')
+    old_low, old_up = old_bins[:-1], old_bins[1:]
+
+    # A new edge strictly inside an old bin would split that bin
+    split = numpy.searchsorted(old_bins,new_bins,side='right')
+    for inew,iold in enumerate(split):
+        if 0 < iold < len(old_bins) and old_bins[iold-1] < new_bins[inew]:
+            if inew < len(new_bins)-1: new_range = (new_bins[inew],new_bins[inew+1])
+            else:                      new_range = (new_bins[inew-1],new_bins[inew])
+            raise ValueError(
+                '''The requested %s rebinning does not align bin edges with the input bin edge.
+                Cannot split input bin [%s,%s] with output bin [%s,%s]'''%(XorY,old_bins[iold-1],old_bins[iold],new_range[0],new_range[1]))
+
+    inew = numpy.searchsorted(new_bins,old_low,side='right')-1
+    inside = (inew >= 0) & (inew < len(new_bins)-1)
+    inside[inside] &= old_up[inside] <= new_bins[inew[inside]+1]
+
+    out = numpy.zeros((len(old_low),len(new_bins)-1))
+    out[numpy.nonzero(inside)[0],inew[inside]] = 1
+    return out
+
 def stitch_hists_in_x(name,binning,histList,blinded=[]):
     '''Required that histList be in order of desired stitching
     `blinded` is a list of the index of regions you wish to skip/blind.
@@ -359,21 +468,96 @@ def stitch_hists_in_x(name,binning,histList,blinded=[]):
     if histListBins != get_bins_from_hist("X",stitched_hist):
         raise ValueError('X axis bins stitched together from histList are not the same as the input template.\n%s vs %s'%(histListBins,get_bins_from_hist("X",stitched_hist)))
     # Stitch
-    bin_jump = 0
+    content, errors = stitch_hist_arrays(histList,blinded)
+    set_hist_arrays(stitched_hist,content,errors)
+
+    return stitched_hist
+
+def stitch_hist_arrays(histList,blinded=[]):
+    '''Concatenate the bin content and error arrays of the histograms in histList
+    along the X axis (in order). The slices of histograms listed in `blinded`
+    are zeroed. Only the in-range bins of the inputs are used so the
+    under/overflow of the output are zero. Output arrays are shaped like those of
+    get_hist_arrays for a histogram with the stitched X binning.
+
+    Args:
+        histList (list(TH2)): List of histograms to stitch together. Must have the same Y binning.
+        blinded (list(int), optional): List of indexes of histList which should be dropped/blinded. Defaults to [].
+
+    Returns:
+        tuple(numpy.ndarray): Stitched bin contents and bin errors.
+    '''
+    contents, errors, keep = [], [], []
     for i,h in enumerate(histList):
-        if i in blinded:
-            bin_jump += histList[i].GetNbinsX()
-            continue
-        
-        for ybin in range(1,h.GetNbinsY()+1):
-            for xbin in range(1,h.GetNbinsX()+1):
-                stitched_xindex = xbin + bin_jump
-                stitched_hist.SetBinContent(stitched_xindex,ybin,h.GetBinContent(xbin,ybin))
-                stitched_hist.SetBinError(stitched_xindex,ybin,h.GetBinError(xbin,ybin))
+        c, e = get_hist_arrays(h)
+        contents.append(c[:,1:-1])
+        errors.append(e[:,1:-1])
+        keep.append(numpy.full(h.GetNbinsX(), i not in blinded))
 
-        bin_jump += histList[i].GetNbinsX()
+    mask = numpy.zeros((contents[0].shape[0],sum([k.size for k in keep])+2),dtype=bool)
+    mask[1:-1,1:-1] = numpy.concatenate(keep)[numpy.newaxis,:]
 
-    return stitched_hist
+    out = []
+    for arrays in [contents,errors]:
+        stitched = numpy.zeros(mask.shape)
+        stitched[:,1:-1] = numpy.concatenate(arrays,axis=1)
+        stitched[~mask] = 0
+        out.append(stitched)
+
+    return out[0], out[1]
+
+def slice_idxs_from_edges(binList,edges):
+    '''Convert slice edges (axis values) to slice indices like Binning.xSliceIdx and
+    Binning.ySliceIdx (the index of each edge in `binList`).
+
+    Args:
+        binList (list(float)): Bin edges of the axis.
+        edges (list(float)): Increasing slice edges. Each must be a bin edge.
+
+    Raises:
+        ValueError: If an edge is not a bin edge or the edges are not increasing.
+
+    Returns:
+        list(int): Slice indices.
+    '''
+    idxs = []
+    for e in edges:
+        matches = [i for i,b in enumerate(binList) if abs(b-e) < 1e-9*max(1,abs(e))]
+        if len(matches) == 0:
+            raise ValueError('Slice edge %s is not a bin edge (%s).'%(e,binList))
+        idxs.append(matches[0])
+    if sorted(set(idxs)) != idxs:
+        raise ValueError('Slice edges must be in increasing order (%s).'%edges)
+    return idxs
+
+def project_slices(content,errors,sliceIdxs,axis):
+    '''Project 2D arrays (shaped like those of get_hist_arrays, ie. [ybin][xbin] with
+    underflow and overflow) onto `axis` in every slice of the other axis at once.
+    Slice i sums the bins sliceIdxs[i]+1 to sliceIdxs[i+1] (inclusive) like TH2.ProjectionX/Y
+    with those first and last bins and the "e" option. All slices come from one cumulative
+    sum of the contents and variances along the summed axis.
+
+    Args:
+        content (numpy.ndarray): 2D bin contents.
+        errors (numpy.ndarray): 2D bin errors.
+        sliceIdxs (list(int)): Slice indices of the summed axis (see Binning.xSliceIdx and slice_idxs_from_edges()).
+        axis (str): Axis to project onto ("X" or "Y").
+
+    Returns:
+        tuple(numpy.ndarray): Contents and errors of the projections, indexed as [slice][bin]
+            (with underflow and overflow).
+    '''
+    if axis == 'Y':
+        content, errors = content.T, errors.T
+    first = numpy.zeros((1,content.shape[1]))
+    cum_content = numpy.concatenate([first,numpy.cumsum(content,axis=0)])
+    cum_variance = numpy.concatenate([first,numpy.cumsum(errors**2,axis=0)])
+
+    idxs = numpy.asarray(sliceIdxs)
+    starts, stops = idxs[:-1]+1, idxs[1:]+1
+    proj_content = cum_content[stops]-cum_content[starts]
+    proj_variance = numpy.clip(cum_variance[stops]-cum_variance[starts],0,None)
+    return proj_content, numpy.sqrt(proj_variance)
 
 def make_blinded_hist(h,sigregion):
     '''Clone histogram (h) and set the bins in range
@@ -400,12 +584,12 @@ def make_blinded_hist(h,sigregion):
     if len(sigregion) != 2:
         raise IndexError('Signal region must be specified by list of length 2.')
 
-    for binY in range(1,h.GetNbinsY()+1):
-        for binX in range(1,h.GetNbinsX()+1):
-            if h.GetXaxis().GetBinUpEdge(binX) <= sigregion[0] or h.GetXaxis().GetBinLowEdge(binX) >= sigregion[1]:
-                if h.GetBinContent(binX,binY) > 0:
-                    blindedHist.SetBinContent(binX,binY,h.GetBinContent(binX,binY))
-                    blindedHist.SetBinError(binX,binY,h.GetBinError(binX,binY))
+    content, errors = get_hist_arrays(h)
+    xbins = numpy.array(get_bins_from_hist("X",h))
+    keep = numpy.zeros(content.shape,dtype=bool)
+    keep[1:-1,1:-1] = ((xbins[1:] <= sigregion[0]) | (xbins[:-1] >= sigregion[1]))[numpy.newaxis,:]
+    keep &= content > 0
+    set_hist_arrays(blindedHist,numpy.where(keep,content,0),numpy.where(keep,errors,0))
 
     return blindedHist
 
@@ -448,49 +632,31 @@ def copy_hist_with_new_bins(copyName,XorY,inHist,new_bins):
     hist_copy.Sumw2()
     hist_copy.GetXaxis().SetName(inHist.GetXaxis().GetName())
     hist_copy.GetYaxis().SetName(inHist.GetYaxis().GetName())
-    old_axis = getattr(inHist,'Get%saxis'%axis_to_rebin)()
-    rebin_axis = getattr(hist_copy,'Get%saxis'%axis_to_rebin)()
-
-    # Loop through the old bins
-    for static_bin in range(1,static_nbins+1):
-        # print 'Bin y: ' + str(binY)
-        for rebin in range(1,rebin_nbins+1):
-            new_bin_content = 0
-            new_bin_errorsq = 0
-            new_bin_min = rebin_axis.GetBinLowEdge(rebin)
-            new_bin_max = rebin_axis.GetBinUpEdge(rebin)
-
-            # print '\t New bin x: ' + str(newBinX) + ', ' + str(newBinXlow) + ', ' + str(newBinXhigh)
-            for old_bin in range(1,old_axis.GetNbins()+1):
-                old_bin_min = old_axis.GetBinLowEdge(old_bin)
-                old_bin_max = old_axis.GetBinUpEdge(old_bin)
-                if old_bin_min >= new_bin_max:
-                    break
-                elif old_bin_min >= new_bin_min and old_bin_min < new_bin_max:
-                    if old_bin_max <= new_bin_max:
-                        if axis_to_rebin == "X":
-                            new_bin_content += inHist.GetBinContent(old_bin,static_bin)
-                            new_bin_errorsq += inHist.GetBinError(old_bin,static_bin)**2
-                        else:
-                            new_bin_content += inHist.GetBinContent(static_bin,old_bin)
-                            new_bin_errorsq += inHist.GetBinError(static_bin,old_bin)**2
-                    elif old_bin_max > new_bin_max:
-                        raise ValueError(
-                            '''The requested %s rebinning does not align bin edges with the input bin edge.
-                            Cannot split input bin [%s,%s] with output bin [%s,%s]'''%(axis_to_rebin,old_bin_min,old_bin_max,new_bin_min,new_bin_max))
-                elif old_bin_min <= new_bin_min and old_bin_max > new_bin_min:
-                    raise ValueError(
-                        '''The requested %s rebinning does not align bin edges with the input bin edge.
-                        Cannot split input bin [%s,%s] with output bin [%s,%s]'''%(axis_to_rebin,old_bin_min,old_bin_max,new_bin_min,new_bin_max))
-
-            # print '\t Setting content ' + str(newBinContent) + '+/-' + str(sqrt(newBinErrorSq))
-            if new_bin_content > 0:
-                if axis_to_rebin == "X":
-                    hist_copy.SetBinContent(rebin,static_bin,new_bin_content)
-                    hist_copy.SetBinError(rebin,static_bin,sqrt(new_bin_errorsq))
-                else:
-                    hist_copy.SetBinContent(static_bin,rebin,new_bin_content)
-                    hist_copy.SetBinError(static_bin,rebin,sqrt(new_bin_errorsq))
+
+    # Map each old bin onto the new bin containing it (raises if any bin would be split)
+    bin_map = rebin_matrix(axis_to_rebin,
+                           get_bins_from_hist(axis_to_rebin,inHist),
+                           get_bins_from_hist(axis_to_rebin,hist_copy))
+
+    # Drop under/overflow and merge all old bins in one matrix product.
+    # Arrays are indexed [y][x] so the rebinned axis is the last one for X and the first for Y.
+    old_content, old_errors = get_hist_arrays(inHist)
+    old_content = old_content[1:-1,1:-1].astype('d')
+    old_errorsq = old_errors[1:-1,1:-1].astype('d')**2
+    if axis_to_rebin == "X":
+        new_content = old_content.dot(bin_map)
+        new_errorsq = old_errorsq.dot(bin_map)
+    else:
+        new_content = bin_map.T.dot(old_content)
+        new_errorsq = bin_map.T.dot(old_errorsq)
+
+    # Only positive bins are filled - empty and negative bins are left at zero
+    filled = new_content > 0
+    out_content = numpy.zeros((hist_copy.GetNbinsY()+2, hist_copy.GetNbinsX()+2))
+    out_errors = numpy.zeros_like(out_content)
+    out_content[1:-1,1:-1] = numpy.where(filled, new_content, 0)
+    out_errors[1:-1,1:-1] = numpy.where(filled, numpy.sqrt(numpy.abs(new_errorsq)), 0)
+    set_hist_arrays(hist_copy, out_content, out_errors)
 
     # Will now set the copyName which will overwrite inHist if it has the same name
     hist_copy.SetName(copyName)
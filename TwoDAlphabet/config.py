@@ -1,10 +1,10 @@
-from collections import OrderedDict
-import ROOT, json, os, pandas, re, warnings, itertools
+from collections import OrderedDict, namedtuple
+import ROOT, array, hashlib, json, multiprocessing, os, pandas, re, warnings, itertools
 from numpy import nan
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 from TwoDAlphabet.helpers import copy_update_dict, open_json, parse_arg_dict, replace_multi
-from TwoDAlphabet.binning import Binning, copy_hist_with_new_bins, get_bins_from_hist
+from TwoDAlphabet.binning import Binning, copy_hist_with_new_bins, get_bins_from_hist, get_hist_arrays, set_hist_arrays
 
 _protected_keys = ["PROCESSES","SYSTEMATICS","REGIONS","BINNING","OPTIONS","GLOBAL","SCALE","COLOR","TYPE","X","Y","TITLE","BINS","NBINS","LOW","HIGH"]
 _syst_col_defaults = {
@@ -36,6 +36,8 @@ class Config:
         self.config = open_json(jsonPath)
         self._addFindReplace(findreplace)
         self.iterWorkspaceObjs = {}
+        self._placeholderCache = {}
+        self._expansionCache = {}
         if 'GLOBAL' in self.config.keys(): self._varReplacement()
         self._addedConfigs = []
 
@@ -180,11 +182,11 @@ class Config:
 
             return out
 
-        out_df = pandas.DataFrame(columns=['process','region','binning'])
+        rows = []
         for r in self._section('REGIONS'):
             data_key = _data_not_included(r)
             if data_key:
-                out_df = out_df.append(pandas.Series({'process':data_key,'region':r, 'binning':self._section('REGIONS')[r]['BINNING']}),ignore_index=True)
+                rows.append({'process':data_key,'region':r, 'binning':self._section('REGIONS')[r]['BINNING']})
 
             for p in self._section('REGIONS')[r]['PROCESSES']:
                 if p not in self._section('PROCESSES') and len([kglobal for kglobal in self._section('GLOBAL') if kglobal in p]) == 0:
@@ -195,11 +197,9 @@ class Config:
                     'region': c['REGION'],
                     'binning':self._section('REGIONS')[c['REGION']]['BINNING']
                 }
-                rows_to_append = self._iterObjReplaceProducer({'PROCESS':p, 'REGION':r}, row_format)
-                for new_row in rows_to_append:
-                    out_df = out_df.append(new_row,ignore_index=True)
+                rows.extend(self._iterObjReplaceProducer({'PROCESS':p, 'REGION':r}, row_format))
                 
-        return out_df
+        return pandas.DataFrame(rows, columns=['process','region','binning'])
 
     def _processTable(self):
         '''Generate the table of process information based on the JSON config.
@@ -209,7 +209,7 @@ class Config:
         Returns:
             pandas.DataFrame
         '''
-        out_df = pandas.DataFrame(columns=['color','process_type','scale','variation','source_filename','source_histname','alias','title','combine_idx'])
+        names, rows = [], []
         for p in self._section('PROCESSES'):
             this_proc_info = self._section('PROCESSES')[p]
             this_proc_info['NAME'] = p
@@ -217,7 +217,7 @@ class Config:
                 raise RuntimeError('Any process of type DATA must have section key "data_obs".')
             for s in this_proc_info['SYSTEMATICS']+['nominal']:
                 this_proc_info['VARIATION'] = s
-                row_format = lambda info: pandas.Series(
+                row_format = lambda info: (info['NAME'],
                     {'color': nan if 'COLOR' not in info else info['COLOR'],
                     'process_type': info['TYPE'],
                     'scale': 1.0 if 'SCALE' not in info else info['SCALE'],
@@ -226,13 +226,13 @@ class Config:
                     'alias': info['NAME'] if 'ALIAS' not in info.keys() else info['ALIAS'], #in file name
                     'title': info['NAME'] if 'TITLE' not in info.keys() else info['TITLE'], #in legend entry
                     'variation': info['VARIATION'],
-                    }, name=info['NAME']
+                    }
                 )
-                rows_to_append = self._iterObjReplaceProducer(this_proc_info, row_format)
-                for new_row in rows_to_append:
-                    out_df = out_df.append(new_row)
+                for name, row in self._iterObjReplaceProducer(this_proc_info, row_format):
+                    names.append(name)
+                    rows.append(row)
 
-        return out_df
+        return pandas.DataFrame(rows, index=names, columns=['color','process_type','scale','variation','source_filename','source_histname','alias','title','combine_idx'])
 
     def _systematicsTable(self):
         '''Generate the table of process information based on the JSON config.
@@ -244,60 +244,65 @@ class Config:
         Returns:
             pandas.DataFrame
         '''
-        out_df = pandas.DataFrame(columns=_syst_col_defaults.keys())
+        rows = []
         for s in self._section('SYSTEMATICS'):
             iterations_to_process = self._iterObjReplaceProducer(self._section('SYSTEMATICS')[s], lambda c: c)
             for iteration in iterations_to_process:
-                for syst in _get_syst_attrs(s, iteration):
-                    out_df = out_df.append(syst)
+                rows.extend(_get_syst_attrs(s, iteration))
         
-        return out_df
+        return pandas.DataFrame(rows, columns=list(_syst_col_defaults.keys()))
 
     def _iterObjReplaceProducer(self, obj_package, func):
         '''Pre-processes input to DataFrame in the case that the inputs
-        can take multiple values with keyword replacement.
+        can take multiple values with keyword replacement. Yields `func` of every
+        combination of the expanded values (see _expand()) of the objects in `obj_package`.
 
         Args:
-            obj_package ([type]): [description]
-            func ([type]): [description]
+            obj_package (dict): Objects (ex. process name and region name) to expand.
+            func (function): Function of the dictionary of one combination of the expanded objects.
         '''
-        def _iterativeReplace(base,find_replace_map):
-            out = base
-            for f,r in find_replace_map.items():
-                out = out.replace(f,r)
-            return out
-
         to_vary = OrderedDict()
         for objKey, obj in obj_package.items(): # do replacement for multiple objects
-            if not isinstance(obj, str):
-                to_vary[objKey] = [obj]
-                continue
-            to_vary[objKey] = []
+            to_vary[objKey] = self._expand(obj) if isinstance(obj, str) else (obj,)
 
-            matches = [] # find all matches to this obj
-            for iterKey in self.iterWorkspaceObjs.keys():
-                if iterKey in obj:
-                    matches.append(iterKey)
+        # Use func to plug everything back together
+        keys = list(to_vary.keys())
+        for varied_set in itertools.product(*(to_vary.values())):
+            yield func(dict(zip(keys, varied_set)))
 
-            # Build all combinations of N matches
-            replacements_for_matches = [self.iterWorkspaceObjs[iterKey] for iterKey in matches]
-            for replacement_set in itertools.product(*replacements_for_matches):
-                if isinstance(replacement_set, str): replacement_set = set(replacement_set)
-                # Loop of replacements, perform replacements, and track the variation
-                find_replace_map = {matches[i]:replacement_set[i] for i in range(len(matches))}
-                to_vary[objKey].append(_iterativeReplace(obj, find_replace_map))
+    def _placeholders(self, s):
+        '''List-valued GLOBAL keys (self.iterWorkspaceObjs) that appear in `s`. Memoized.
 
-            if len(to_vary[objKey]) == 0:
-                # if no replacements, store original
-                to_vary[objKey] = [obj]
+        Args:
+            s (str): String to scan.
 
-        # Use func to plug everything back together
-        out = []
-        for varied_set in itertools.product(*(to_vary.values())):
-            varied_set_map = {key: varied_set[i] for i,key in enumerate(to_vary.keys())}
-            out.append(func(varied_set_map))
-        
-        return out
+        Returns:
+            tuple(str): Keys in the order of self.iterWorkspaceObjs.
+        '''
+        if s not in self._placeholderCache:
+            self._placeholderCache[s] = tuple(k for k in self.iterWorkspaceObjs.keys() if k in s)
+        return self._placeholderCache[s]
+
+    def _expand(self, s):
+        '''All strings made by replacing the list-valued GLOBAL keys in `s` with
+        every combination of their values. Memoized on (`s`, placeholders in `s`).
+
+        Args:
+            s (str): String to expand.
+
+        Returns:
+            tuple(str): Expansions (just `s` if there are no placeholders).
+        '''
+        matches = self._placeholders(s)
+        if (s, matches) not in self._expansionCache:
+            expansions = []
+            for replacement_set in itertools.product(*[self.iterWorkspaceObjs[k] for k in matches]):
+                out = s
+                for f,r in zip(matches, replacement_set):
+                    out = out.replace(f,r)
+                expansions.append(out)
+            self._expansionCache[(s, matches)] = tuple(expansions)
+        return self._expansionCache[(s, matches)]
 
     def Add(self,cNew,onlyOn=['process','region']):
         raise NotImplementedError('Multiple config support is currently a work in progress. Only the first config will be used.')
@@ -358,52 +363,132 @@ class OrganizedHists():
         binning (Binning): Binning object, taken from configObj.
         rebinned (bool): Flag to denote if a rebinning has already occured.
         file (ROOT.TFile): TFile to store histograms on disk.
+        index (OrderedDict): Map of histogram name to HistInfo (TKey, binning, process,
+            region, subspace, systematic) for every histogram in the file.
 
     Args:
         configObj (Config): Config object.
     '''
-    def __init__(self,projPath,binnings,hist_map,readOnly=False):
+    def __init__(self,projPath,binnings,hist_map,readOnly=False,nCores=1,useCache=True):
         self.filename = projPath + 'organized_hists.root'
         self.hist_map = hist_map
+        self.index = OrderedDict()
 
         if os.path.exists(self.filename) and readOnly:
-            self.file = ROOT.TFile.Open(self.filename,"OPEN")
+            for histdf in self.hist_map.values():
+                for row in histdf.to_dict('records'):
+                    self._register(row, binnings[row['binning']])
         else:
-            self.file = ROOT.TFile.Open(self.filename,"RECREATE")
-            self.Add(binnings)
-            self.file.Close()
-            self.file = ROOT.TFile.Open(self.filename,"OPEN")
+            # The workers are forked before any file is opened so that they do not inherit
+            # the open output (or cache) TFile. They only read the source files.
+            nfiles = len(self.hist_map)
+            pool = multiprocessing.Pool(min(nCores,nfiles)) if nCores > 1 and nfiles > 1 else None
+            cache, self.file = None, None
+            try:
+                cache = HistCache(self.filename) if useCache else None
+                self.file = ROOT.TFile.Open(self.filename,"RECREATE")
+                self.Add(binnings,pool,cache)
+                self.file.Close()
+            except:
+                if cache != None: # keep the previous build so the next attempt can use it
+                    if self.file: self.file.Close()
+                    cache.Restore()
+                raise
+            finally:
+                if pool != None:
+                    pool.close()
+                    pool.join()
+            if cache != None: cache.Close()
+
+        self.file = ROOT.TFile.Open(self.filename,"OPEN")
+        self._indexKeys()
+
+    def _register(self, row, binning):
+        '''Add the histogram described by a `hist_map` row, and its sub-regions,
+        to the index. TKeys are attached once the file is opened for reading.
+
+        Args:
+            row (dict): Row of a `hist_map` DataFrame.
+            binning (Binning): Binning of the histogram.
+
+        Returns:
+            None
+        '''
+        info = HistInfo(None, row['binning'], row['process'], row['region'], 'FULL', row['systematic'])
+        self.index[row['out_histname']] = info
+        for sub in binning.xbinByCat.keys():
+            self.index[row['out_histname'].replace('_FULL','_'+sub)] = info._replace(subspace=sub)
+
+    def _indexKeys(self):
+        '''Attach the TKey of each histogram in the file to its index entry.
+        Histograms not described by `hist_map` are indexed without meta information.
+
+        Returns:
+            None
+        '''
+        for hkey in self.file.GetListOfKeys():
+            name = hkey.GetName()
+            if name in self.index:
+                self.index[name] = self.index[name]._replace(key=hkey)
+            else:
+                self.index[name] = HistInfo(hkey, None, None, None, None, None)
 
-    def Add(self, binnings):
+    def Add(self, binnings, pool=None, cache=None):
         '''Manipulate all histograms in self.hist_map and save them to organized_hists.root.
+        Each source file is read, scaled, and rebinned independently so, with a `pool`,
+        the files are processed by the worker processes which pass the bin arrays
+        back to this (single) writer. The serial and parallel paths build the output
+        histograms in the same way so the stored content is identical.
+
+        If a HistCache is provided, histograms (and their sub-regions) whose inputs
+        and binning are unchanged since the previous build are copied from it
+        and only the remaining rows are recomputed. Every row (cached or not) is
+        registered in the histogram index.
+
+        Args:
+            binnings (dict): Map of binning names to Binning objects.
+            pool (multiprocessing.Pool, optional): Worker processes. Defaults to None (serial).
+            cache (HistCache, optional): Cache of the previous build. Defaults to None.
 
         Returns:
             None
         '''
+        bin_edges = {k:(b.xbinList,b.ybinList) for k,b in binnings.items()}
+        jobs = []
         for infilename,histdf in self.hist_map.items():
-            infile = ROOT.TFile.Open(infilename)
-            for row in histdf.itertuples():
-                if row.source_histname not in [k.GetName() for k in infile.GetListOfKeys()]:
-                    raise NameError('Histogram name %s does not exist in file %s.'%(row.source_histname,infile.GetName()))
-                h = infile.Get(row.source_histname)
-                h.SetDirectory(0)
-                h.Scale(row.scale)
-                binning = binnings[row.binning]
-
-                if get_bins_from_hist("Y", h) != binning.ybinList:
-                    h = copy_hist_with_new_bins(row.out_histname+'_rebinY','Y',h,binning.ybinList)
-                if get_bins_from_hist("X", h) != binning.xbinList:
-                    h = copy_hist_with_new_bins(row.out_histname,'X',h,binning.xbinList)
-                else:
-                    h.SetName(row.out_histname)
-
-                h.SetTitle(row.out_histname)
-                h.SetFillColor(row.color)
-
-                self.file.WriteTObject(h, row.out_histname)
-                self.CreateSubRegions(h, binning)
-
-            infile.Close()
+            rows_to_make = []
+            for row in histdf.to_dict('records'):
+                binning = binnings[row['binning']]
+                self._register(row, binning)
+                if cache != None:
+                    key = _hist_cache_key(infilename, row, binning)
+                    row['cache_key'] = key
+                    histnames = [row['out_histname']]+[row['out_histname'].replace('_FULL','_'+sub) for sub in binning.xbinByCat.keys()]
+                    cached_hists = cache.Get(key, histnames)
+                    if cached_hists != None:
+                        for h in cached_hists:
+                            self.file.WriteTObject(h, h.GetName())
+                        continue
+                rows_to_make.append(row)
+
+            if len(rows_to_make) > 0:
+                jobs.append((infilename,rows_to_make,bin_edges))
+
+        if cache != None:
+            print ('Reusing %s cached histograms. Remaking %s.'%(cache.nhits, sum([len(j[1]) for j in jobs])))
+
+        if pool != None and len(jobs) > 1:
+            results = pool.imap(_ingest_source_file, jobs)
+        else:
+            results = (_ingest_source_file(job) for job in jobs)
+
+        for hist_records in results:
+            for record in hist_records:
+                h = _hist_from_record(record)
+                self.file.WriteTObject(h, record['name'])
+                self.CreateSubRegions(h, binnings[record['binning']])
+                if cache != None:
+                    cache.Track(record['name'], record['cache_key'])
 
     def Get(self,histname='',process='',region='',systematic='',subspace='FULL'):
         '''Get histogram from the opened TFile. Specify the histogram
@@ -430,18 +515,54 @@ class OrganizedHists():
             if systematic != '':
                 histname+='_'+systematic
 
-        all_histnames = [k.GetName() for k in self.file.GetListOfKeys()]
-        if histname not in all_histnames:
+        if histname not in self.index or self.index[histname].key == None:
             raise NameError('Histogram %s does not exist.'%(histname))
 
         return self.file.Get(histname)
 
     def GetHistNames(self):
-        return [hkey.GetName() for hkey in self.file.GetListOfKeys()]
+        return [hname for hname,info in self.index.items() if info.key != None]
+
+    def GetInfo(self,histname):
+        '''Get the indexed information on a histogram.
+
+        Args:
+            histname (str): Name of histogram.
+
+        Raises:
+            NameError: If the histogram is not in the index.
+
+        Returns:
+            HistInfo: Named tuple of (key, binning, process, region, subspace, systematic).
+        '''
+        if histname not in self.index:
+            raise NameError('Histogram %s does not exist.'%(histname))
+        return self.index[histname]
+
+    def Query(self,process=None,region=None,subspace=None,systematic=None):
+        '''Get the names of the stored histograms matching all of the provided selections.
+        Each selection can be a single value or a list of accepted values. Selections
+        left as None are not applied. Nominal histograms have `systematic` equal to ''.
+
+        Args:
+            process (str or list, optional): Process name(s). Defaults to None.
+            region (str or list, optional): Region name(s). Defaults to None.
+            subspace (str or list, optional): Subspace name(s) ('FULL','LOW','SIG','HIGH'). Defaults to None.
+            systematic (str or list, optional): Systematic variation(s) (ex. 'JERUp'). Defaults to None.
+
+        Returns:
+            list(str): Histogram names, in the order they were indexed.
+        '''
+        selections = {}
+        for field,value in [('process',process),('region',region),('subspace',subspace),('systematic',systematic)]:
+            if value is None: continue
+            selections[field] = set(value) if isinstance(value,(list,tuple,set)) else set([value])
+
+        return [hname for hname,info in self.index.items()
+                if info.key != None and all(getattr(info,field) in accepted for field,accepted in selections.items())]
 
     def BinningLookup(self,histname):
-        all_hists = pandas.concat([v[['out_histname','binning']] for v in self.hist_map.values()])
-        return all_hists.loc[all_hists.out_histname.eq(histname)].iloc[0].binning
+        return self.GetInfo(histname).binning
 
     def CreateSubRegions(self,h,binning):
         '''Sub-divide input histogram along the X axis into the regions specified in the config
@@ -460,6 +581,177 @@ class OrganizedHists():
                     hsub.SetBinContent(b,1e-6)
             self.file.WriteObject(hsub, hsub.GetName())
 
+HistInfo = namedtuple('HistInfo',['key','binning','process','region','subspace','systematic'])
+
+class HistCache():
+    '''Track which inputs each histogram in organized_hists.root was built from
+    so that a rebuild can reuse any histogram whose inputs did not change.
+    The keys are stored in organized_hists_cache.json next to the ROOT file.
+    On construction, an existing organized_hists.root is moved aside
+    (to organized_hists_prev.root) and opened to serve cache hits. It is deleted
+    on Close(), once the new file has been written, or moved back by Restore()
+    if the new build failed.
+
+    Args:
+        filename (str): Path to organized_hists.root.
+
+    Attributes:
+        nhits (int): Number of histograms served from the cache.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.manifestname = filename.replace('.root','_cache.json')
+        self._prevfilename = filename.replace('.root','_prev.root')
+        self.previous = {}
+        self.current = {}
+        self.nhits = 0
+        self.file = None
+        if os.path.exists(filename) and os.path.exists(self.manifestname):
+            with open(self.manifestname) as fmanifest:
+                self.previous = json.load(fmanifest)
+            os.rename(filename, self._prevfilename)
+            self.file = ROOT.TFile.Open(self._prevfilename)
+
+    def Get(self, key, histnames):
+        '''Get the cached versions of `histnames` if the first (the "FULL" histogram)
+        was previously built with the same `key`.
+
+        Args:
+            key (str): Key from _hist_cache_key(). None is never a hit.
+            histnames (list(str)): Names of the histograms to retrieve.
+
+        Returns:
+            list(TH2): Cached histograms or None if any is missing or out of date.
+        '''
+        if key == None or self.file == None or self.previous.get(histnames[0]) != key:
+            return None
+        out = []
+        for hname in histnames:
+            h = self.file.Get(hname)
+            if h == None:
+                return None
+            out.append(h)
+        self.Track(histnames[0], key)
+        self.nhits += 1
+        return out
+
+    def Track(self, histname, key):
+        '''Record the key of a histogram in the new build.'''
+        if key != None:
+            self.current[histname] = key
+
+    def Close(self):
+        '''Save the keys of the new build and delete the previous build.'''
+        with open(self.manifestname,'w') as fmanifest:
+            json.dump(self.current, fmanifest, indent=2, sort_keys=True)
+        if self.file != None:
+            self.file.Close()
+            os.remove(self._prevfilename)
+
+    def Restore(self):
+        '''Move the previous build back in place of a failed new build. Its keys are still
+        the ones in the manifest so it is reused by the next build.'''
+        if self.file != None:
+            self.file.Close()
+            os.rename(self._prevfilename, self.filename)
+        self.file = None
+
+def _hist_cache_key(infilename, row, binning):
+    '''Hash everything that determines the content of an output histogram:
+    the source file (path, size, and modification time), the source histogram name,
+    the scale, the fill color, and the binning scheme.
+
+    Args:
+        infilename (str): Source file path.
+        row (dict): Row of the histogram map.
+        binning (Binning): Binning of the output histogram.
+
+    Returns:
+        str: Hex digest or None if the source file cannot be inspected (ex. a remote file).
+    '''
+    if not os.path.isfile(infilename):
+        return None
+    stat = os.stat(infilename)
+    info = [os.path.abspath(infilename), stat.st_size, stat.st_mtime,
+            row['source_histname'], row['scale'], row['color'],
+            binning.xbinByCat, binning.ybinList]
+    return hashlib.sha1(json.dumps(info, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _ingest_source_file(job):
+    '''Read, scale, and rebin all of the requested histograms from one source file
+    and return them as plain bin arrays (so they can be passed between processes).
+
+    Args:
+        job (tuple): Source file name, list of row dictionaries (with keys `source_histname`,
+            `out_histname`, `scale`, `color`, and `binning`), and a dictionary mapping binning
+            names to the (X, Y) bin edge lists.
+
+    Raises:
+        NameError: If a requested histogram does not exist in the file.
+
+    Returns:
+        list(dict): One record per histogram as consumed by _hist_from_record().
+    '''
+    infilename, rows, bin_edges = job
+    infile = ROOT.TFile.Open(infilename)
+    all_histnames = set([k.GetName() for k in infile.GetListOfKeys()])
+
+    out = []
+    for row in rows:
+        if row['source_histname'] not in all_histnames:
+            raise NameError('Histogram name %s does not exist in file %s.'%(row['source_histname'],infile.GetName()))
+        h = infile.Get(row['source_histname'])
+        h.SetDirectory(0)
+        h.Scale(row['scale'])
+        xbins, ybins = bin_edges[row['binning']]
+
+        if get_bins_from_hist("Y", h) != ybins:
+            h = copy_hist_with_new_bins(row['out_histname']+'_rebinY','Y',h,ybins)
+        if get_bins_from_hist("X", h) != xbins:
+            h = copy_hist_with_new_bins(row['out_histname'],'X',h,xbins)
+
+        content, errors = get_hist_arrays(h)
+        out.append({
+            'name': row['out_histname'],
+            'cache_key': row.get('cache_key'),
+            'binning': row['binning'],
+            'color': row['color'],
+            'class': h.ClassName(),
+            'xbins': get_bins_from_hist("X", h),
+            'ybins': get_bins_from_hist("Y", h),
+            'xaxis': (h.GetXaxis().GetName(), h.GetXaxis().GetTitle()),
+            'yaxis': (h.GetYaxis().GetName(), h.GetYaxis().GetTitle()),
+            'entries': h.GetEntries(),
+            'content': content,
+            'errors': errors
+        })
+
+    infile.Close()
+    return out
+
+def _hist_from_record(record):
+    '''Build the output histogram from a record made by _ingest_source_file().
+
+    Args:
+        record (dict): Histogram name, binning, and bin arrays.
+
+    Returns:
+        TH2: Output histogram.
+    '''
+    h = getattr(ROOT,record['class'])(
+            record['name'], record['name'],
+            len(record['xbins'])-1, array.array('d',record['xbins']),
+            len(record['ybins'])-1, array.array('d',record['ybins'])
+        )
+    h.Sumw2()
+    for axis,info in [(h.GetXaxis(),record['xaxis']),(h.GetYaxis(),record['yaxis'])]:
+        axis.SetName(info[0])
+        axis.SetTitle(info[1])
+    set_hist_arrays(h, record['content'], record['errors'])
+    h.SetEntries(record['entries'])
+    h.SetFillColor(record['color'])
+    return h
+
 def _keyword_replace(df,col_strs):
     '''Given a DataFrame and list of column names,
     find and replace the three keywords ("$process", "$region$", "$syst") with their
@@ -472,19 +764,21 @@ def _keyword_replace(df,col_strs):
     Returns:
         pandas.DataFrame: The manipulated DataFrame copy.
     '''
-    def _batch_replace(row,s=None):
-        if pandas.isna(row[s]):
-            return nan
-        else:
-            return replace_multi(
-                row[col_str],
-                {'$process': row.alias,
-                 '$region':  row.region,
-                 '$syst':    row.variation_alias}
-            )
-
     for col_str in col_strs:
-        df[col_str] = df.apply(_batch_replace, axis='columns', s=col_str)
+        col = df[col_str]
+        if col.isnull().all():
+            continue
+        # Only rows with a keyword need a (row-specific) replacement. The rest are kept as is (including NaN).
+        has_keyword = col.str.contains('$', regex=False).fillna(False).astype(bool).values
+        if not has_keyword.any():
+            continue
+        replaced = col.astype(object).values.copy()
+        replaced[has_keyword] = [
+            replace_multi(v, {'$process': a, '$region': r, '$syst': s})
+            for v,a,r,s in zip(col.values[has_keyword], df.alias.values[has_keyword],
+                               df.region.values[has_keyword], df.variation_alias.values[has_keyword])
+        ]
+        df[col_str] = replaced
     return df
 
 def _get_syst_attrs(name,syst_dict):
@@ -548,7 +842,8 @@ def _df_condense_nameinfo(df,baseColName):
     Returns:
         pandas.DataFrame: Condensed DataFrame.
     '''
-    df[baseColName] = df.apply(lambda row: row[baseColName+'_syst'] if pandas.notna(row[baseColName+'_syst']) else row[baseColName], axis='columns')
+    syst_col = df[baseColName+'_syst']
+    df[baseColName] = syst_col.where(syst_col.notna(), df[baseColName].values).values
     df.drop(baseColName+'_syst',axis='columns',inplace=True)
     return df
 
@@ -1,4 +1,4 @@
-import subprocess, json, ROOT, os, copy, time, glob
+import subprocess, json, ROOT, os, copy, time, glob, hashlib
 from collections import defaultdict
 from contextlib import contextmanager
 
@@ -118,6 +118,107 @@ def cd(newdir): # pragma: no cover
     finally:
         os.chdir(prevdir)
 
+def execute_cmd_in(cmd,cwd,log):
+    '''Execute a command-line command via subprocess.call() in the directory `cwd`
+    without changing the working directory of this process (so it is safe to use
+    from several processes at once). The stdout and stderr of the command are streamed
+    (appended) to the file `log`, relative to `cwd`.
+
+    Args:
+        cmd (str): Command to execute as a subprocess.
+        cwd (str): Directory to execute the command in.
+        log (str): Name of the log file, relative to `cwd`.
+
+    Returns:
+        int: Return code of the command.
+    '''
+    print ('Executing in %s: %s'%(cwd,cmd))
+    with open(os.path.join(cwd,log),'a') as logfile:
+        return subprocess.call(cmd,shell=True,cwd=cwd,stdout=logfile,stderr=subprocess.STDOUT)
+
+_file_hashes = {}
+def file_hash(filename):
+    '''SHA1 of the contents of a file. The result is memoized on the
+    path, size, and modification time so that large files (ex. base.root)
+    are only read once per process while unchanged.
+
+    Args:
+        filename (str): File name and path.
+
+    Returns:
+        str: Hex digest.
+    '''
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(filename,'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+def build_workspace(card, t2wOptions='--channel-masks --X-no-jmax', cacheDir=None, rebuild=False):
+    '''Compile a Combine card into a workspace with text2workspace.py, reusing a
+    previously compiled workspace if one exists for the same card content,
+    text2workspace.py options, and shape files (ex. base.root). The workspaces
+    are stored as `<hash>.root` in `cacheDir` so that cards which are identical
+    between subtags share one workspace.
+
+    The build runs in the directory of the card (without changing the working
+    directory of this process) and its output goes to text2workspace.log in that
+    directory. The workspace is written to a temporary file and then moved into
+    place so that several processes can safely request the same workspace.
+
+    Args:
+        card (str): Path to the card.
+        t2wOptions (str, optional): Options to pass to text2workspace.py. Defaults to '--channel-masks --X-no-jmax'.
+        cacheDir (str, optional): Directory to store the workspaces. Defaults to None in which case
+            `workspace_cache/` next to the first shape file in the card (normally base.root) is used.
+        rebuild (bool, optional): Always run text2workspace.py (and replace the cached workspace). Defaults to False.
+
+    Raises:
+        RuntimeError: If text2workspace.py fails.
+
+    Returns:
+        str: Absolute path to the workspace.
+    '''
+    card_dir = os.path.dirname(os.path.abspath(card))
+    with open(card) as f:
+        card_text = f.read()
+
+    shape_files = []
+    for line in card_text.splitlines():
+        pieces = line.split()
+        if len(pieces) > 3 and pieces[0] == 'shapes':
+            shape_file = os.path.normpath(os.path.join(card_dir, pieces[3]))
+            if shape_file not in shape_files:
+                shape_files.append(shape_file)
+
+    h = hashlib.sha1((card_text+t2wOptions).encode('utf-8'))
+    for shape_file in sorted(shape_files):
+        h.update(file_hash(shape_file).encode('utf-8'))
+
+    if cacheDir == None:
+        cacheDir = os.path.join(os.path.dirname(shape_files[0]) if len(shape_files) > 0 else card_dir, 'workspace_cache')
+    if not os.path.isdir(cacheDir):
+        try: os.makedirs(cacheDir)
+        except OSError: pass # made by another process in the meantime
+
+    workspace = os.path.abspath(os.path.join(cacheDir, h.hexdigest()+'.root'))
+    if rebuild or not os.path.exists(workspace):
+        tmp_workspace = '%s.%s.tmp'%(workspace, os.getpid())
+        returncode = execute_cmd_in(
+            'text2workspace.py -b %s -o %s %s'%(os.path.abspath(card), tmp_workspace, t2wOptions),
+            card_dir, 'text2workspace.log')
+        if returncode != 0 or not os.path.exists(tmp_workspace):
+            raise RuntimeError('text2workspace.py failed for %s. See %s/text2workspace.log.'%(card, card_dir))
+        os.rename(tmp_workspace, workspace)
+    else:
+        print ('Reusing workspace %s for %s'%(workspace, card))
+
+    return workspace
+
 def make_RDH(myTH2,RAL_vars,altname=''):
     '''Create a RooDataHist from the input TH2 and RooArgList of
     axis variables.
@@ -282,7 +383,7 @@ def _combineTool_impacts_fix(fileNameExpected):
     potential_files_to_rename = glob.glob(seed_version)
 
     # Only run if there are seeded files to rename
-    if potential_files_to_rename > 0:
+    if len(potential_files_to_rename) > 0:
         all_seeds = list(set([f.split('.')[-2] for f in potential_files_to_rename]))
         if len(all_seeds) > 1:
             raise RuntimeError('More than one seed found when trying to move files for combineTool (%s). Clean up the area and try again.'%all_seeds)
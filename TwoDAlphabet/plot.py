@@ -1,8 +1,11 @@
-import glob
-import ROOT, os, warnings, pandas, math, time
+import glob, array
+from collections import OrderedDict
+import ROOT, os, warnings, pandas, math, time, itertools, numpy, multiprocessing, hashlib, json
 from PIL import Image
-from TwoDAlphabet.helpers import set_hist_maximums, execute_cmd, cd
-from TwoDAlphabet.binning import stitch_hists_in_x, convert_to_events_per_unit, get_min_bin_width
+from TwoDAlphabet.helpers import set_hist_maximums, execute_cmd, cd, file_hash
+from TwoDAlphabet.binning import stitch_hists_in_x, convert_to_events_per_unit, get_min_bin_width, get_hist_arrays, set_hist_arrays, project_slices, slice_idxs_from_edges, _buffer_to_numpy
+from TwoDAlphabet.alphawrap import transfer_func_bands
+from TwoDAlphabet.toys import ToyHarvester, read_tree_branches, empirical_pvalue, injection_pulls
 from TwoDAlphabet.ext import tdrstyle, CMS_lumi
 
 
@@ -12,6 +15,95 @@ from TwoDAlphabet.ext import tdrstyle, CMS_lumi
 yellow = ROOT.kYellow
 red = ROOT.kRed
 
+# Bump when the histograms made by Plotter._make() change so that existing outputs are remade
+_plotter_version = 1
+
+class HistCache(object):
+    '''Read access to the histograms in a ROOT file. The names of the keys are
+    indexed once (so checking for a histogram does not list the keys again) and
+    the loaded histograms are kept in a least-recently-used cache of at most `maxMB`
+    megabytes (estimated from the number of bins) so that repeated calls for the same
+    histogram do not read it from the file again.
+
+    Args:
+        tfile (ROOT.TFile): Open file.
+        maxMB (float, optional): Memory cap of the cache. Defaults to 500.
+
+    Attributes:
+        keys (set(str)): Names of the keys in the file.
+        hits (int): Number of calls to Get() served from the cache.
+        misses (int): Number of calls to Get() that read from the file.
+    '''
+    def __init__(self, tfile, maxMB=500):
+        self.file = tfile
+        self.keys = set(k.GetName() for k in tfile.GetListOfKeys())
+        self.maxBytes = maxMB*1024*1024
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._nbytes = 0
+
+    def __contains__(self, name):
+        return name in self.keys
+
+    def Get(self, name):
+        '''Get a histogram by name.
+
+        Raises:
+            LookupError: If the histogram is not in the file.
+
+        Returns:
+            TH1: Histogram (the same object for repeated calls while cached).
+        '''
+        if name in self._cache:
+            self.hits += 1
+            entry = self._cache.pop(name)
+            self._cache[name] = entry # most recently used
+            return entry[0]
+
+        if name not in self.keys:
+            raise LookupError('Histogram %s not found in %s'%(name,self.file.GetName()))
+        self.misses += 1
+        obj = self.file.Get(name)
+        if isinstance(obj, ROOT.TH1):
+            obj.SetDirectory(0)
+            ROOT.SetOwnership(obj, True) # freed when evicted
+            nbytes = 16*obj.GetNcells()+1024 # contents and sum of squared weights
+        else:
+            nbytes = 1024
+
+        self._cache[name] = (obj, nbytes)
+        self._nbytes += nbytes
+        while self._nbytes > self.maxBytes and len(self._cache) > 1:
+            _, (_, evicted_bytes) = self._cache.popitem(last=False)
+            self._nbytes -= evicted_bytes
+        return obj
+
+    def Stats(self):
+        '''Returns:
+            dict: Number of hits, misses, the hit rate, and the number and estimated size (MB) of the cached histograms.'''
+        ncalls = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': float(self.hits)/ncalls if ncalls else 0.0,
+                'cached': len(self._cache), 'cached_MB': self._nbytes/1024.0/1024.0}
+
+def _region_slice_grid(pads):
+    '''Lay out projection pads for make_can() with one row per region and one column per slice.
+    Rows of regions with fewer slices than the others are padded with blanks (None).
+
+    Args:
+        pads (pandas.DataFrame): One row per pad with the columns "pad", "region", and "slice" (int).
+
+    Returns:
+        tuple(list, int, int): Pad names in the order to paste them, the number of pads across, and the number down.
+    '''
+    padx = int(pads.groupby('region').size().max())
+    padnames = []
+    for _, group in pads.groupby('region', sort=True):
+        row = group.sort_values(by='slice').pad.to_list()
+        padnames.extend(row+[None]*(padx-len(row)))
+    return padnames, padx, len(padnames)//padx
+
 class Plotter(object):
     '''Class to manage output distributions, manipulate them, and provide access to plotting
     standard groups of distributions.
@@ -26,14 +118,22 @@ class Plotter(object):
         dir (str): Directory path to save final images.
         slices (dict): Stores edges to slice "x" and "y" axes. 
         root_out (ROOT.TFile): File storing all histograms that are made.
+        hists (HistCache): Index and cache of the histograms in `root_out` (see Get()).
+        nCores (int): Number of processes to draw the pads with.
     '''
-    def __init__(self,ledger,twoD,fittag,loadExisting=False):
+    def __init__(self,ledger,twoD,fittag,loadExisting=False,nCores=None,sliceEdges={},rebuild=False):
         '''Constructor.
 
         Args:
             twoD (TwoDAlphabet): Object with meta information about the run.
             fittag (str): Either 's' or 'b'.
             loadExisting (bool, optional): Flag to load existing projections instead of remaking everything. Defaults to False.
+                If False, only the projections whose inputs changed since the last time are remade (see _make()).
+            nCores (int, optional): Number of processes to draw the pads with (see render_pads()).
+                Defaults to None in which case the `nCores` option is used.
+            sliceEdges (dict, optional): Slice edges to use for the "x" and/or "y" axes of every region instead of
+                the default three slices (ex. {'y': [800,1000,1200,1500,2000]}). Edges must be bin edges. Defaults to {}.
+            rebuild (bool, optional): Remake all of the projections even if their inputs did not change. Defaults to False.
         '''
 
         self.fittag = fittag
@@ -43,10 +143,13 @@ class Plotter(object):
         self.df = pandas.DataFrame(columns=['process','region','process_type','title'])
         self.dir = 'plots_fit_{f}'.format(f=self.fittag)
         self.slices = {'x': {}, 'y': {}}
+        self.sliceEdges = sliceEdges
         self.root_out = None
+        self.hists = None
+        self.nCores = twoD.options.nCores if nCores == None else nCores
 
         if not loadExisting:
-            self._make()
+            self._make(rebuild)
         else:
             self._load()
 
@@ -60,7 +163,22 @@ class Plotter(object):
         and reference with `self.df` and `self.root_out` attributes.'''
         root_out_name = '%s/all_plots.root'%self.dir
         self.root_out = ROOT.TFile.Open(root_out_name)
-        self.df = pandas.read_csv('%s/df.csv'%self.dir)
+        self.hists = HistCache(self.root_out, self.twoD.options.plotCacheMB)
+        self.df = pandas.read_csv('%s/df.csv'%self.dir, index_col=0)
+        self._setSlices()
+
+    def _setSlices(self):
+        '''Set the edges (`vals`) and bin indices (`idxs`) of the slices of the "x" and "y" axes
+        of each region. By default, the three slices of the Binning (x: below, in, and above the signal region).
+        Those in `self.sliceEdges` are used instead where given.'''
+        for region in self.ledger.GetRegions():
+            binning,_ = self.twoD.GetBinningFor(region)
+            for axis, binList, vals, idxs in [('x', binning.xbinList, binning.xSlices, binning.xSliceIdx),
+                                              ('y', binning.ybinList, binning.ySlices, binning.ySliceIdx)]:
+                if axis in self.sliceEdges:
+                    vals = self.sliceEdges[axis]
+                    idxs = slice_idxs_from_edges(binList, vals)
+                self.slices[axis][region] = {'vals': vals, 'idxs': idxs}
 
     def _format_1Dhist(self, hslice, title, xtitle, ytitle, color, proc_type):
         '''Perform some basic formatting of a 1D histogram so that the ROOT.TH1
@@ -104,94 +222,157 @@ class Plotter(object):
 
         return hslice
 
-    def _make(self):
-        '''Make the DataFrame and output ROOT file from scratch
+    def _style(self, process):
+        '''Color, process type, and title of a process (from the ledger).
+
+        Args:
+            process (str): Process name (or 'TotalBkg').
+
+        Returns:
+            tuple: Color, process type, and title.
+        '''
+        if process == 'TotalBkg':
+            return ROOT.kBlack, 'TOTAL', 'TotalBkg'
+
+        color = self.ledger.GetProcessColor(process)
+        if 'TTbar' in process:
+            color = red
+        return color, self.ledger.GetProcessType(process), self.ledger.GetProcessTitle(process)
+
+    def _get_shapes(self, shapes_file, process, region):
+        '''Get the LOW, SIG, and HIGH pre-fit and post-fit histograms of a process in a region
+        from the shapes file.
+
+        Raises:
+            IOError: If a histogram cannot be found.
+
+        Returns:
+            dict: Lists of the [LOW, SIG, HIGH] histograms for 'prefit' and 'postfit'.
+        '''
+        loc_base = '{r}_{c}_{t}/{p}'
+        out = {}
+        for time in ['prefit','postfit']:
+            out[time] = []
+            for c in ['LOW','SIG','HIGH']:
+                name = loc_base.format(r=region, c=c, t=time, p=process)
+                h = shapes_file.Get(name)
+                if h == None: raise IOError('Could not find histogram %s in postfitshapes_%s.root'%(name, self.fittag))
+                out[time].append(h)
+        return out
+
+    def _settings_fingerprint(self):
+        '''Fingerprint of the settings which apply to all of the histograms (binning, slices, and plot options).'''
+        binnings = {}
+        for region in self.ledger.GetRegions():
+            binning,_ = self.twoD.GetBinningFor(region)
+            binnings[region] = [binning.xbinList, binning.ybinList, binning.xtitle, binning.ytitle]
+        return _fingerprint({'binning': binnings, 'slices': self.slices,
+                             'blindedPlots': self.twoD.options.blindedPlots,
+                             'plotEvtsPerUnit': self.twoD.options.plotEvtsPerUnit,
+                             'version': _plotter_version})
+
+    def _hist_names(self, process, region):
+        '''Names of all of the histograms made for a process in a region.'''
+        names = []
+        for time in ['prefit','postfit']:
+            names.append('%s_%s_%s_2D'%(process,region,time))
+            for proj in ['x','y']:
+                nslices = len(self.slices['x' if proj == 'y' else 'y'][region]['idxs'])-1
+                names.extend(['%s_%s_%s_proj%s%s'%(process,region,time,proj,i) for i in range(nslices)])
+        return names
+
+    def _make(self, rebuild=False):
+        '''Make the DataFrame and output ROOT file (or bring them up to date)
         and reference with `self.df` and `self.root_out` attributes.
         
         Loops over all regions and processes from the pre-fit and post-fit shapes
-        and tracks/constructs the 2D histograms and six projections (three each for "x" and "y"). 
+        and tracks/constructs the 2D histograms and their projections in each slice (see _setSlices()).
+        The histograms are written to the output file together at the end.
+
+        The inputs of each process-region pair (its histograms in postfitshapes_<fittag>.root and its
+        color, type, and title) and the settings shared by all pairs are fingerprinted and saved
+        to fingerprints.json in `self.dir`. If the settings match those of the existing all_plots.root,
+        only the pairs whose inputs changed are remade (in place) and nothing is remade if none changed.
+        Otherwise, everything is remade.
+
+        Args:
+            rebuild (bool, optional): Remake everything regardless of the saved fingerprints. Defaults to False.
         '''
         root_out_name = '%s/all_plots.root'%self.dir
-        self.root_out = ROOT.TFile.Open(root_out_name,'RECREATE')
-
-        shapes_file = ROOT.TFile.Open('postfitshapes_%s.root'%self.fittag)
-        loc_base = '{r}_{c}_{t}/{p}'
+        state_name = '%s/fingerprints.json'%self.dir
+        shapes_name = 'postfitshapes_%s.root'%self.fittag
 
         proc_reg_pairs = self.ledger.GetProcRegPairs()+[('TotalBkg', r) for r in self.ledger.GetRegions()]
+        self._setSlices()
+
+        old = None
+        if not rebuild and os.path.exists(root_out_name) and os.path.exists(state_name):
+            with open(state_name) as f:
+                old = json.load(f)
 
+        shapes_file = ROOT.TFile.Open(shapes_name)
+        state = {'settings': self._settings_fingerprint(), 'shapes': file_hash(shapes_name), 'styles': {}, 'inputs': {}}
+        rows, pairs = [], []
         for region in self.ledger.GetRegions():
-            binning,_ = self.twoD.GetBinningFor(region)
-            if len(self.twoD.options.blindedPlots) > 0:
-                if region in self.twoD.options.blindedPlots:
-                    blinding = [1]
-                else: blinding = []
-            else: blinding = []
-
-            self.slices['x'][region] = {'vals': binning.xSlices,'idxs':binning.xSliceIdx}
-            self.slices['y'][region] = {'vals': binning.ySlices,'idxs':binning.ySliceIdx}
-            
             for process in self.ledger.GetProcesses()+['TotalBkg']:
                 # Skip processes not in this region
                 if process not in [pair[0] for pair in proc_reg_pairs if pair[1] == region]:
                     continue
-                
-                if process != 'TotalBkg':
-                    color = self.ledger.GetProcessColor(process)
-                    
-                    if 'TTbar' in process:
-                        color = red
-                    
-                    proc_type = self.ledger.GetProcessType(process)
-                    proc_title = self.ledger.GetProcessTitle(process)
+
+                color, proc_type, proc_title = self._style(process)
+                rows.append({'process':process,
+                             'region':region,
+                             'process_type': proc_type,
+                             'title': proc_title})
+
+                key = _pair_key(process, region)
+                pairs.append(key)
+                state['styles'][key] = _fingerprint([color, proc_type, proc_title])
+                if old != None and old['shapes'] == state['shapes'] and key in old['inputs']:
+                    state['inputs'][key] = old['inputs'][key]
                 else:
-                    color = ROOT.kBlack
-                    proc_type = 'TOTAL'
-                    proc_title = 'TotalBkg'
-
-                self.df = self.df.append({'process':process,
-                                          'region':region,
-                                          'process_type': proc_type,
-                                          'title': proc_title}, ignore_index=True)
-                
+                    shapes = self._get_shapes(shapes_file, process, region)
+                    state['inputs'][key] = _hists_fingerprint(shapes['prefit']+shapes['postfit'])
+
+        self.df = pandas.DataFrame(rows, columns=['process','region','process_type','title'])
+        mode, changed, removed = _plan_plot_update(old, state, pairs)
+        print ('Plotter (fit %s): %s (%s of %s process-region pairs to remake)'%(self.fittag, mode, len(changed), len(pairs)))
+
+        if mode != 'load':
+            self.root_out = ROOT.TFile.Open(root_out_name,'RECREATE' if mode == 'rebuild' else 'UPDATE')
+            for key in removed:
+                process, region = key.split('/')
+                if region in self.slices['x']:
+                    for name in self._hist_names(process, region):
+                        self.root_out.Delete(name+';*')
+
+            to_write = []
+            for key in changed:
+                process, region = key.split('/')
+                binning,_ = self.twoD.GetBinningFor(region)
+                blinding = [1] if region in self.twoD.options.blindedPlots else []
+                color, proc_type, proc_title = self._style(process)
+                shapes = self._get_shapes(shapes_file, process, region)
+
                 for time in ['prefit','postfit']:
                     # 2D distributions first
                     out2d_name = '%s_%s_%s_2D'%(process,region,time)
-
-                    low_name = loc_base.format(r=region, c='LOW', t=time, p=process)
-                    sig_name = loc_base.format(r=region, c='SIG', t=time, p=process)
-                    high_name = loc_base.format(r=region, c='HIGH',t=time, p=process)
-                    
-                    low  = shapes_file.Get(low_name)
-                    sig  = shapes_file.Get(sig_name)
-                    high = shapes_file.Get(high_name)
-
-                    if low == None: raise IOError('Could not find histogram %s in postfitshapes_%s.root'%(low_name, self.fittag))
-                    if sig == None: raise IOError('Could not find histogram %s in postfitshapes_%s.root'%(sig_name, self.fittag))
-                    if high == None: raise IOError('Could not find histogram %s in postfitshapes_%s.root'%(high_name, self.fittag))
-
-                    full = stitch_hists_in_x(out2d_name, binning, [low,sig,high], blinded=blinding if process == 'data_obs' else [])
+                    full = stitch_hists_in_x(out2d_name, binning, shapes[time], blinded=blinding if process == 'data_obs' else [])
                     full.SetMinimum(0)
                     full.SetTitle('%s, %s, %s'%(proc_title,region,time))
+                    to_write.append(full)
 
-                    self.root_out.WriteTObject(full,full.GetName())
-
-                    # Now do projections using the 2D
+                    # Now do projections using the 2D (all slices of each axis at once)
+                    content, errors = get_hist_arrays(full)
                     out_proj_name = '{p}_{r}_{t}_proj{x}{i}'
                     for proj in ['X','Y']:
                         slices = self.slices['x' if proj == 'Y' else 'y'][region]
+                        proj_content, proj_errors = project_slices(content, errors, slices['idxs'], proj)
 
-                        for islice in range(3):
+                        for islice in range(len(slices['idxs'])-1):
                             hname = out_proj_name.format(p=process,r=region,t=time,x=proj.lower(),i=islice)
-                            start,stop = _get_start_stop(islice,slices['idxs'])
-                            
-                            hslice = getattr(full,'Projection'+proj)(hname,start,stop,'e')
-                            
-#                             if 'prefit' in hslice.GetName() and 'projy2' in hslice.GetName():
-#                                 print 'hname, start, stop'
-#                                 print hname, start, stop
-#                                 print hslice.Integral()
-#                                 print full.Integral()
-#                                 print ''
+                            hslice = _hist_1D_from_arrays(hname, binning.xbinList if proj == 'X' else binning.ybinList,
+                                                          proj_content[islice], proj_errors[islice])
 
                             hslice_title = '%s, %s, %s, %s-%s'%(proc_title,region,time,slices['vals'][islice],slices['vals'][islice+1])
                             hslice = self._format_1Dhist(
@@ -199,16 +380,21 @@ class Plotter(object):
                                 binning.xtitle if proj == 'X' else binning.ytitle,
                                 self.yaxis1D_title,
                                 color, proc_type)
+                            to_write.append(hslice)
 
-                            self.root_out.WriteTObject(hslice,hslice.GetName())
+            for h in to_write:
+                self.root_out.WriteTObject(h,h.GetName(),'WriteDelete')
+            self.root_out.Close()
+            with open(state_name,'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
 
         shapes_file.Close()
-        self.root_out.Close()
         self.root_out = ROOT.TFile.Open(root_out_name)
+        self.hists = HistCache(self.root_out, self.twoD.options.plotCacheMB)
 
     def Get(self,hname=None,row=None,hist_type=None):
-        '''Get a histogram by name from the master ROOT file.
-        Does quick check for if the histogram is saved.
+        '''Get a histogram by name from the master ROOT file
+        (via the key index and cache in `self.hists`).
         
         Args:
             hname (str): Histogram name.
@@ -217,12 +403,10 @@ class Plotter(object):
             LookupError: If histogram cannot be found.
         '''
         if hname != None:
-            if hname not in [k.GetName() for k in self.root_out.GetListOfKeys()]:
-                raise LookupError('Histogram %s not found in %s'%(hname,self.root_out.GetName()))
             name = hname
         else:
-            name = '_'.join([row.process,row.region,hist_type])
-        return self.root_out.Get(name)
+            name = _hist_name(row, hist_type)
+        return self.hists.Get(name)
 
     def _order_df_on_proc_list(self,df,proc_type,proclist=[],alphaBottom=True):
         '''Re-order input dataframe (`df`) based on the ordered list of process names (`proclist`).
@@ -258,15 +442,18 @@ class Plotter(object):
         Returns:
             None
         '''
+        specs, cans = [], []
         for pr, _ in self.df.groupby(['process','region']):
             process, region = pr[0], pr[1]
             out_file_name = '{d}/base_figs/{p}_{r}_%s_2D'.format(d=self.dir,p=process,r=region)
-            make_pad_2D(outname=out_file_name%('prefit'), hist=self.Get('{p}_{r}_{t}'.format(p=process,r=region,t='prefit_2D')),
-                            year=self.twoD.options.year, savePDF=True, savePNG=True, extraText='Work In Progress, prefit')
-            make_pad_2D(outname=out_file_name%('postfit'), hist=self.Get('{p}_{r}_{t}'.format(p=process,r=region,t='postfit_2D')),
-                            year=self.twoD.options.year, savePDF=True, savePNG=True, extraText='Work In Progress')
+            specs.append(_pad_spec('2D', out_file_name%('prefit'), {'hist': '{p}_{r}_{t}'.format(p=process,r=region,t='prefit_2D')},
+                            year=self.twoD.options.year, savePDF=self.twoD.options.plotPadPDFs, savePNG=self.twoD.options.plotPadPNGs, extraText='Work In Progress, prefit'))
+            specs.append(_pad_spec('2D', out_file_name%('postfit'), {'hist': '{p}_{r}_{t}'.format(p=process,r=region,t='postfit_2D')},
+                            year=self.twoD.options.year, savePDF=self.twoD.options.plotPadPDFs, savePNG=self.twoD.options.plotPadPNGs, extraText='Work In Progress'))
+
+            cans.append(('{d}/{p}_{r}_2D'.format(d=self.dir,p=process,r=region), [out_file_name%('prefit'), out_file_name%('postfit')], 2, 1))
 
-            make_can('{d}/{p}_{r}_2D'.format(d=self.dir,p=process,r=region), [out_file_name%('prefit')+'.png', out_file_name%('postfit')+'.png'])
+        self._render(specs, cans)
 
     def plot_projections(self, prefit=False):
         '''Plot comparisons of data and the post-fit background model and signal
@@ -275,14 +462,14 @@ class Plotter(object):
         are the different slices of the un-plotted axis.
 
         Args:
-	    prefit (bool): If True, will plot the prefit distributions instead of postfit. Defaults to False.
+            prefit (bool): If True, will plot the prefit distributions instead of postfit. Defaults to False.
         Returns:
             None
         '''
         
         print('self.twoD.options.year', self.twoD.options.year)
         
-        pads = pandas.DataFrame()
+        specs, pads = [], []
         for region, group in self.df.groupby('region'):
             binning,_ = self.twoD.GetBinningFor(region)
 
@@ -293,16 +480,16 @@ class Plotter(object):
                 signals = group[group.process_type.eq('SIGNAL')]
 
                 for proj in ['prefit_projx','prefit_projy'] if prefit else ['postfit_projx','postfit_projy']:
-                    for islice in range(3):
+                    for islice in range(len(self.slices['x' if 'y' in proj else 'y'][region]['idxs'])-1):
                         projn = proj+str(islice)
                         sig_projn = projn
                         if self.twoD.options.plotPrefitSigInFitB and self.fittag == 'b':
                             sig_projn = projn.replace('postfit','prefit')
 
-                        this_data =      self.Get(row=group.loc[group.process_type.eq('DATA')].iloc[0], hist_type=projn)
-                        this_totalbkg =  self.Get(row=group.loc[group.process_type.eq('TOTAL')].iloc[0], hist_type=projn)
-                        these_bkgs =    [self.Get(row=ordered_bkgs.iloc[irow], hist_type=projn) for irow in range(ordered_bkgs.shape[0])]
-                        these_signals = [self.Get(row=signals.iloc[irow], hist_type=sig_projn) for irow in range(signals.shape[0])]
+                        this_data =      _hist_name(group.loc[group.process_type.eq('DATA')].iloc[0], projn)
+                        this_totalbkg =  _hist_name(group.loc[group.process_type.eq('TOTAL')].iloc[0], projn)
+                        these_bkgs =    [_hist_name(ordered_bkgs.iloc[irow], projn) for irow in range(ordered_bkgs.shape[0])]
+                        these_signals = [_hist_name(signals.iloc[irow], sig_projn) for irow in range(signals.shape[0])]
 
                         slice_edges = (
                             self.slices['x' if 'y' in proj else 'y'][region]['vals'][islice],
@@ -316,12 +503,14 @@ class Plotter(object):
                                             d=self.dir, projn=projn, reg=region,
                                             logy='' if logyFlag == False else '_logy')
                         
-                        make_pad_1D(out_pad_name, data=this_data, bkgs=these_bkgs, signals=these_signals,
-                                    subtitle=slice_str, totalBkg=this_totalbkg,
-                                    logyFlag=logyFlag, year=self.twoD.options.year, preVsPost=False,
-                                    extraText='', savePDF=True, savePNG=True, ROOTout=False)
-                        pads = pads.append({'pad':out_pad_name+'.png', 'region':region, 'proj':projn, 'logy':logyFlag}, ignore_index=True)
-
+                        specs.append(_pad_spec('1D', out_pad_name,
+                                    {'data': this_data, 'bkgs': these_bkgs, 'signals': these_signals, 'totalBkg': this_totalbkg},
+                                    subtitle=slice_str, logyFlag=logyFlag, year=self.twoD.options.year, preVsPost=False,
+                                    extraText='', savePDF=self.twoD.options.plotPadPDFs, savePNG=self.twoD.options.plotPadPNGs, ROOTout=False))
+                        pads.append({'pad':out_pad_name, 'region':region, 'proj':projn, 'slice':islice, 'logy':logyFlag})
+
+        pads = pandas.DataFrame(pads, columns=['pad','region','proj','slice','logy'])
+        cans = []
         for logy in ['','_logy']:
             for proj in ['prefit_projx','prefit_projy'] if prefit else ['postfit_projx','postfit_projy']:
                 these_pads = pads.loc[pads.proj.str.contains(proj)]
@@ -330,28 +519,28 @@ class Plotter(object):
                 else:
                     these_pads = these_pads.loc[these_pads.logy.eq(True)]
                 
-                these_pads = these_pads.sort_values(by=['region','proj']).pad.to_list()
                 out_can_name = '{d}/{proj}{logy}'.format(d=self.dir, proj=proj, logy=logy)
-                make_can(out_can_name, these_pads)
-                
+                cans.append((out_can_name,)+_region_slice_grid(these_pads))
+
+        self._render(specs, cans)
         
     def plot_pre_vs_post(self):
         '''Make comparisons for each background process of pre and post fit projections.
         '''
+        specs, cans = [], []
         for proj in ['projx','projy']:
-            pads = pandas.DataFrame()
+            pads = []
             for pr, _ in self.df[~self.df.process.isin(['data_obs','TotalBkg'])].groupby(['process','region']):
                 process, region = pr[0], pr[1]
                 binning,_ = self.twoD.GetBinningFor(region)
-                for islice in range(3):
+                for islice in range(len(self.slices['x' if 'y' in proj else 'y'][region]['idxs'])-1):
                     projn = proj+str(islice)
-                    post = self.Get('%s_%s_postfit_%s'%(process,region,projn))
-                    post.SetLineColor(ROOT.kBlack)
-                    post.SetTitle('          Postfit,'+process)	# spaces are for legend aesthetics
-
-                    pre = self.Get('%s_%s_prefit_%s'%(process,region,projn))
-		    pre.SetLineColor(red)
-                    pre.SetTitle('Prefit, '+process)
+                    post = '%s_%s_postfit_%s'%(process,region,projn)
+                    pre = '%s_%s_prefit_%s'%(process,region,projn)
+                    styles = {
+                        post: [('SetLineColor', ROOT.kBlack), ('SetTitle', '          Postfit,'+process)], # spaces are for legend aesthetics
+                        pre:  [('SetLineColor', red), ('SetTitle', 'Prefit, '+process)]
+                    }
 
                     slice_edges = (
                         self.slices['x' if 'y' in proj else 'y'][region]['vals'][islice],
@@ -362,123 +551,96 @@ class Plotter(object):
                     slice_str = '%s < %s < %s %s'%slice_edges
 
                     out_pad_name = '{d}/base_figs/{p}_{reg}_{projn}'.format(d=self.dir,p=process,projn=projn, reg=region)
-                    make_pad_1D(
-                        out_pad_name, 
-                        post, [pre], totalBkg=pre, subtitle=slice_str, savePDF=True, savePNG=True, 
+                    specs.append(_pad_spec('1D', out_pad_name,
+                        {'data': post, 'bkgs': [pre], 'totalBkg': pre}, styles=styles,
+                        subtitle=slice_str, savePDF=self.twoD.options.plotPadPDFs, savePNG=self.twoD.options.plotPadPNGs, 
                         datastyle='histe', year=self.twoD.options.year, extraText='',
-			preVsPost=True	# This tells make_pad_1D() that we're not passing in data distributions but rather a non-data postfit dist and to relabel the legend
-                    )
+                        preVsPost=True # This tells make_pad_1D() that we're not passing in data distributions but rather a non-data postfit dist and to relabel the legend
+                    ))
                     
-                    pads = pads.append({'pad':out_pad_name+'.png','process':process,'region':region,'proj':projn}, ignore_index=True)
-
-	    for process, padgroup in pads.groupby('process'):
-		these_pads = padgroup.sort_values(by=['region','proj']).pad.to_list()
-		make_can('{d}/{p}_{proj}'.format(d=self.dir, p=process,proj=proj), these_pads)
-
-
-    def plot_transfer_funcs(self):
-        raise NotImplementedError()
-        # # Need to sample the space to get the Rp/f with proper errors (1000 samples)
-        # rpf_xnbins = len(self.fullXbins)-1
-        # rpf_ynbins = len(self.newYbins)-1
-        # if self.rpfRatio == False: rpf_zbins = [i/1000000. for i in range(0,1000001)]
-        # else: rpf_zbins = [i/1000. for i in range(0,5001)]
-        # rpf_samples = TH3F('rpf_samples','rpf_samples',rpf_xnbins, array.array('d',self.fullXbins), rpf_ynbins, array.array('d',self.newYbins), len(rpf_zbins)-1, array.array('d',rpf_zbins))# TH3 to store samples
-        # sample_size = 500
-
-        # # Collect all final parameter values
-        # param_final = fit_result.floatParsFinal()
-        # coeffs_final = RooArgSet()
-        # for v in self.rpf.funcVars.keys():
-        #     coeffs_final.add(param_final.find(v))
-
-        # # Now sample to generate the Rpf distribution
-        # for i in range(sample_size):
-        #     sys.stdout.write('\rSampling '+str(100*float(i)/float(sample_size)) + '%')
-        #     sys.stdout.flush()
-        #     param_sample = fit_result.randomizePars()
-
-        #     # Set params of the Rpf object
-        #     coeffIter_sample = param_sample.createIterator()
-        #     coeff_sample = coeffIter_sample.Next()
-        #     while coeff_sample:
-        #         # Set the rpf parameter to the sample value
-        #         if coeff_sample.GetName() in self.rpf.funcVars.keys():
-        #             self.rpf.setFuncParam(coeff_sample.GetName(), coeff_sample.getValV())
-        #         coeff_sample = coeffIter_sample.Next()
-
-        #     # Loop over bins and fill
-        #     for xbin in range(1,rpf_xnbins+1):
-        #         for ybin in range(1,rpf_ynbins+1):
-        #             bin_val = 0
-
-        #             thisXCenter = rpf_samples.GetXaxis().GetBinCenter(xbin)
-        #             thisYCenter = rpf_samples.GetYaxis().GetBinCenter(ybin)
-
-        #             if self.recycleAll:
-        #                 # Remap to [-1,1]
-        #                 x_center_mapped = (thisXCenter - self.newXbins['LOW'][0])/(self.newXbins['HIGH'][-1] - self.newXbins['LOW'][0])
-        #                 y_center_mapped = (thisYCenter - self.newYbins[0])/(self.newYbins[-1] - self.newYbins[0])
-
-        #                 # And assign it to a RooConstVar 
-        #                 x_const = RooConstVar("ConstVar_x_"+c+'_'+str(xbin)+'-'+str(ybin)+'_'+self.name,"ConstVar_x_"+c+'_'+str(xbin)+'-'+str(ybin)+'_'+self.name,x_center_mapped)
-        #                 y_const = RooConstVar("ConstVar_y_"+c+'_'+str(xbin)+'-'+str(ybin)+'_'+self.name,"ConstVar_x_"+c+'_'+str(xbin)+'-'+str(ybin)+'_'+self.name,y_center_mapped)
-                        
-        #                 # Now get the Rpf function value for this bin 
-        #                 self.allVars.append(x_const)
-        #                 self.allVars.append(y_const)
-        #                 self.rpf.evalRpf(x_const, y_const,xbin,ybin)
-
-        #             # Determine the category
-        #             if thisXCenter > self.newXbins['LOW'][0] and thisXCenter < self.newXbins['LOW'][-1]: # in the LOW category
-        #                 thisxcat = 'LOW'
-        #             elif thisXCenter > self.newXbins['SIG'][0] and thisXCenter < self.newXbins['SIG'][-1]: # in the SIG category
-        #                 thisxcat = 'SIG'
-        #             elif thisXCenter > self.newXbins['HIGH'][0] and thisXCenter < self.newXbins['HIGH'][-1]: # in the HIGH category
-        #                 thisxcat = 'HIGH'
-
-        #             bin_val = self.rpf.getFuncBinVal(thisxcat,xbin,ybin)
-
-        #             rpf_samples.Fill(thisXCenter,thisYCenter,bin_val)
-
-        # print ('\n')
-        # rpf_final = TH2F('rpf_final','rpf_final',rpf_xnbins, array.array('d',self.fullXbins), rpf_ynbins, array.array('d',self.newYbins))
-        # # Now loop over all x,y bin in rpf_samples, project onto Z axis, 
-        # # get the mean and RMS and set as the bin content and error in rpf_final
-        # for xbin in range(1,rpf_final.GetNbinsX()+1):
-        #     for ybin in range(1,rpf_final.GetNbinsY()+1):
-        #         temp_projz = rpf_samples.ProjectionZ('temp_projz',xbin,xbin,ybin,ybin)
-        #         rpf_final.SetBinContent(xbin,ybin,temp_projz.GetMean())
-        #         rpf_final.SetBinError(xbin,ybin,temp_projz.GetRMS())
-
-        # rpf_final.SetTitle('')
-        # rpf_final.GetXaxis().SetTitle(self.xVarTitle)
-        # rpf_final.GetYaxis().SetTitle(self.yVarTitle)
-        # rpf_final.GetZaxis().SetTitle('R_{P/F}' if self.rpfRatio == False else 'R_{Ratio}')
-        # rpf_final.GetXaxis().SetTitleSize(0.045)
-        # rpf_final.GetYaxis().SetTitleSize(0.045)
-        # rpf_final.GetZaxis().SetTitleSize(0.045)
-        # rpf_final.GetXaxis().SetTitleOffset(1.2)
-        # rpf_final.GetYaxis().SetTitleOffset(1.5)
-        # rpf_final.GetZaxis().SetTitleOffset(1.3)
-
-        # rpf_c = TCanvas('rpf_c','Post-fit R_{P/F}',1000,700)
-        # CMS_lumi.lumiTextSize = 0.75
-        # CMS_lumi.cmsTextSize = 0.85
-        # CMS_lumi.extraText = 'Preliminary'
-        # CMS_lumi.CMS_lumi(rpf_c, self.year, 11)
-        # rpf_c.SetRightMargin(0.2)
-        # rpf_final.Draw('colz')
-        # rpf_c.Print(self.projPath+'plots/fit_'+fittag+'/postfit_rpf_colz.pdf','pdf')
-        # rpf_final.Draw('surf')
-        # rpf_c.Print(self.projPath+'plots/fit_'+fittag+'/postfit_rpf_surf.pdf','pdf')
-        # rpf_final.Draw('pe')
-        # rpf_c.Print(self.projPath+'plots/fit_'+fittag+'/postfit_rpf_errs.pdf','pdf')
-
-        # rpf_file = TFile.Open(self.projPath+'/plots/postfit_rpf_fit'+fittag+'.root','RECREATE')
-        # rpf_file.cd()
-        # rpf_final.Write()
-        # rpf_file.Close()
+                    pads.append({'pad':out_pad_name,'process':process,'region':region,'proj':projn,'slice':islice})
+
+            pads = pandas.DataFrame(pads, columns=['pad','process','region','proj','slice'])
+            for process, padgroup in pads.groupby('process'):
+                cans.append(('{d}/{p}_{proj}'.format(d=self.dir, p=process,proj=proj),)+_region_slice_grid(padgroup))
+
+        self._render(specs, cans)
+
+    def _render(self, specs, cans):
+        '''Draw the pads described by `specs` (see _pad_spec()) in `self.nCores` processes
+        and then combine them into the canvases `cans` with make_can(). The images of the pads
+        are passed to make_can() in memory so the pads are only saved to disk if requested
+        (see the `plotPadPDFs` and `plotPadPNGs` options).
+
+        Args:
+            specs (list(dict)): Pads to draw.
+            cans (list(tuple(str, list(str), int, int))): Output name, list of pad output names,
+                and number of pads across and down (see make_can()) of each canvas.
+        '''
+        in_cans = set(itertools.chain.from_iterable(can[1] for can in cans))
+        for spec in specs:
+            spec['image'] = spec['outname'] in in_cans
+
+        images = render_pads(specs, self.root_out.GetName(), self.nCores, self.hists)
+        images = {spec['outname']: image for spec, image in zip(specs, images)}
+        for outname, padnames, padx, pady in cans:
+            make_can(outname, [None if p == None else images[p] for p in padnames], padx, pady)
+
+    def plot_transfer_funcs(self, tfs, nsamples=1000, seed=12345):
+        '''Plot the post-fit transfer functions with their uncertainty. The parameters
+        of each function are sampled `nsamples` times from the fit result covariance
+        (parameters not floated in the fit are held at their current values) and the functions
+        are evaluated for all samples at once with NumPy (see `alphawrap.transfer_func_bands`).
+        The per-bin mean and RMS are plotted side by side.
+
+        Args:
+            tfs (list(dict)): Transfer functions to plot with their name, formula, forcePositive,
+                parameter names (`params`) and nominal values (`nominal`), and Binning (`binning`)
+                (see TwoDAlphabet._transferFuncs()). Parameters not floated in the fit are held at
+                their nominal values.
+            nsamples (int, optional): Number of parameter samples. Defaults to 1000.
+            seed (int, optional): Random seed for the sampling. Defaults to 12345.
+
+        Returns:
+            None
+        '''
+        fit_result_file = ROOT.TFile.Open('fitDiagnosticsTest.root')
+        if self.fittag not in _get_good_fit_results(fit_result_file):
+            fit_result_file.Close()
+            return
+
+        fit_result = fit_result_file.Get('fit_'+self.fittag)
+        final_pars = ROOT.RooArgList(fit_result.floatParsFinal())
+        cov = fit_result.covarianceMatrix()
+        fit_idx = {final_pars.at(i).GetName():i for i in range(final_pars.getSize())}
+        rng = numpy.random.RandomState(seed)
+
+        for tf in tfs:
+            names = tf['params']
+            central = numpy.array([final_pars.at(fit_idx[n]).getValV() if n in fit_idx else tf['nominal'][i] for i,n in enumerate(names)])
+            tf_cov = numpy.zeros((len(names),len(names)))
+            for (i,ni),(j,nj) in itertools.product(enumerate(names),enumerate(names)):
+                if ni in fit_idx and nj in fit_idx:
+                    tf_cov[i][j] = cov[fit_idx[ni]][fit_idx[nj]]
+
+            samples = rng.multivariate_normal(central, tf_cov, nsamples)
+            mean, rms = transfer_func_bands(tf['formula'], tf['binning'], samples, tf['forcePositive'])
+
+            pads = []
+            for label, vals in [('mean',mean), ('rms',rms)]:
+                h = tf['binning'].CreateHist('%s_postfit_%s'%(tf['name'],label))
+                content = numpy.zeros((vals.shape[0]+2, vals.shape[1]+2))
+                content[1:-1,1:-1] = vals
+                set_hist_arrays(h, content, numpy.zeros(content.shape))
+                h.GetZaxis().SetTitle('Transfer function %s'%label)
+                out_pad_name = '{d}/base_figs/{n}_{l}'.format(d=self.dir, n=tf['name'], l=label)
+                pad = make_pad_2D(out_pad_name, h, year=self.twoD.options.year, savePDF=self.twoD.options.plotPadPDFs, savePNG=self.twoD.options.plotPadPNGs, extraText='Work In Progress')
+                pads.append(pad_image(pad))
+                pad.Close()
+
+            make_can('{d}/{n}_postfit'.format(d=self.dir, n=tf['name']), pads)
+
+        fit_result_file.Close()
 
 def _save_pad_generic(outname, pad, ROOTout, savePDF, savePNG):
     if isinstance(ROOTout, ROOT.TFile):
@@ -488,6 +650,149 @@ def _save_pad_generic(outname, pad, ROOTout, savePDF, savePNG):
     if savePNG:
         pad.Print(outname+'.png','png')
 
+def _fingerprint(info):
+    '''SHA1 of JSON serializable information.'''
+    return hashlib.sha1(json.dumps(info, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _hists_fingerprint(hists):
+    '''SHA1 of the bin contents and errors of a list of histograms.'''
+    h = hashlib.sha1()
+    for hist in hists:
+        for arr in get_hist_arrays(hist):
+            h.update(numpy.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+def _pair_key(process, region):
+    return '%s/%s'%(process, region)
+
+def _plan_plot_update(old, new, pairs):
+    '''Decide how to bring the Plotter output up to date by comparing fingerprints (see Plotter._make()).
+
+    Args:
+        old (dict): Previous fingerprints (or None if there are none).
+        new (dict): Current fingerprints.
+        pairs (list(str)): Keys of the current process-region pairs, in order.
+
+    Returns:
+        tuple: Mode ('rebuild', 'update', or 'load'), keys of the pairs to remake, and keys
+            of the pairs to remove.
+    '''
+    if old == None or old['settings'] != new['settings']:
+        return 'rebuild', list(pairs), []
+
+    changed = [k for k in pairs if old['inputs'].get(k) != new['inputs'][k] or old['styles'].get(k) != new['styles'][k]]
+    removed = [k for k in old['inputs'] if k not in new['inputs']]
+    if len(changed) == 0 and len(removed) == 0:
+        return 'load', [], []
+    return 'update', changed, removed
+
+def _hist_1D_from_arrays(name, bins, content, errors):
+    '''Make a TH1D with bin edges `bins` and the contents and errors (with underflow and overflow) in the arrays.'''
+    h = ROOT.TH1D(name, name, len(bins)-1, array.array('d',bins))
+    h.Sumw2()
+    set_hist_arrays(h, content, errors)
+    return h
+
+def _hist_name(row, hist_type):
+    return '_'.join([row.process,row.region,hist_type])
+
+def _pad_spec(kind, outname, hists, styles={}, **kwargs):
+    '''Description of a pad for render_pads() that can be sent to other processes.
+
+    Args:
+        kind (str): "1D" for make_pad_1D() or "2D" for make_pad_2D().
+        outname (str): Output file path name.
+        hists (dict): Names of the histograms in all_plots.root for each histogram argument of the pad function
+            (ex. {'data': ..., 'bkgs': [...], 'signals': [...], 'totalBkg': ...} or {'hist': ...}).
+        styles (dict, optional): Map of histogram name to a list of (method, argument) to call on it before drawing. Defaults to {}.
+        **kwargs: Other arguments to the pad function.
+
+    Returns:
+        dict
+    '''
+    return {'kind': kind, 'outname': outname, 'hists': hists, 'styles': styles, 'kwargs': kwargs}
+
+def _render_pad(spec, getter):
+    '''Draw one pad from its spec (see _pad_spec()). Each histogram is a fresh copy from `getter`
+    (the same copy if the name is used more than once) so that drawing never depends on earlier pads.
+    Returns the image of the pad (see pad_image()) if `spec['image']` is True and None otherwise.'''
+    copies = {}
+    def _get(name):
+        if name not in copies:
+            copies[name] = getter(name).Clone(name)
+            copies[name].SetDirectory(0)
+            for method, arg in spec['styles'].get(name, []):
+                getattr(copies[name], method)(arg)
+        return copies[name]
+
+    args = {}
+    for arg, names in spec['hists'].items():
+        args[arg] = [_get(n) for n in names] if isinstance(names, list) else _get(names)
+    args.update(spec['kwargs'])
+
+    pad_func = make_pad_1D if spec['kind'] == '1D' else make_pad_2D
+    pad = pad_func(spec['outname'], **args)
+    image = pad_image(pad) if spec.get('image', False) else None
+    pad.Close()
+    return image
+
+# Histograms of all_plots.root in each worker process of render_pads()
+_render_hists = None
+
+def _init_render_worker(filename, maxMB):
+    global _render_hists
+    ROOT.gROOT.SetBatch(True)
+    _render_hists = HistCache(ROOT.TFile.Open(filename), maxMB)
+
+def _render_worker(spec):
+    return _render_pad(spec, _render_hists.Get)
+
+def render_pads(specs, filename, nCores=1, hists=None):
+    '''Draw the pads described by `specs` (see _pad_spec()) with the histograms from `filename`.
+    With `nCores` > 1, the pads are split over a pool of processes in batch mode that each
+    open `filename` (read-only) once. The output is the same for any `nCores`.
+    The images of the pads with `spec['image']` set to True are returned (see pad_image())
+    so that they can be combined with make_can() without reading them back from disk.
+
+    Args:
+        specs (list(dict)): Pads to draw.
+        filename (str): ROOT file with the histograms (ex. all_plots.root).
+        nCores (int, optional): Number of processes. Defaults to 1.
+        hists (HistCache, optional): Cache of `filename` to use when drawing in this process
+            (its memory cap is also used in the workers). Defaults to None in which case a new one is made.
+
+    Returns:
+        list(numpy.ndarray): Image of each pad (or None if not requested), in the order of `specs`.
+    '''
+    maxMB = 500 if hists == None else hists.maxBytes/1024.0/1024.0
+    if nCores > 1 and len(specs) > 1:
+        pool = multiprocessing.Pool(min(nCores,len(specs)), _init_render_worker, (filename, maxMB))
+        try:
+            images = pool.map(_render_worker, specs, chunksize=max(1, len(specs)//(4*nCores)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        if hists == None:
+            hists = HistCache(ROOT.TFile.Open(filename), maxMB)
+        images = [_render_pad(spec, hists.Get) for spec in specs]
+    return images
+
+def pad_image(pad):
+    '''Rasterize a drawn pad in memory (the same image as `pad.Print(<name>.png)`).
+
+    Args:
+        pad (TPad): Pad.
+
+    Returns:
+        numpy.ndarray: RGB pixels of the pad, shaped (height, width, 3).
+    '''
+    img = ROOT.TImage.Create()
+    img.FromPad(pad)
+    w, h = img.GetWidth(), img.GetHeight()
+    argb = _buffer_to_numpy(img.GetArgbArray(), w*h, 'u4').reshape(h, w)
+    return numpy.dstack([(argb >> shift) & 0xff for shift in (16, 8, 0)]).astype('uint8')
+
 def _make_pad_gen(name):
     tdrstyle.setTDRStyle()
     ROOT.gStyle.SetLegendFont(42)
@@ -766,18 +1071,16 @@ def make_pad_1D(outname, data, bkgs=[], signals=[], title='', subtitle='',
     return pad
 
 def make_can(outname, padnames, padx=0, pady=0):
-    '''Combine multiple pads/canvases into one canvas for convenience of viewing.
+    '''Combine multiple pads/canvases into one canvas (saved as `outname`.pdf) for convenience of viewing.
     Input pad order matters.
 
     Args:
         outname (str): Output file path name.
-        pads ([TCanvas,TPad]): List of canvases/pads to plot together on one canvas.
-        saveROOT (bool, optional): Save to master ROOT file. Defaults to False.
-        savePDF (bool, optional): Save to PDF. Defaults to True.
-        savePNG (bool, optional): Save to PNG. Defaults to True.
-
-    Raises:
-        RuntimeError: If 10 or more subdivisions are requested.
+        padnames (list): Images of the pads to plot together on one canvas. Each is either
+            the pixels from pad_image(), the path of an image file, or None to leave the space blank.
+        padx (int, optional): Number of pads across. Defaults to 0 in which case up to three pads
+            are put in one row and more are arranged in a near-square grid.
+        pady (int, optional): Number of pads down. Defaults to 0 (see `padx`).
 
     Returns:
         None
@@ -785,59 +1088,37 @@ def make_can(outname, padnames, padx=0, pady=0):
     
 
     if padx == 0 or pady == 0:
-        if len(padnames) == 1:
-            padx = 1; pady = 1
-        elif len(padnames) == 2:
-            padx = 2; pady = 1
-        elif len(padnames) == 3:
-            padx = 3; pady = 1
-        elif len(padnames) == 4:
-            padx = 2; pady = 2
-        elif len(padnames) <= 6:
-            padx = 3; pady = 2
-        elif len(padnames) <= 9:
-            padx = 3; pady = 3
-        elif len(padnames) <= 12:
-            padx = 4; pady = 3
-        elif len(padnames) <= 16:
-            padx = 4; pady = 4
-        elif len(padnames) > 30:
-            padx = 6; pady = 6
-        elif len(padnames) > 36:
-            padx = 7; pady = 7
-        elif len(padnames) > 49:
-            padx = 8; pady = 8
-        elif len(padnames) > 64:
-            padx = 10; pady = 10
-        else:
-            raise RuntimeError('histlist of size %s not currently supported: %s'%(len(padnames),[p.GetName() for p in padnames]))
+        padx = len(padnames) if len(padnames) <= 3 else int(math.ceil(math.sqrt(len(padnames))))
+        pady = int(math.ceil(float(len(padnames))/padx))
 
-    pads = [Image.open(os.path.abspath(pname)) for pname in padnames]
-    w, h = pads[0].size
-    grid = Image.new('RGB', size=(padx*w, pady*h))
+    pads = [None if p is None else Image.fromarray(p, 'RGB') if isinstance(p, numpy.ndarray) else Image.open(os.path.abspath(p)) for p in padnames]
+    w, h = [pad for pad in pads if pad is not None][0].size
+    grid = Image.new('RGB', size=(padx*w, pady*h), color='white')
     
     for i, pad in enumerate(pads):
-        grid.paste(pad, box=(i%padx*w, i//padx*h))
+        if pad is not None:
+            grid.paste(pad, box=(i%padx*w, i//padx*h))
     
     print ('Writing grid of images %s.pdf'%outname)
     grid.save(outname+'.pdf')
 
-def _get_start_stop(i,slice_idxs):
-    start = slice_idxs[i]+1
-    stop  = slice_idxs[i+1]
-    return start, stop
-
-def gen_projections(ledger, twoD, fittag, loadExisting=False, prefit=False):
+def gen_projections(ledger, twoD, fittag, loadExisting=False, prefit=False, tfs=[], nCores=None, sliceEdges={}, rebuild=False):
     '''
     Optional Args:
 	loadExisting (bool): Flag to load existing projections instead of remaking everything. Defaults to False.
 	prefit	     (bool): Flag to plot prefit distributions instead of postfit. Defaults to False.
+	tfs	     (list): Transfer functions to plot with Plotter.plot_transfer_funcs() (see TwoDAlphabet._transferFuncs()). Defaults to [] (none).
+	nCores	     (int): Number of processes to draw the pads with. Defaults to None (the `nCores` option).
+	sliceEdges   (dict): Slice edges for the "x" and/or "y" axes instead of the defaults (see Plotter). Defaults to {}.
+	rebuild      (bool): Remake all projections even if their inputs did not change. Defaults to False.
     '''
-    plotter = Plotter(ledger, twoD, fittag, loadExisting)
+    plotter = Plotter(ledger, twoD, fittag, loadExisting, nCores, sliceEdges, rebuild)
     plotter.plot_2D_distributions()
     plotter.plot_projections(prefit)
     plotter.plot_pre_vs_post()
-    # plotter.plot_transfer_funcs()
+    if len(tfs) > 0:
+        plotter.plot_transfer_funcs(tfs)
+    print ('Histogram cache (this process): %s'%plotter.hists.Stats())
 
 def make_systematic_plots(twoD):
     '''Make plots of the systematic shape variations of each process based on those
@@ -966,7 +1247,13 @@ def save_post_fit_parametric_vals():
 
     fit_result_file.Close()
 
-def gen_post_fit_shapes():
+def gen_post_fit_shapes(force=False):
+    '''Make postfitshapes_<b/s>.root with PostFit2DShapesFromWorkspace for each good fit.
+    Outputs which are newer than the fit result and the workspace are kept.
+
+    Args:
+        force (bool, optional): Remake the outputs even if they are up to date. Defaults to False.
+    '''
     fit_result_file = ROOT.TFile.Open('fitDiagnosticsTest.root')
     goodFitTags = _get_good_fit_results(fit_result_file)
     for t in goodFitTags:
@@ -974,6 +1261,11 @@ def gen_post_fit_shapes():
             workspace_file = 'higgsCombineTest.FitDiagnostics.mH120.root'
         else:
             workspace_file = 'higgsCombineTest.FitDiagnostics.mH120.123456.root'
+        shapes_file = 'postfitshapes_%s.root'%t
+        if not force and os.path.exists(shapes_file) and os.path.exists(workspace_file) and \
+           os.path.getmtime(shapes_file) > max(os.path.getmtime(f) for f in ['fitDiagnosticsTest.root',workspace_file]):
+            print ('%s is up to date. Not remaking it.'%shapes_file)
+            continue
         shapes_cmd = 'PostFit2DShapesFromWorkspace -w {w} -o postfitshapes_{t}.root -f fitDiagnosticsTest.root:fit_{t} --postfit --samples 100 --print 2> PostFitShapes2D_stderr_{t}.txt'.format(t=t,w=workspace_file)
         execute_cmd(shapes_cmd)
     fit_result_file.Close()
@@ -1046,59 +1338,54 @@ def plot_correlation_matrix(varsToIgnore, threshold=0, corrText=False):
 
     fit_result_file.Close()
 
+def _hist_from_values(name, values, nbins=100, lo=None, hi=None):
+    '''Fill a TH1F with an array of values (ex. toy test statistics). Without `lo` and `hi`,
+    the range is the range of the values (like TTree::Draw).'''
+    values = numpy.asarray(values, dtype='float64')
+    values = values[numpy.isfinite(values)]
+    if lo == None: lo = values.min() if len(values) else 0
+    if hi == None: hi = values.max() if len(values) else 1
+    if hi <= lo: hi = lo+1
+    h = ROOT.TH1F(name, name, nbins, lo, hi)
+    h.Sumw2()
+    if len(values) > 0:
+        h.FillN(len(values), values, numpy.ones(len(values)))
+    return h
+
 def plot_gof(tag, subtag, seed=123456, condor=False):
     with cd(tag+'/'+subtag):
         if condor:
-            tmpdir = 'notneeded/tmp/'
-            execute_cmd('mkdir '+tmpdir) 
-            execute_cmd('cat %s_%s_gof_toys_output_*.tgz | tar zxvf - -i --strip-components 2 -C %s'%(tag,subtag,tmpdir))
-            toy_limit_tree = ROOT.TChain('limit')
-            if len(glob.glob(tmpdir+'higgsCombine_gof_toys.GoodnessOfFit.mH120.*.root')) == 0:
-                raise Exception('No files found')
-            toy_limit_tree.Add(tmpdir+'higgsCombine_gof_toys.GoodnessOfFit.mH120.*.root') 
-            
+            # Read the toys straight from the condor output tarballs (only new/changed ones since the last call)
+            harvester = ToyHarvester('gof_toys_harvest.json', 'limit', ['limit'], 'higgsCombine_gof_toys.GoodnessOfFit.mH120.*.root')
+            toy_limits = harvester.Update('%s_%s_gof_toys_output_*.tgz'%(tag,subtag)).Values()
         else:
-            toyOutput = ROOT.TFile.Open('higgsCombine_gof_toys.GoodnessOfFit.mH120.{seed}.root'.format(seed=seed))
-            toy_limit_tree = toyOutput.Get('limit')
+            toy_limits = numpy.array(read_tree_branches('higgsCombine_gof_toys.GoodnessOfFit.mH120.{seed}.root'.format(seed=seed), 'limit', ['limit'])['limit'])
+        toy_limits = toy_limits[numpy.isfinite(toy_limits)]
+        if len(toy_limits) == 0:
+            raise Exception('No files found')
 
         # Now to analyze the output
         # Get observation
         ROOT.gROOT.SetBatch(True)
         ROOT.gStyle.SetOptStat(False)
-        gof_data_file = ROOT.TFile.Open('higgsCombine_gof_data.GoodnessOfFit.mH120.root')
-#         gof_data_file = ROOT.TFile.Open('higgsCombine_gof_toys.GoodnessOfFit.mH120.123456.root')
-        gof_limit_tree = gof_data_file.Get('limit')
-        gof_limit_tree.GetEntry(0)
-        gof_data = gof_limit_tree.limit
-
-        # Get toys
-        toy_limit_tree.Draw('limit>>hlimit','limit>1.0 && limit<%s && limit != %s'%(gof_data*2.0,gof_data)) 
-        htoy_gof = ROOT.gDirectory.Get('hlimit')
-        time.sleep(1) # if you don't sleep the code moves too fast and won't perform the fit
-        htoy_gof.Fit("gaus")
-
-        # Fit toys and derive p-value
-        gaus = htoy_gof.GetFunction("gaus")
-        pvalue = 1-(1/gaus.Integral(-float("inf"),float("inf")))*gaus.Integral(-float("inf"),gof_data)
+        gof_data = read_tree_branches('higgsCombine_gof_data.GoodnessOfFit.mH120.root', 'limit', ['limit'])['limit'][0]
+
+        # p-value is the fraction of toys at least as extreme as data (no assumption on the shape of the distribution)
+        pvalue, pvalue_err = empirical_pvalue(toy_limits, gof_data, seed=seed)
 
         # Write out for reference
         with open('gof_results.txt','w') as out:
-            out.write('Test statistic in data = '+str(gof_data))
-            out.write('Mean from toys = '+str(gaus.GetParameter(1)))
-            out.write('Width from toys = '+str(gaus.GetParameter(2)))
-            out.write('p-value = '+str(pvalue))
-
-        # Extend the axis if needed
-        if htoy_gof.GetXaxis().GetXmax() < gof_data:
-            print ('Axis limit greater than GOF p value')
-            binwidth = htoy_gof.GetXaxis().GetBinWidth(1)
-            xmin = htoy_gof.GetXaxis().GetXmin()
-            new_xmax = int(gof_data*1.1)
-            new_nbins = int((new_xmax-xmin)/binwidth)
-            toy_limit_tree.Draw('limit>>hlimitrebin('+str(new_nbins)+', '+str(xmin)+', '+str(new_xmax)+')','limit>0.001 && limit<1500') 
-            htoy_gof = ROOT.gDirectory.Get('hlimitrebin')
-            htoy_gof.Fit("gaus")
-            gaus = htoy_gof.GetFunction("gaus")
+            out.write('Test statistic in data = %s\n'%gof_data)
+            out.write('Number of toys = %s\n'%len(toy_limits))
+            out.write('Mean from toys = %s\n'%toy_limits.mean())
+            out.write('Width from toys = %s\n'%toy_limits.std())
+            out.write('p-value = %s +/- %s\n'%(pvalue, pvalue_err))
+
+        # Range covers the bulk of the toys and the observation
+        xmin = min(numpy.quantile(toy_limits, 0.001), gof_data)
+        xmax = max(numpy.quantile(toy_limits, 0.999), gof_data)
+        margin = 0.05*(xmax-xmin)
+        htoy_gof = _hist_from_values('hlimit', toy_limits, 100, xmin-margin, xmax+margin)
 
         # Arrow for observed
         arrow = ROOT.TArrow(gof_data,0.25*htoy_gof.GetMaximum(),gof_data,0)
@@ -1110,9 +1397,9 @@ def plot_gof(tag, subtag, seed=123456, condor=False):
         leg.SetLineWidth(0)
         leg.SetFillStyle(0)
         leg.SetTextFont(42)
-        leg.AddEntry(htoy_gof,"toy data","lep")
+        leg.AddEntry(htoy_gof,"toy data (%s)"%len(toy_limits),"lep")
         leg.AddEntry(arrow,"observed = %.1f"%gof_data,"l")
-        leg.AddEntry(0,"p-value = %.2f"%(pvalue),"")
+        leg.AddEntry(0,"p-value = %.3f #pm %.3f"%(pvalue,pvalue_err),"")
 
         # Draw
         cout = ROOT.TCanvas('cout','cout',800,700)
@@ -1125,24 +1412,20 @@ def plot_gof(tag, subtag, seed=123456, condor=False):
         cout.Print('gof_plot.pdf','pdf')
         cout.Print('gof_plot.png','png')
 
-	if condor:
-            execute_cmd('rm -r '+tmpdir)
-
 def plot_signalInjection(tag, subtag, injectedAmount, seed=123456, stats=True, condor=False):
     # if injectedAmount is not an integer, need to look for different file
     # see: https://github.com/lcorcodilos/2DAlphabet/blob/e089ed1da63172770726b3e6f406c11e611e057d/TwoDAlphabet/twoDalphabet.py#L488
     injectedName = str(injectedAmount).replace('.','p')
     with cd(tag+'/'+subtag):
+        branches = ['r','rHiErr','rLoErr','fit_status']
         if condor:
-            tmpdir = 'notneeded/tmp/'
-            execute_cmd('mkdir '+tmpdir) 
-            execute_cmd('cat %s_%s_sigInj_r%s_output_*.tgz | tar zxvf - -i --strip-components 2 -C %s'%(tag,subtag,injectedName,tmpdir))
-            tree_fit_sb = ROOT.TChain('tree_fit_sb')
-            tree_fit_sb.Add(tmpdir+'fitDiagnostics_sigInj_r{rinj}*.root'.format(rinj=injectedName)) 
-            
+            # Read the fits straight from the condor output tarballs (only new/changed ones since the last call)
+            harvester = ToyHarvester('sigInj_r%s_harvest.json'%injectedName, 'tree_fit_sb', branches, 'fitDiagnostics_sigInj_r%s*.root'%injectedName)
+            harvester.Update('%s_%s_sigInj_r%s_output_*.tgz'%(tag,subtag,injectedName))
+            fits = {b:harvester.Values(b) for b in branches}
         else:
-            toyOutput = ROOT.TFile.Open('fitDiagnostics_sigInj_r{rinj}_{seed}.root'.format(rinj=injectedName,seed=seed))
-            tree_fit_sb = toyOutput.Get('tree_fit_sb')
+            fits = read_tree_branches('fitDiagnostics_sigInj_r{rinj}_{seed}.root'.format(rinj=injectedName,seed=seed), 'tree_fit_sb', branches)
+        pulls, biases = injection_pulls(fits, injectedAmount)
 
         ROOT.gROOT.SetBatch(True)
         if stats:
@@ -1152,10 +1435,8 @@ def plot_signalInjection(tag, subtag, injectedAmount, seed=123456, stats=True, c
         # Final plotting
         result_can = ROOT.TCanvas('sigpull_can','sigpull_can',800,700)
 
-        tree_fit_sb.Draw("(r-{rinj})/(rHiErr*(r<{rinj})+rLoErr*(r>{rinj}))>>sigpull(20,-5,5)".format(rinj=injectedAmount),"fit_status>=0")
-        hsigpull = ROOT.gDirectory.Get('sigpull')
-        tree_fit_sb.Draw("(r-{rinj})>>sigstrength(20,-1,1)".format(rinj=injectedAmount),"fit_status>=0")
-        hsignstrength = ROOT.gDirectory.Get('sigstrength')
+        hsigpull = _hist_from_values('sigpull', pulls, 20, -5, 5)
+        hsignstrength = _hist_from_values('sigstrength', biases, 20, -1, 1)
 
         hsigpull.Fit("gaus","L")
         hsigpull.SetTitle('')
@@ -1171,6 +1452,3 @@ def plot_signalInjection(tag, subtag, injectedAmount, seed=123456, stats=True, c
         hsignstrength.Draw('pe')
         print tag+'/'+subtag+'signalInjection_r%s.png'%(str(injectedAmount).replace('.','p')),'png'
         result_can.Print('signalInjection_r%s.png'%(str(injectedAmount).replace('.','p')),'png')
-
-	if condor:
-            execute_cmd('rm -r '+tmpdir)
@@ -0,0 +1,427 @@
+import ROOT, math, multiprocessing
+from array import array
+
+_gof_columns = ['limit','quantileExpected','iToy','iSeed']
+# Lower bound of the expected events in a bin for the saturated test statistic (like combine)
+_min_expected = 1e-9
+_fit_columns = ['r','rErr','rHiErr','rLoErr','fit_status','iToy','iSeed']
+
+class ToyEngine(object):
+    '''Generate and fit toys in this process from a workspace made by text2workspace.py
+    (the model and data from its ModelConfig). The workspace is loaded once and the same
+    NLL and minimizer are reused for every toy. Each fit starts from the minimum
+    of the previous toy and is only retried from the generation point if it fails.
+
+    Toys are generated like combine's `--toysFrequentist`: the nuisance parameters
+    are set to the generation point (see SetGenerationPoint()), the global observables
+    are generated from the product of the constraint terms at that point (see _constraintPdf()),
+    and the binned data is generated from the model.
+
+    NOTE: The channel masks made by `--channel-masks` are a feature of combine's own NLL
+    and are ignored here (all channels are generated and fit).
+
+    Args:
+        workspaceFile (str): Workspace file name and path.
+        snapshot (str, optional): Snapshot to load from the workspace. Defaults to None.
+        poi (str, optional): Parameter of interest. Defaults to 'r'.
+        rRange (tuple(float), optional): Range of the POI. Defaults to (-5,5).
+        setParams (dict, optional): Parameter values to set. Defaults to {}.
+        freezeParams (list(str), optional): Parameters to freeze. Defaults to [].
+        strategy (int, optional): Minuit strategy. Defaults to 0.
+    '''
+    def __init__(self, workspaceFile, snapshot=None, poi='r', rRange=(-5,5), setParams={}, freezeParams=[], strategy=0):
+        ROOT.gSystem.Load('libHiggsAnalysisCombinedLimit')
+        self._file = ROOT.TFile.Open(workspaceFile)
+        if not self._file or self._file.IsZombie():
+            raise IOError('Cannot open %s.'%workspaceFile)
+        self.w = self._file.Get('w')
+        if snapshot != None:
+            self.w.loadSnapshot(snapshot)
+
+        mc = self.w.genobj('ModelConfig')
+        self.pdf = mc.GetPdf()
+        self.obs = mc.GetObservables()
+        self.nuis = mc.GetNuisanceParameters()
+        self.globs = mc.GetGlobalObservables()
+        self.data = self.w.data('data_obs')
+        self.poi = self.w.var(poi)
+        self.poi.setRange(rRange[0], rRange[1])
+        for p,v in setParams.items():
+            self.w.var(p).setVal(v)
+        for p in freezeParams:
+            self.w.var(p).setConstant(True)
+        self.strategy = strategy
+
+        self.constraintPdf = self._constraintPdf(mc) if self.globs and self.globs.getSize() > 0 else None
+
+        self.params = self.pdf.getParameters(self.obs)
+        self.floating = ROOT.RooArgSet()
+        for p in _iter_args(self.params):
+            if not p.isConstant() and (not self.globs or not self.globs.find(p.GetName())):
+                self.floating.add(p)
+
+        self._genPoint = self.params.snapshot()
+        self._lastMin = None
+        self._nll = None
+        self._minimizer = None
+        self._fitData = None
+        self._channels = self._channelBins()
+
+    def _constraintPdf(self, mc):
+        '''Product of the constraint terms of the model (the pdfs of the global observables).
+        Uses combine's utils::makeNuisancePdf() if it is loaded and otherwise collects the
+        terms which do not depend on the observables with RooAbsPdf::getAllConstraints().'''
+        try:
+            return ROOT.utils.makeNuisancePdf(mc)
+        except AttributeError:
+            self._constraints = self.pdf.getAllConstraints(self.obs, ROOT.RooArgSet(self.nuis), False)
+            return ROOT.RooProdPdf('nuisancePdf', 'nuisancePdf', ROOT.RooArgList(self._constraints))
+
+    def SetGenerationPoint(self, fitData=True, rGen=None):
+        '''Set the parameter values to generate toys from.
+
+        Args:
+            fitData (bool, optional): Fit the data first (like `--toysFrequentist`) instead of
+                using the pre-fit values (like `--bypassFrequentistFit`). Defaults to True.
+            rGen (float, optional): Value of the POI to generate with (like `--expectSignal`).
+                Defaults to None in which case the POI is not changed.
+        '''
+        if fitData:
+            self.Fit(self.data)
+        if rGen != None:
+            self.poi.setVal(rGen)
+        self._genPoint = self.params.snapshot()
+
+    def Generate(self):
+        '''Returns:
+            RooDataSet: Binned toy data. The global observables are left at their generated values.'''
+        self.params.assignValueOnly(self._genPoint)
+        if self.constraintPdf != None:
+            gen_globs = self.constraintPdf.generate(self.globs, 1)
+            self.globs.assignValueOnly(gen_globs.get(0))
+        toy = self.pdf.generate(self.obs, ROOT.RooFit.Extended(), ROOT.RooFit.AllBinned())
+        # Warm start the next fit
+        if self._lastMin != None:
+            self.floating.assignValueOnly(self._lastMin)
+        return toy
+
+    def Fit(self, data, minos=False):
+        '''Fit `data`, reusing the NLL and minimizer from the previous fit.
+
+        Args:
+            data (RooAbsData): Data to fit.
+            minos (bool, optional): Run MINOS on the POI. Defaults to False (HESSE only).
+
+        Returns:
+            int: Minimizer status (0 if successful).
+        '''
+        self._setData(data)
+        status = self._minimizer.minimize('Minuit2','Migrad')
+        if status != 0: # retry from the generation point
+            self.floating.assignValueOnly(self._genPoint)
+            status = self._minimizer.minimize('Minuit2','Migrad')
+        if status == 0:
+            self._lastMin = self.floating.snapshot()
+            self._minimizer.hesse()
+            if minos and not self.poi.isConstant():
+                self._minimizer.minos(ROOT.RooArgSet(self.poi))
+        return status
+
+    def _setData(self, data):
+        self._fitData = data # the NLL does not own its data
+        if self._nll != None and self._nll.setData(data, False):
+            return
+        args = [ROOT.RooFit.Extended(True), ROOT.RooFit.Constrain(self.nuis)]
+        if self.globs:
+            args.append(ROOT.RooFit.GlobalObservables(self.globs))
+        self._nll = self.pdf.createNLL(data, *args)
+        self._minimizer = ROOT.RooMinimizer(self._nll)
+        self._minimizer.setPrintLevel(-1)
+        self._minimizer.setStrategy(self.strategy)
+
+    def _channelBins(self):
+        '''Bins of each channel as a list of (category cut, channel pdf, channel observables, template RooDataHist).'''
+        if not isinstance(self.pdf, ROOT.RooSimultaneous):
+            return [(None, self.pdf, self.obs, ROOT.RooDataHist('bins','bins',self.obs))]
+
+        cat = self.pdf.indexCat()
+        out = []
+        for label in _category_labels(cat):
+            chan_pdf = self.pdf.getPdf(label)
+            chan_obs = chan_pdf.getObservables(self.obs)
+            chan_obs.remove(cat, True, True)
+            cut = '%s==%s::%s'%(cat.GetName(), cat.GetName(), label)
+            out.append((cut, chan_pdf, chan_obs, ROOT.RooDataHist('bins_'+label,'bins_'+label,chan_obs)))
+        return out
+
+    def Saturated(self, data):
+        '''Saturated test statistic of `data` at the current parameter values (ex. after Fit()),
+        2*sum(nu - n + n*ln(n/nu)) over all bins of all channels where nu is the expected and n
+        the observed number of events. This is the Poisson part of combine's saturated test statistic
+        so the data and the toys should both be evaluated here for a p-value. Expected values
+        are floored at a small positive number so that bins fit to zero (or below) stay finite.
+
+        Returns:
+            float
+        '''
+        q = 0
+        for cut, chan_pdf, chan_obs, template in self._channels:
+            chan_data = data if cut == None else data.reduce(ROOT.RooFit.Cut(cut))
+            observed = ROOT.RooDataHist('observed','observed',chan_obs,chan_data)
+            nexp = chan_pdf.expectedEvents(chan_obs)
+            for i in range(template.numEntries()):
+                coords = template.get(i)
+                volume = template.binVolume()
+                observed.get(i)
+                n = observed.weight()
+                chan_obs.assignValueOnly(coords)
+                nu = max(_min_expected, nexp*chan_pdf.getVal(chan_obs)*volume)
+                q += nu - n
+                if n > 0:
+                    q += n*math.log(n/nu)
+        return 2*q
+
+def _iter_tobjects(it):
+    obj = it.Next()
+    while obj:
+        yield obj
+        obj = it.Next()
+
+def _iter_args(argset):
+    return _iter_tobjects(argset.createIterator())
+
+def _category_labels(cat):
+    if hasattr(cat, 'typeIterator'): # ROOT < 6.22
+        return [t.GetName() for t in _iter_tobjects(cat.typeIterator())]
+    return [state.first for state in cat]
+
+def _split_toys(ntoys, njobs, seed):
+    '''Split `ntoys` into at most `njobs` chunks with unique seeds (`seed`, `seed`+1, ...).
+
+    Returns:
+        list(tuple(int,int)): Number of toys and seed of each chunk.
+    '''
+    njobs = max(1, min(njobs, ntoys))
+    sizes = [ntoys//njobs + (1 if i < ntoys%njobs else 0) for i in range(njobs)]
+    return [(n, seed+i) for i,n in enumerate(sizes) if n > 0]
+
+def _startBatch(engine, seed):
+    '''Seed the generator and forget the warm start of the previous batch so that the
+    results of a batch only depend on its seed (not on which worker ran the batch before).'''
+    ROOT.RooRandom.randomGenerator().SetSeed(seed)
+    engine._lastMin = None
+
+def _gofToys(engine, ntoys, seed):
+    _startBatch(engine, seed)
+    out = {c:[] for c in _gof_columns}
+    for itoy in range(ntoys):
+        toy = engine.Generate()
+        status = engine.Fit(toy)
+        out['limit'].append(engine.Saturated(toy) if status == 0 else float('nan'))
+        out['quantileExpected'].append(-1)
+        out['iToy'].append(itoy+1)
+        out['iSeed'].append(seed)
+    return out
+
+def _fitToys(engine, ntoys, seed):
+    _startBatch(engine, seed)
+    out = {c:[] for c in _fit_columns}
+    for itoy in range(ntoys):
+        toy = engine.Generate()
+        status = engine.Fit(toy, minos=True)
+        out['r'].append(engine.poi.getVal())
+        out['rErr'].append(engine.poi.getError())
+        out['rHiErr'].append(engine.poi.getErrorHi() if engine.poi.hasAsymError() else engine.poi.getError())
+        out['rLoErr'].append(-engine.poi.getErrorLo() if engine.poi.hasAsymError() else engine.poi.getError())
+        out['fit_status'].append(status if status == 0 else -1)
+        out['iToy'].append(itoy+1)
+        out['iSeed'].append(seed)
+    return out
+
+_toy_loops = {'gof': _gofToys, 'fit': _fitToys}
+_toy_columns = {'gof': _gof_columns, 'fit': _fit_columns}
+
+def _gofJob(job):
+    ROOT.RooRandom.randomGenerator().SetSeed(job['seed'])
+    engine = ToyEngine(**job['engine'])
+    engine.SetGenerationPoint(fitData=True)
+    return _gofToys(engine, job['ntoys'], job['seed'])
+
+def _fitJob(job):
+    ROOT.RooRandom.randomGenerator().SetSeed(job['seed'])
+    engine = ToyEngine(**job['engine'])
+    engine.SetGenerationPoint(fitData=job['fitData'], rGen=job['rGen'])
+    return _fitToys(engine, job['ntoys'], job['seed'])
+
+# One engine per worker process of run_adaptive() (kept between batches)
+_worker_engine = None
+
+def _initWorkerEngine(engineArgs, fitData, rGen):
+    global _worker_engine
+    _worker_engine = ToyEngine(**engineArgs)
+    _worker_engine.SetGenerationPoint(fitData=fitData, rGen=rGen)
+
+def _workerBatch(batch):
+    kind, ntoys, seed = batch
+    return _toy_loops[kind](_worker_engine, ntoys, seed)
+
+def _run_jobs(func, jobs, nCores, columns):
+    if nCores > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nCores,len(jobs)))
+        try:
+            results = pool.map(func, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [func(job) for job in jobs]
+
+    return {c:[v for r in results for v in r[c]] for c in columns}
+
+def run_gof_data(engineArgs, seed=123456):
+    '''Saturated GoodnessOfFit of the data.
+
+    Returns:
+        dict: Columns of combine's `limit` tree.
+    '''
+    engine = ToyEngine(**engineArgs)
+    status = engine.Fit(engine.data)
+    return {'limit': [engine.Saturated(engine.data) if status == 0 else float('nan')],
+            'quantileExpected': [-1], 'iToy': [0], 'iSeed': [seed]}
+
+def run_gof(engineArgs, ntoys, seed=123456, nCores=1):
+    '''Saturated GoodnessOfFit of the data and of `ntoys` frequentist toys, split over `nCores` processes.
+
+    Args:
+        engineArgs (dict): Arguments to construct the ToyEngine.
+        ntoys (int): Number of toys.
+        seed (int, optional): Seed of the first process (the others use `seed`+1, `seed`+2, ...). Defaults to 123456.
+        nCores (int, optional): Number of processes. Defaults to 1.
+
+    Returns:
+        tuple(dict, dict): Columns of combine's `limit` tree for the data and the toys.
+    '''
+    data = run_gof_data(engineArgs, seed)
+    jobs = [{'engine': engineArgs, 'ntoys': n, 'seed': s} for n,s in _split_toys(ntoys, nCores, seed)]
+    return data, _run_jobs(_gofJob, jobs, nCores, _gof_columns)
+
+def run_signal_injection(engineArgs, injectAmount, ntoys, seed=123456, nCores=1, fitData=True):
+    '''Fit `ntoys` toys generated with the POI at `injectAmount`, split over `nCores` processes.
+
+    Args:
+        engineArgs (dict): Arguments to construct the ToyEngine.
+        injectAmount (float): POI value to generate with.
+        ntoys (int): Number of toys.
+        seed (int, optional): Seed of the first process (the others use `seed`+1, `seed`+2, ...). Defaults to 123456.
+        nCores (int, optional): Number of processes. Defaults to 1.
+        fitData (bool, optional): Fit the data to get the generation point. Defaults to True.
+
+    Returns:
+        dict: Columns of combine's `tree_fit_sb` tree.
+    '''
+    jobs = [{'engine': engineArgs, 'ntoys': n, 'seed': s, 'rGen': injectAmount, 'fitData': fitData}
+                for n,s in _split_toys(ntoys, nCores, seed)]
+    return _run_jobs(_fitJob, jobs, nCores, _fit_columns)
+
+def run_adaptive(kind, engineArgs, stopRule, batchSize=100, minToys=100, maxToys=10000, seed=123456, nCores=1, fitData=True, rGen=None):
+    '''Run toys in batches until `stopRule` is satisfied or `maxToys` is reached.
+    Each of the `nCores` worker processes loads the workspace once and runs one batch
+    of `batchSize` toys at a time. Every batch gets its own seed (`seed`, `seed`+1, ...)
+    so no two batches repeat the same toys. `stopRule` is checked on all toys
+    collected so far after each round of batches (once at least `minToys` are done).
+
+    Args:
+        kind (str): "gof" for the saturated test statistic of each toy (columns of combine's `limit` tree)
+            or "fit" for the POI fit of each toy (columns of combine's `tree_fit_sb` tree).
+        engineArgs (dict): Arguments to construct the ToyEngine.
+        stopRule (callable): Called with the columns so far. Returns a reason (str) to stop or None to continue
+            (ex. toys.PValueStop or toys.PullMeanStop).
+        batchSize (int, optional): Toys per batch. Defaults to 100.
+        minToys (int, optional): Toys to run before checking `stopRule`. Defaults to 100.
+        maxToys (int, optional): Maximum number of toys. Defaults to 10000.
+        seed (int, optional): Seed of the first batch. Defaults to 123456.
+        nCores (int, optional): Number of processes. Defaults to 1.
+        fitData (bool, optional): Fit the data to get the generation point. Defaults to True.
+        rGen (float, optional): POI value to generate with. Defaults to None (unchanged).
+
+    Returns:
+        tuple(dict, str): Columns of all of the toys and the reason for stopping.
+    '''
+    if nCores > 1:
+        pool = multiprocessing.Pool(nCores, _initWorkerEngine, (engineArgs, fitData, rGen))
+        run_batches = lambda batches: pool.map(_workerBatch, batches, chunksize=1)
+    else:
+        _initWorkerEngine(engineArgs, fitData, rGen)
+        run_batches = lambda batches: [_workerBatch(b) for b in batches]
+
+    out = {c:[] for c in _toy_columns[kind]}
+    ntoys, next_seed, reason = 0, seed, None
+    try:
+        while reason == None:
+            batches = []
+            for _ in range(max(1,nCores)):
+                n = min(batchSize, maxToys-ntoys-sum(b[1] for b in batches))
+                if n <= 0:
+                    break
+                batches.append((kind, n, next_seed))
+                next_seed += 1
+            if len(batches) == 0:
+                reason = 'reached maxToys = %s'%maxToys
+                break
+
+            for result in run_batches(batches):
+                for c in out:
+                    out[c].extend(result[c])
+            ntoys = len(out['iToy'])
+            if ntoys >= minToys:
+                reason = stopRule(out)
+            print ('Finished %s toys (seeds %s-%s)%s'%(ntoys, seed, next_seed-1, '' if reason == None else ': stopping, '+reason))
+    finally:
+        if nCores > 1:
+            pool.close()
+            pool.join()
+
+    return out, reason
+
+def generate_toys(engineArgs, ntoys, outFile, seed=123456, expectSignal=0, fitData=False):
+    '''Generate `ntoys` toys and save them like `combine -M GenerateOnly --saveToys`
+    (as `toys/toy_<i>` in `outFile`).
+
+    Args:
+        engineArgs (dict): Arguments to construct the ToyEngine.
+        ntoys (int): Number of toys.
+        outFile (str): Output file name.
+        seed (int, optional): Seed. Defaults to 123456.
+        expectSignal (float, optional): POI value to generate with. Defaults to 0.
+        fitData (bool, optional): Fit the data to get the generation point. Defaults to False.
+    '''
+    ROOT.RooRandom.randomGenerator().SetSeed(seed)
+    engine = ToyEngine(**engineArgs)
+    engine.SetGenerationPoint(fitData=fitData, rGen=expectSignal)
+    f = ROOT.TFile.Open(outFile,'RECREATE')
+    toydir = f.mkdir('toys')
+    for itoy in range(ntoys):
+        toy = engine.Generate()
+        toydir.WriteTObject(toy, 'toy_%s'%(itoy+1))
+    f.Close()
+
+def write_tree(filename, treeName, columns):
+    '''Write `columns` (map of branch name to list of values) as a TTree of doubles.
+
+    Args:
+        filename (str): Output file name (recreated).
+        treeName (str): Name of the TTree (ex. "limit" or "tree_fit_sb").
+        columns (dict(str, list)): Branch values.
+    '''
+    f = ROOT.TFile.Open(filename,'RECREATE')
+    tree = ROOT.TTree(treeName, treeName)
+    buffers = {}
+    for c in columns:
+        buffers[c] = array('d',[0])
+        tree.Branch(c, buffers[c], c+'/D')
+    for i in range(len(next(iter(columns.values())))):
+        for c in columns:
+            buffers[c][0] = columns[c][i]
+        tree.Fill()
+    f.WriteTObject(tree, treeName)
+    f.Close()
@@ -0,0 +1,335 @@
+import ROOT, fnmatch, glob, hashlib, json, numpy, os, shutil, tarfile, tempfile
+
+def read_tree_branches(filename, treeName, branches):
+    '''Read the values of `branches` from every entry of the TTree `treeName` in `filename`.
+    The branches are read in one bulk read with RDataFrame.AsNumpy when it is available
+    (ROOT 6.16+) and with a loop over the entries otherwise.
+
+    Args:
+        filename (str): ROOT file name and path.
+        treeName (str): Name of the TTree (ex. "limit" or "tree_fit_sb").
+        branches (list(str)): Branches to read.
+
+    Raises:
+        IOError: If the file cannot be opened or the tree does not exist.
+
+    Returns:
+        dict(str, list): Map of the branch name to the list of values.
+    '''
+    f = ROOT.TFile.Open(filename)
+    if not f or f.IsZombie():
+        raise IOError('Cannot open %s.'%filename)
+    tree = f.Get(treeName)
+    if not tree:
+        f.Close()
+        raise IOError('Tree %s not found in %s.'%(treeName, filename))
+
+    if hasattr(ROOT, 'RDataFrame') and hasattr(ROOT.RDataFrame, 'AsNumpy'):
+        f.Close()
+        arrays = ROOT.RDataFrame(treeName, filename).AsNumpy(list(branches))
+        return {b:numpy.asarray(arrays[b], dtype=float).tolist() for b in branches}
+
+    out = {b:[] for b in branches}
+    for entry in tree:
+        for b in branches:
+            out[b].append(float(getattr(entry, b)))
+    f.Close()
+    return out
+
+def empirical_pvalue(values, observed, nboot=1000, seed=None):
+    '''Fraction of the toys with a value at least as large as `observed` (ex. the
+    GoodnessOfFit test statistic in data) and its bootstrap uncertainty. No shape is
+    assumed for the distribution of the toys. The tail count of a resample of the toys
+    (with replacement) is binomially distributed so the resamples are drawn directly
+    from that distribution instead of resampling the full array `nboot` times.
+
+    Args:
+        values (array-like): Toy values. Non-finite values (failed toys) are dropped.
+        observed (float): Observed value.
+        nboot (int, optional): Number of bootstrap samples. Defaults to 1000.
+        seed (int, optional): Seed for the bootstrap. Defaults to None.
+
+    Returns:
+        tuple(float, float): p-value and its uncertainty (NaN if there are no toys).
+            If no toy reaches `observed`, the uncertainty is 1/N (an upper bound on the p-value).
+    '''
+    values = numpy.asarray(values, dtype=float)
+    values = values[numpy.isfinite(values)]
+    if values.size == 0:
+        return numpy.nan, numpy.nan
+    ntail = numpy.count_nonzero(values >= observed)
+    pvalue = float(ntail)/values.size
+    if ntail == 0:
+        return pvalue, 1.0/values.size
+    boot = numpy.random.RandomState(seed).binomial(values.size, pvalue, nboot)/float(values.size)
+    return pvalue, float(boot.std())
+
+def binomial_uncertainty(k, n):
+    '''Uncertainty of the fraction `k`/`n` (Agresti-Coull, so that it is not zero when `k` is 0 or `n`).'''
+    p = (k+2.0)/(n+4.0)
+    return numpy.sqrt(p*(1-p)/(n+4.0))
+
+def injection_pulls(fits, injected):
+    '''Pulls ((r-injected)/(error on the side of the injected value)) and the biases (r-injected)
+    of the successful fits (fit_status >= 0) to signal injection toys.
+
+    Args:
+        fits (dict): Arrays (or lists) of `r`, `rHiErr`, `rLoErr`, and `fit_status` (as in combine's tree_fit_sb).
+        injected (float): Injected signal strength.
+
+    Returns:
+        tuple(numpy.ndarray, numpy.ndarray): Pulls and biases.
+    '''
+    good = numpy.asarray(fits['fit_status'], dtype=float) >= 0
+    r = numpy.asarray(fits['r'], dtype=float)[good]
+    hi = numpy.asarray(fits['rHiErr'], dtype=float)[good]
+    lo = numpy.asarray(fits['rLoErr'], dtype=float)[good]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        pulls = (r-injected)/(hi*(r<injected)+lo*(r>injected))
+    return pulls, r-injected
+
+class PValueStop(object):
+    '''Stopping rule for toy campaigns (see toyengine.run_adaptive()) on the empirical p-value
+    of `observed` among the toys in `column`. Stops when the binomial uncertainty on the
+    p-value is below `precision` or when the p-value is more than `nsigma` uncertainties
+    away from `threshold` (so it is clearly above or below it).
+
+    Args:
+        observed (float): Observed test statistic.
+        precision (float, optional): Target uncertainty on the p-value. Defaults to 0.005.
+        threshold (float, optional): p-value to decide on. Defaults to 0.05. Use None to only stop on the precision.
+        nsigma (float, optional): Number of uncertainties away from `threshold` to decide. Defaults to 3.
+        column (str, optional): Column with the test statistics. Defaults to 'limit'.
+    '''
+    def __init__(self, observed, precision=0.005, threshold=0.05, nsigma=3, column='limit'):
+        self.observed = observed
+        self.precision = precision
+        self.threshold = threshold
+        self.nsigma = nsigma
+        self.column = column
+
+    def __call__(self, columns):
+        values = numpy.asarray(columns[self.column], dtype=float)
+        values = values[numpy.isfinite(values)]
+        k, n = numpy.count_nonzero(values >= self.observed), values.size
+        if n == 0:
+            return None
+        p, err = float(k)/n, binomial_uncertainty(k, n)
+        if err < self.precision:
+            return 'p-value = %.4f +/- %.4f reached the precision of %s'%(p, err, self.precision)
+        if self.threshold != None and abs(p-self.threshold) > self.nsigma*err:
+            return 'p-value = %.4f +/- %.4f is %s the threshold of %s'%(p, err, 'above' if p > self.threshold else 'below', self.threshold)
+        return None
+
+class PullMeanStop(object):
+    '''Stopping rule for signal injection toys (see toyengine.run_adaptive()). Stops when the
+    uncertainty on the mean of the pulls (see injection_pulls()) is below `precision`.
+
+    Args:
+        injected (float): Injected signal strength.
+        precision (float, optional): Target uncertainty on the mean pull. Defaults to 0.05.
+    '''
+    def __init__(self, injected, precision=0.05):
+        self.injected = injected
+        self.precision = precision
+
+    def __call__(self, columns):
+        pulls = injection_pulls(columns, self.injected)[0]
+        pulls = pulls[numpy.isfinite(pulls)]
+        if pulls.size < 2:
+            return None
+        mean, err = pulls.mean(), pulls.std(ddof=1)/numpy.sqrt(pulls.size)
+        if err < self.precision:
+            return 'mean pull = %.3f +/- %.3f reached the precision of %s'%(mean, err, self.precision)
+        return None
+
+class ToyHarvester(object):
+    '''Collect branches of the toy outputs (ex. `limit` from GoodnessOfFit or
+    `r`, `rHiErr`, `rLoErr`, and `fit_status` from FitDiagnostics) as they arrive.
+    ROOT files and condor output tarballs (.tgz) are read in place. Tarball members
+    are copied out one at a time to a temporary file and removed after reading,
+    so the tarballs are never fully extracted.
+
+    The values of each input are stored once in their own .npz file in `<stateFile>.data/`
+    and the small JSON state file only records the size, modification time, and number of toys
+    of each input. Each call to Update() only reads files that are new or have changed
+    since the last call (so harvesting can be resumed and run while jobs are still finishing).
+    The accumulated toys are available at any time from Values(), Histogram(),
+    Quantiles(), PValue(), and Summary().
+
+    Args:
+        stateFile (str): Path to the JSON state file. Loaded if it already exists.
+        treeName (str): Name of the TTree to read.
+        branches (list(str)): Branches to read.
+        memberPattern (str, optional): Pattern (fnmatch) for the names of the ROOT files to read
+            inside tarballs. Defaults to '*.root'.
+        saveEvery (int, optional): Number of inputs to read between saves of the state file
+            during Update(). Defaults to 50.
+
+    Attributes:
+        files (dict): Map of the input (ROOT file path or `<tarball>::<member>`) to its size,
+            modification time, and number of toys.
+    '''
+    def __init__(self, stateFile, treeName, branches, memberPattern='*.root', saveEvery=50):
+        self.stateFile = stateFile
+        self.dataDir = stateFile+'.data'
+        self.treeName = treeName
+        self.branches = list(branches)
+        self.memberPattern = memberPattern
+        self.saveEvery = saveEvery
+        self.files = {}
+        self._data = {} # values of the inputs loaded from (or written to) dataDir
+        if os.path.exists(stateFile):
+            with open(stateFile) as f:
+                state = json.load(f)
+            if state['treeName'] == treeName and state['branches'] == self.branches:
+                self.files = state['files']
+            else:
+                print ('WARNING: Ignoring state in %s which was made for a different tree or branches.'%stateFile)
+
+    def Save(self):
+        '''Write the state file (via a temporary file so that it is never left half-written).'''
+        tmp = self.stateFile+'.tmp'
+        with open(tmp,'w') as f:
+            json.dump({'treeName': self.treeName, 'branches': self.branches, 'files': self.files}, f)
+        os.rename(tmp, self.stateFile)
+
+    def _dataFile(self, key):
+        return os.path.join(self.dataDir, hashlib.md5(key.encode('utf-8')).hexdigest()+'.npz')
+
+    def _store(self, key, stamp, data):
+        '''Write the values of input `key` to its .npz file and return its entry for `files`.'''
+        if not os.path.exists(self.dataDir):
+            os.makedirs(self.dataDir)
+        arrays = [numpy.asarray(data[b], dtype=float) for b in self.branches]
+        with open(self._dataFile(key),'wb') as f:
+            numpy.savez(f, *arrays)
+        self._data[key] = dict(zip(self.branches, arrays))
+        return dict(stamp, count=int(arrays[0].size))
+
+    def _load(self, key):
+        if key not in self._data:
+            with numpy.load(self._dataFile(key)) as npz:
+                self._data[key] = {b:npz['arr_%s'%i] for i,b in enumerate(self.branches)}
+        return self._data[key]
+
+    def Update(self, patterns):
+        '''Read all new or changed ROOT files and tarballs matching `patterns`.
+        Files that cannot be read yet (ex. a tarball still being transferred) are
+        skipped and tried again on the next call. The state is saved every `saveEvery`
+        inputs (so an interrupted harvest is resumed without starting over) and at the end.
+
+        Args:
+            patterns (str or list(str)): Glob pattern(s) for the ROOT files and/or tarballs.
+
+        Returns:
+            ToyHarvester: self (for chaining).
+        '''
+        if isinstance(patterns, str):
+            patterns = [patterns]
+
+        nread = 0
+        for path in sorted(set(p for pattern in patterns for p in glob.glob(pattern))):
+            stat = os.stat(path)
+            stamp = {'size': stat.st_size, 'mtime': stat.st_mtime}
+            existing = [k for k in self.files if k == path or k.startswith(path+'::')]
+            if len(existing) > 0 and all(self.files[k]['size'] == stamp['size'] and self.files[k]['mtime'] == stamp['mtime'] for k in existing):
+                continue
+
+            try:
+                if path.endswith('.tgz') or path.endswith('.tar.gz'):
+                    new_entries = self._readTarball(path, stamp)
+                else:
+                    new_entries = {path: self._store(path, stamp, read_tree_branches(path, self.treeName, self.branches))}
+            except (IOError, OSError, tarfile.TarError, EOFError) as e:
+                print ('Skipping %s for now: %s'%(path, e))
+                continue
+
+            for k in existing:
+                del self.files[k]
+                if k not in new_entries:
+                    self._data.pop(k, None)
+                    if os.path.exists(self._dataFile(k)):
+                        os.remove(self._dataFile(k))
+            self.files.update(new_entries)
+            nread += 1
+            if nread % self.saveEvery == 0:
+                self.Save()
+
+        if nread % self.saveEvery != 0 or not os.path.exists(self.stateFile):
+            self.Save()
+        return self
+
+    def _readTarball(self, path, stamp):
+        out = {}
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with tarfile.open(path, 'r:gz') as tar:
+                for member in tar:
+                    if not member.isfile() or not fnmatch.fnmatch(os.path.basename(member.name), self.memberPattern):
+                        continue
+                    tmpname = os.path.join(tmpdir, os.path.basename(member.name))
+                    with open(tmpname,'wb') as tmp:
+                        shutil.copyfileobj(tar.extractfile(member), tmp)
+                    key = path+'::'+member.name
+                    out[key] = self._store(key, stamp, read_tree_branches(tmpname, self.treeName, self.branches))
+                    os.remove(tmpname)
+        finally:
+            shutil.rmtree(tmpdir)
+        if len(out) == 0: # nothing to read but don't try again until it changes
+            out[path] = self._store(path, stamp, {b:[] for b in self.branches})
+        return out
+
+    def Values(self, branch=None):
+        '''Values harvested so far (in a fixed order of the inputs).
+
+        Args:
+            branch (str, optional): Branch to get. Defaults to None in which case the first branch is used.
+
+        Returns:
+            numpy.ndarray
+        '''
+        branch = self.branches[0] if branch == None else branch
+        if len(self.files) == 0:
+            return numpy.array([], dtype=float)
+        return numpy.concatenate([self._load(k)[branch] for k in sorted(self.files)])
+
+    @property
+    def count(self):
+        return sum(f['count'] for f in self.files.values())
+
+    def Histogram(self, nbins, lo, hi, branch=None):
+        '''Returns:
+            tuple(numpy.ndarray, numpy.ndarray): Counts and bin edges (see numpy.histogram).'''
+        return numpy.histogram(self.Values(branch), bins=nbins, range=(lo,hi))
+
+    def Quantiles(self, qs=(0.025,0.16,0.5,0.84,0.975), branch=None):
+        '''Returns:
+            numpy.ndarray: Quantiles of the values (NaN if there are none).'''
+        values = self.Values(branch)
+        if values.size == 0:
+            return numpy.full(len(qs), numpy.nan)
+        return numpy.quantile(values, qs)
+
+    def PValue(self, observed, branch=None, nboot=1000):
+        '''Empirical p-value of `observed` from the toys (see empirical_pvalue()).
+
+        Returns:
+            tuple(float, float): p-value and its bootstrap uncertainty.
+        '''
+        return empirical_pvalue(self.Values(branch), observed, nboot)
+
+    def Summary(self, observed=None, branch=None):
+        '''Returns:
+            dict: Number of toys, mean, standard deviation, the 2.5/16/50/84/97.5% quantiles,
+            and (if `observed` is given) the empirical p-value and its uncertainty.'''
+        values = self.Values(branch)
+        out = {
+            'count': int(values.size),
+            'mean': float(values.mean()) if values.size else numpy.nan,
+            'std': float(values.std()) if values.size else numpy.nan,
+            'quantiles': dict(zip(['2.5','16','50','84','97.5'], self.Quantiles(branch=branch).tolist()))
+        }
+        if observed != None:
+            out['pvalue'], out['pvalue_err'] = self.PValue(observed, branch)
+        return out
@@ -1,9 +1,11 @@
-import argparse, os, itertools, pandas, glob, pickle, sys, re, random, copy, numpy
+import argparse, os, itertools, pandas, glob, pickle, sys, re, random, copy, numpy, multiprocessing, json, time
 from collections import OrderedDict
 from TwoDAlphabet.config import Config, OrganizedHists
-from TwoDAlphabet.binning import Binning
-from TwoDAlphabet.helpers import CondorRunner, execute_cmd, parse_arg_dict, unpack_to_line, make_RDH, cd, _combineTool_impacts_fix
+from TwoDAlphabet.binning import Binning, get_hist_arrays, set_hist_arrays
+from TwoDAlphabet.helpers import CondorRunner, execute_cmd, execute_cmd_in, build_workspace, parse_arg_dict, unpack_to_line, make_RDH, cd, _combineTool_impacts_fix
 from TwoDAlphabet.alphawrap import Generic2D
+from TwoDAlphabet.toyengine import run_gof, run_gof_data, run_signal_injection, run_adaptive, generate_toys, write_tree, _split_toys
+from TwoDAlphabet.toys import PValueStop, PullMeanStop
 from TwoDAlphabet import plot
 import ROOT
 
@@ -65,7 +67,9 @@ class TwoDAlphabet:
 
             self.organizedHists = OrganizedHists(
                 self.tag+'/', self.binnings,
-                self.GetHistMap(), readOnly=False
+                self.GetHistMap(), readOnly=False,
+                nCores=self.options.nCores,
+                useCache=self.options.cacheHists
             )
             self.workspace = self._makeWorkspace()
 
@@ -117,6 +121,14 @@ class TwoDAlphabet:
             help="Delete project directory if it exists. Defaults to False.")
         parser.add_argument('debugDraw', default=False, type=bool, nargs='?',
             help="Draw all canvases while running for the sake of debugging. Useful for developers only. Defaults to False.")
+        parser.add_argument('nCores', default=1, type=int, nargs='?',
+            help="Number of local processes to use for parallelizable steps (ex. reading input histograms). Defaults to 1 (serial).")
+        parser.add_argument('cacheHists', default=True, type=bool, nargs='?',
+            help="Reuse histograms from an existing organized_hists.root if their inputs and binning are unchanged. Defaults to True.")
+        parser.add_argument('cacheWorkspaces', default=True, type=bool, nargs='?',
+            help="Reuse the workspace compiled from a card (by text2workspace) if the card and base.root are unchanged. Defaults to True.")
+        parser.add_argument('qcdFloor', default=1e-5, type=float, nargs='?',
+            help="Value given to bins of data minus backgrounds (see InitQCDHists) that are negative. Defaults to 1e-5.")
         # Blinding
         parser.add_argument('blindedPlots', default=[], type=str, nargs='*',
             help='List of regions in which to blind plots of x-axis SIG. Does not blind fit.')
@@ -131,6 +143,12 @@ class TwoDAlphabet:
             help='Plot comparison of pre-fit uncertainty shape templates in 1D projections. Defaults to False.')
         parser.add_argument('plotPrefitSigInFitB', default=False, type=bool, nargs='?',
             help='In the b-only post-fit plots, plot the signal normalized to its pre-fit value. Defaults to False.')
+        parser.add_argument('plotCacheMB', default=500, type=float, nargs='?',
+            help='Memory cap (in MB) of the cache of histograms loaded for plotting (see plot.HistCache). Defaults to 500.')
+        parser.add_argument('plotPadPDFs', default=True, type=bool, nargs='?',
+            help='Save a PDF of each pad of the combined plots (in base_figs/). Defaults to True.')
+        parser.add_argument('plotPadPNGs', default=True, type=bool, nargs='?',
+            help='Save a PNG of each pad of the combined plots (in base_figs/). The combined plots do not need them. Defaults to True.')
         parser.add_argument('plotEvtsPerUnit', default=False, type=bool, nargs='?',
             help='Post-fit bins are plotted as events per unit rather than events per bin. Defaults to False.')
         parser.add_argument('year', default=1, type=int, nargs='?',
@@ -180,6 +198,7 @@ class TwoDAlphabet:
         model_obj_row = {
             "process": process,
             "region": region,
+            "owner": process+'_'+region,
             "process_type": ptype,
             "color": color,
             'title': title_to_use
@@ -193,6 +212,14 @@ class TwoDAlphabet:
             d['owner'] = process+'_'+region
             self.ledger.alphaParams = self.ledger.alphaParams.append(d, ignore_index=True)
 
+        for f in obj.funcs: # so the transfer functions can be plotted after the fit (see StdPlots)
+            self.ledger.alphaFuncs = self.ledger.alphaFuncs.append({
+                'name': f.name, 'formula': f.formula, 'forcePositive': f.forcePositive,
+                'params': ' '.join(n['name'] for n in f.nuisances),
+                'nominal': ' '.join(repr(n['obj'].getValV()) for n in f.nuisances),
+                'owner': process+'_'+region
+            }, ignore_index=True)
+
         for rph_cat in rph.values():
             print ('Adding RooParametricHist... %s'%rph_cat.GetName())
             getattr(self.workspace,'import')(rph_cat,ROOT.RooFit.RecycleConflictNodes(),ROOT.RooFit.Silence())
@@ -203,7 +230,9 @@ class TwoDAlphabet:
 # --------------- GETTERS --------------- #
     def InitQCDHists(self):
         '''Loop over all regions and for a given region's data histogram, subtract the list of background histograms,
-        and return data-bkgList.
+        and return data-bkgList. The subtraction is done on the bin arrays. After each background is subtracted,
+        bins (excluding under/overflow) that are negative are set to `qcdFloor` and their errors are reset
+        to the data errors.
 
         Returns:
             dict(region,TH2): Dictionary with regions as keys and values as histograms of data-bkgList.
@@ -213,44 +242,37 @@ class TwoDAlphabet:
             data_hist = self.organizedHists.Get(process='data_obs',region=region,systematic='')
             qcd = data_hist.Clone(data_hist.GetName().replace('data_obs','qcd'))
             qcd.SetDirectory(0)
-            
-            print 'data_hist.GetEntries()', data_hist.GetEntries()
 
+            data_content, data_errors = get_hist_arrays(data_hist)
+            content = data_content.copy()
+            sumw2 = data_errors**2
+
+            # Bins where the backgrounds exceed data are floored and keep the data uncertainty
+            negative = numpy.zeros(content.shape, dtype=bool)
+            floored = numpy.zeros(content.shape, dtype=bool)
             bkg_sources = group.loc[group.process_type.eq('BKG') & group.variation.eq('nominal')]['process']
             for process_name in bkg_sources.to_list():
-                print(process_name, region)
-                bkg_hist = self.organizedHists.Get(process=process_name,region=region,systematic='')
-                print 'bkg_hist.GetEntries()', bkg_hist.GetEntries()
-                
-                
-                qcd.Add(bkg_hist,-1)
-                
-
-                # hardcoding fix for bins where mc ttbar > data
-                # if qcd is < 0 in a bin, set bin content to 0
-                for i in range(qcd.ProjectionX().GetNbinsX()):
-                    for j in range(qcd.ProjectionY().GetNbinsX()):
-                        
-                        # set bin content to 0 if negative
-                        # reset uncertainty to cloned data uncertainty
-                        bc = qcd.GetBinContent(i,j)
-                        if bc < 0:
-                            qcd.SetBinContent(i,j,0.00001)
-                            qcd.SetBinError(i, j,  data_hist.GetBinError(i,j))
-                        
-                        
-     
-
-
+                bkg_content, bkg_errors = get_hist_arrays(self.organizedHists.Get(process=process_name,region=region,systematic=''))
+                content -= bkg_content
+                sumw2 += bkg_errors**2
+
+                negative[1:-1,1:-1] = content[1:-1,1:-1] < 0
+                content[negative] = self.options.qcdFloor
+                sumw2[negative] = data_errors[negative]**2
+                floored |= negative
+
+            if floored.any():
+                print ('WARNING: %s bins of data-bkgs in %s are negative. Setting to %s.'%(floored.sum(), region, self.options.qcdFloor))
+            set_hist_arrays(qcd, content, numpy.sqrt(sumw2))
             out[region] = qcd
-            
+
         return out
 
     def GetHistMap(self, df=None):
         '''Collect information on the histograms to extract, manipulate, and save
         into organized_hists.root and store it inside a `dict` where the key is the
         filename and the value is a DataFrame with columns `source_histname`, `out_histname`,
-        `scale`, `color`, and `binning`. Only accounts for "FULL" category and does not 
+        `scale`, `color`, `binning`, `process`, `region`, and `systematic` (empty for nominal). Only accounts for "FULL" category and does not 
         contain information on subspaces.
 
         Args:
@@ -282,7 +304,8 @@ class TwoDAlphabet:
             out_df = out_df[out_df['variation'].eq('nominal') | out_df["syst_type"].eq("shapes")]
             out_df['out_histname'] = out_df.apply(_get_out_name, axis=1)
             out_df['binning'] = out_df.apply(lambda row: self._binningMap[row.region], axis=1)
-            hists[g] = out_df[['source_histname','out_histname','scale','color','binning']]
+            out_df['systematic'] = out_df.apply(lambda row: '' if row.variation == 'nominal' else row.variation+row.direction, axis=1)
+            hists[g] = out_df[['source_histname','out_histname','scale','color','binning','process','region','systematic']]
         return hists
 
     def GetBinningFor(self, region):
@@ -294,24 +317,6 @@ class TwoDAlphabet:
         
         raise RuntimeError('Cannot find region (%s) in config:\n\t%s'%(region,self._binningMap))
 
-    def _getCatNameRobust(self, hname):
-        if hname.split('_')[-1] in ['FULL','SIG','HIGH','LOW']: # simplest case
-            out =  hname.split('_')[-1]
-        else: # systematic variation so need to be careful
-            this_rname = False
-            for rname in self.ledger.GetRegions():
-                if rname in hname:
-                    this_rname = rname
-                    break
-
-            if not this_rname: raise RuntimeError('Could not find a region name from %s in "%s"'%(self.ledger.GetRegions(),hname))
-
-            start_idx = hname.index(this_rname)+len(this_rname)+1 #+1 for the trailing underscore
-            end_idx = hname.index('_',start_idx)
-            out = hname[start_idx:end_idx]
-        
-        return out
-
 # ---------- FIRST STEP CONSTRUCTION ------ #
     def _makeWorkspace(self):
         var_lists = {}
@@ -322,15 +327,11 @@ class TwoDAlphabet:
 
         print ("Making workspace...")
         workspace = ROOT.RooWorkspace("w")
-        for hname in self.organizedHists.GetHistNames():
-            cat = self._getCatNameRobust(hname)
-            if cat == 'FULL':
-                continue
-            
-            binningName = self.organizedHists.BinningLookup(hname.replace(cat,'FULL'))
+        for hname in self.organizedHists.Query(subspace=['LOW','SIG','HIGH']):
+            info = self.organizedHists.GetInfo(hname)
 
             print ('Making RooDataHist... %s'%hname)
-            rdh = make_RDH(self.organizedHists.Get(hname), var_lists[binningName][cat])
+            rdh = make_RDH(self.organizedHists.Get(hname), var_lists[info.binning][info.subspace])
             getattr(workspace,'import')(rdh)
 
         return workspace
@@ -340,6 +341,84 @@ class TwoDAlphabet:
             _runDirSetup(subtag)
             MakeCard(subledger, subtag, workspaceDir)
 
+    def MakeMasterWorkspace(self, subledger, subtag='master', workspaceDir='../', rRange=(-5,20)):
+        '''Make one card and workspace holding all of the signals in `subledger` (a "master" workspace).
+        Each signal gets its own signal strength, `r_<signal>`, via the multiSignalModel
+        physics model so that a single signal can be selected for a fit by freezing the
+        others to zero (see MasterSignalOptions()) instead of building a new workspace
+        for every signal. The list of signals is saved to `<tag>/<subtag>/master_signals.json`.
+
+        Args:
+            subledger (Ledger): Ledger with all of the signals (and one choice of background).
+            subtag (str, optional): Directory (in the project directory) for the card. Defaults to 'master'.
+            workspaceDir (str, optional): Location of base.root relative to the card. Defaults to '../'.
+            rRange (tuple, optional): Range of the signal strengths. Defaults to (-5,20).
+
+        Returns:
+            str: Absolute path to the workspace.
+        '''
+        run_dir = _runDirSetup(self.tag+'/'+subtag)
+        MakeCard(subledger, run_dir, workspaceDir)
+
+        signals = sorted(set(subledger.GetProcesses('SIGNAL')))
+        t2w_options = '--channel-masks --X-no-jmax -P HiggsAnalysis.CombinedLimit.PhysicsModel:multiSignalModel '
+        t2w_options += ' '.join(["--PO 'map=.*/%s:r_%s[1,%s,%s]'"%(s,s,rRange[0],rRange[1]) for s in signals])
+        workspace = build_workspace(run_dir+'/card.txt', t2w_options, rebuild=not self.options.cacheWorkspaces)
+
+        with open(run_dir+'/master_signals.json','w') as f:
+            json.dump({'workspace': os.path.relpath(workspace, self.tag), 'signals': signals}, f, indent=4)
+
+        return workspace
+
+    def MasterSignalOptions(self, signal, subtag='master'):
+        '''Options to fit only `signal` with the workspace from MakeMasterWorkspace().
+        The other signal strengths are set to zero and frozen and `r_<signal>` becomes the POI.
+
+        Example:
+            ::
+
+                workspace, params, extra = twoD.MasterSignalOptions('MX_2000_MY_800')
+                twoD.MLfit('MX_2000_MY_800_area', cardOrW=workspace, setParams=params, extra=extra)
+                twoD.Limit('MX_2000_MY_800_area', card_or_w=workspace+' '+extra, setParams=params)
+
+        Args:
+            signal (str): Name of the signal process to fit.
+            subtag (str, optional): Directory of the master workspace. Defaults to 'master'.
+
+        Raises:
+            KeyError: If `signal` is not in the master workspace.
+
+        Returns:
+            tuple(str, dict, str): Workspace path relative to a subtag directory (ex. `<tag>/<signal>_area/`),
+                parameter values to set, and extra Combine options.
+        '''
+        with open(self.tag+'/'+subtag+'/master_signals.json') as f:
+            master = json.load(f)
+        if signal not in master['signals']:
+            raise KeyError('Signal %s not in the master workspace (options are %s).'%(signal, master['signals']))
+
+        others = ['r_'+s for s in master['signals'] if s != signal]
+        set_params = {r:0 for r in others}
+        extra = '--redefineSignalPOIs r_%s'%signal
+        if len(others) > 0:
+            extra += ' --freezeParameters '+','.join(others)
+
+        return os.path.join('..', str(master['workspace'])), set_params, extra
+
+    def _compiledWorkspace(self, card_or_w):
+        '''Swap a card for its compiled workspace (see build_workspace()).
+        Must be called from the directory the card path is relative to.
+
+        Args:
+            card_or_w (str): Card (ending in .txt) or workspace (possibly with extra options like `--snapshotName`).
+
+        Returns:
+            str: Workspace path relative to the current directory (or `card_or_w` if not a card).
+        '''
+        if not card_or_w.endswith('.txt'):
+            return card_or_w
+        return os.path.relpath(build_workspace(card_or_w, rebuild=not self.options.cacheWorkspaces))
+
 # -------- STAT METHODS ------------------ #
     def MLfit(self, subtag, cardOrW='card.txt', rMin=-1, rMax=10, setParams={}, verbosity=0, usePreviousFit=False, defMinStrat=0, extra=''):
         _runDirSetup(self.tag+'/'+subtag)
@@ -351,7 +430,7 @@ class TwoDAlphabet:
         
         with cd(self.tag+'/'+subtag):
             _runMLfit(
-                cardOrW=cardOrW,
+                cardOrW=cardOrW if usePreviousFit else self._compiledWorkspace(cardOrW),
                 blinding=self.options.blindedFit,
                 verbosity=verbosity, 
                 rMin=rMin, rMax=rMax,
@@ -380,9 +459,32 @@ class TwoDAlphabet:
 		corrText=False # change this if you want the correlation matrix to write the number values to each grid square (often there are too many parameters and looks ugly/useless)
             )
             plot.gen_post_fit_shapes()
+            tfs = self._transferFuncs(ledger)
 #             plot.gen_projections(ledger, self, 'b', loadExisting=True, prefit=False)
-            plot.gen_projections(ledger, self, 'b', prefit)
-            plot.gen_projections(ledger, self, 's', prefit)
+            plot.gen_projections(ledger, self, 'b', prefit, tfs=tfs)
+            plot.gen_projections(ledger, self, 's', prefit, tfs=tfs)
+
+    def _transferFuncs(self, ledger):
+        '''Transfer functions (ParametricFunctions) of the alphabet objects in `ledger`
+        as needed by plot.Plotter.plot_transfer_funcs(). Each function is listed once
+        even if it is part of several objects.
+
+        Args:
+            ledger (Ledger): Ledger with the alphabet objects (and their alphaFuncs).
+
+        Returns:
+            list(dict): Name, formula, forcePositive, parameter names (`params`) and nominal values
+                (`nominal`), and Binning (`binning`) of each function.
+        '''
+        regions = dict(zip(ledger._alphaOwners(), ledger.alphaObjs.region))
+        out = []
+        for _, row in ledger.alphaFuncs.drop_duplicates('name').iterrows():
+            out.append({
+                'name': row['name'], 'formula': row.formula, 'forcePositive': bool(row.forcePositive),
+                'params': str(row.params).split(), 'nominal': [float(v) for v in str(row.nominal).split()],
+                'binning': self.GetBinningFor(regions[row.owner])[0]
+            })
+        return out
             
     def GetParamsOnMatch(self, regex='', subtag='', b_or_s='b'):
         out = {}
@@ -400,7 +502,14 @@ class TwoDAlphabet:
 
         return out
 
-    def GenerateToys(self, name, subtag, card=None, workspace=None, ntoys=1, seed=123456, expectSignal=0, setParams={}, freezeParams=[]):
+    def GenerateToys(self, name, subtag, card=None, workspace=None, ntoys=1, seed=123456, expectSignal=0, setParams={}, freezeParams=[], inProcess=False):
+        '''Generate toys with `combine -M GenerateOnly` (or in this process with the ToyEngine if `inProcess` is True).
+        The toys are saved as `toys/toy_<i>` in `<tag>/<subtag>/higgsCombine_<name>.GenerateOnly.mH120.<seed>.root`.
+
+        Returns:
+            str: Path to the file with the toys.
+        '''
+        snapshot = None
         if card == None and workspace == None:
             raise IOError('Either card or workspace must be provided relative to the directory where the generation will be run.')
         elif card != None and workspace != None:
@@ -411,26 +520,31 @@ class TwoDAlphabet:
                 card_name = card
             elif isinstance(card, bool) and card == True:
                 card_name = 'card.txt'
-            workspace_file = '%s_gen_workspace.root'%(name)
-            execute_cmd(
-                'text2workspace.py -b {0}/{1} -o {0}/{2} --channel-masks --X-no-jmax'.format(
-                    self.tag+'/'+subtag, card_name, workspace_file)
-            )
+            workspace_file = os.path.relpath(
+                build_workspace(self.tag+'/'+subtag+'/'+card_name, rebuild=not self.options.cacheWorkspaces),
+                self.tag+'/'+subtag)
             
             input_opt = '-d %s'%workspace_file
         
         elif workspace:
             if isinstance(workspace, str):
-                workspace_file = workspace.split(':')
-                input_opt = '-d %s --snapshotName %s'%(workspace.split(':'))
+                workspace_file, snapshot = workspace.split(':')
+                input_opt = '-d %s --snapshotName %s'%(workspace_file, snapshot)
             elif isinstance(workspace, bool) and workspace == True:
-                workspace_file = 'initialFitWorkspace.root'
-                input_opt = '-d %s --snapshotName initialFit'%workspace_file
+                workspace_file, snapshot = 'initialFitWorkspace.root', 'initialFit'
+                input_opt = '-d %s --snapshotName %s'%(workspace_file, snapshot)
 
         run_dir = self.tag+'/'+subtag
         masks_off = ['%s=0'%mask for mask in self._getMasks(run_dir+'/'+workspace_file)]
         
         with cd(run_dir):
+            if inProcess:
+                engine_params = dict(setParams)
+                engine_params.update({mask:0 for mask in self._getMasks(workspace_file)})
+                generate_toys({'workspaceFile': workspace_file, 'snapshot': snapshot, 'setParams': engine_params, 'freezeParams': freezeParams},
+                              ntoys, 'higgsCombine_%s.GenerateOnly.mH120.%s.root'%(name,seed), seed, expectSignal)
+                return '%s/higgsCombine_%s.GenerateOnly.mH120.%s.root'%(self.tag+'/'+subtag+'/',name,seed)
+
             param_vals = ['%s=%s'%(k,v) for k,v in setParams.items()]
             param_vals.extend(masks_off)
             param_opt = ''
@@ -474,7 +588,25 @@ class TwoDAlphabet:
         return masked_regions
 
     def GoodnessOfFit(self, subtag, ntoys, card_or_w='card.txt', freezeSignal=False, seed=123456,
-                            verbosity=0, extra='', condor=False, eosRootfiles=None, njobs=0, makeEnv=False):
+                            verbosity=0, extra='', condor=False, eosRootfiles=None, njobs=0, makeEnv=False,
+                            inProcess=False, nCores=None, adaptive=None):
+        '''Saturated goodness of fit of the data and of `ntoys` frequentist toys with `combine -M GoodnessOfFit`
+        (locally or split over `njobs` condor jobs with seeds `seed`, `seed`+1, ...). With `inProcess`, the toys are instead generated and fit
+        by the ToyEngine in `nCores` local processes (defaults to the `nCores` option) and the outputs
+        are written with the same names and trees as combine (see toyengine.run_gof()).
+
+        With `inProcess`, `adaptive` can be a dict of options for toyengine.run_adaptive() (`batchSize`, `minToys`)
+        and toys.PValueStop (`precision`, `threshold`, `nsigma`) to run toys in batches only until the p-value is
+        known well enough (at most `ntoys`). Use an empty dict for the defaults.
+
+        Raises:
+            ValueError: If `extra` combine options are given with `inProcess` (they cannot be applied to the ToyEngine)
+                or `adaptive` is given without `inProcess`.
+        '''
+        if inProcess and extra.strip() != '':
+            raise ValueError('The extra combine options "%s" cannot be used with inProcess=True.'%extra)
+        if adaptive != None and not inProcess:
+            raise ValueError('Adaptive toys (adaptive=%s) require inProcess=True.'%adaptive)
         # NOTE: There's no way to blind data here - need to evaluate it to get the p-value
         # param_str = '' if setParams == {} else '--setParameters '+','.join(['%s=%s'%(p,v) for p,v in setParams.items()])
 
@@ -482,6 +614,23 @@ class TwoDAlphabet:
         _runDirSetup(run_dir)
         
         with cd(run_dir):
+            card_or_w = self._compiledWorkspace(card_or_w)
+            if inProcess:
+                engine_args = _toyEngineArgs(card_or_w,
+                    setParams={} if not freezeSignal else {'r':freezeSignal},
+                    freezeParams=[] if not freezeSignal else ['r'])
+                nCores = self.options.nCores if nCores == None else nCores
+                if adaptive != None:
+                    gof_data = run_gof_data(engine_args, seed)
+                    scheduler_opts, stop_opts = _adaptiveOptions(adaptive)
+                    gof_toys, reason = run_adaptive('gof', engine_args, PValueStop(gof_data['limit'][0], **stop_opts),
+                                                    maxToys=ntoys, seed=seed, nCores=nCores, **scheduler_opts)
+                else:
+                    gof_data, gof_toys = run_gof(engine_args, ntoys, seed, nCores)
+                write_tree('higgsCombine_gof_data.GoodnessOfFit.mH120.root', 'limit', gof_data)
+                write_tree('higgsCombine_gof_toys.GoodnessOfFit.mH120.{seed}.root'.format(seed=seed), 'limit', gof_toys)
+                return
+
             gof_data_cmd = [
                 'combine -M GoodnessOfFit',
                 '-d '+card_or_w,
@@ -506,16 +655,15 @@ class TwoDAlphabet:
                 execute_cmd(gof_toy_cmd)
                 
             else:
-                per_job_toys = int(round(ntoys/njobs))
-
                 print ('Running toys on condor... first cleaning potential duplicates...')
                 execute_cmd('rm higgsCombine_gof_toys.GoodnessOfFit.mH120.*.root')
 
+                # Unique seeds so that no two jobs make the same toys
                 gof_toy_cmds = [
                     gof_toy_cmd.format(
-                        ntoys=per_job_toys,
-                        seed=random.randint(0,1000000)
-                    ) for _ in range(njobs)
+                        ntoys=job_toys,
+                        seed=job_seed
+                    ) for job_toys, job_seed in _split_toys(ntoys, njobs, seed)
                 ]
 
 		if not makeEnv:
@@ -533,7 +681,25 @@ class TwoDAlphabet:
                 condor.submit()
             
     def SignalInjection(self, subtag, injectAmount, ntoys, blindData=True, card_or_w='card.txt', rMin=-5, rMax=5, 
-                              seed=123456, verbosity=0, setParams={}, defMinStrat=0, extra='', condor=False, eosRootfiles=None, njobs=0, makeEnv=False):
+                              seed=123456, verbosity=0, setParams={}, defMinStrat=0, extra='', condor=False, eosRootfiles=None, njobs=0, makeEnv=False,
+                              inProcess=False, nCores=None, adaptive=None):
+        '''Fit `ntoys` toys generated with `injectAmount` of signal with `combine -M FitDiagnostics`
+        (locally or split over `njobs` condor jobs with seeds `seed`, `seed`+1, ...). With `inProcess`, the toys are instead generated and fit
+        by the ToyEngine in `nCores` local processes (defaults to the `nCores` option) and the fit results
+        are written with the same name and tree as combine (see toyengine.run_signal_injection()).
+
+        With `inProcess`, `adaptive` can be a dict of options for toyengine.run_adaptive() (`batchSize`, `minToys`)
+        and toys.PullMeanStop (`precision`) to run toys in batches only until the mean pull is
+        known well enough (at most `ntoys`). Use an empty dict for the defaults.
+
+        Raises:
+            ValueError: If `extra` combine options are given with `inProcess` (they cannot be applied to the ToyEngine)
+                or `adaptive` is given without `inProcess`.
+        '''
+        if inProcess and extra.strip() != '':
+            raise ValueError('The extra combine options "%s" cannot be used with inProcess=True.'%extra)
+        if adaptive != None and not inProcess:
+            raise ValueError('Adaptive toys (adaptive=%s) require inProcess=True.'%adaptive)
         run_dir = self.tag+'/'+subtag
         _runDirSetup(run_dir)
         
@@ -541,6 +707,19 @@ class TwoDAlphabet:
         param_str = '' if setParams == {} else '--setParameters '+','.join(['%s=%s'%(p,v) for p,v in setParams.items()])
 
         with cd(run_dir):
+            card_or_w = self._compiledWorkspace(card_or_w)
+            if inProcess:
+                engine_args = _toyEngineArgs(card_or_w, rRange=(rMin,rMax), setParams=setParams, strategy=defMinStrat)
+                nCores = self.options.nCores if nCores == None else nCores
+                if adaptive != None:
+                    scheduler_opts, stop_opts = _adaptiveOptions(adaptive)
+                    fits, reason = run_adaptive('fit', engine_args, PullMeanStop(injectAmount, **stop_opts), maxToys=ntoys, seed=seed,
+                                                nCores=nCores, fitData=not blindData, rGen=injectAmount, **scheduler_opts)
+                else:
+                    fits = run_signal_injection(engine_args, injectAmount, ntoys, seed, nCores, fitData=not blindData)
+                write_tree('fitDiagnostics_sigInj_r{rinj}_{seed}.root'.format(rinj=rinj,seed=seed), 'tree_fit_sb', fits)
+                return
+
             fit_cmd = [
                 'combine -M FitDiagnostics',
                 '-d '+card_or_w,
@@ -560,16 +739,15 @@ class TwoDAlphabet:
                 execute_cmd(fit_cmd)
                 
             else:
-                per_job_toys = int(round(ntoys/njobs))
-
                 print ('Running toys on condor... first cleaning potential duplicates...')
                 execute_cmd('rm fitDiagnostics_sigInj_r{rinj}_{seed}.root'.format(rinj=rinj,seed=seed))
 
+                # Unique seeds so that no two jobs make the same toys
                 fit_cmds = [
                     fit_cmd.format(
-                        ntoys=per_job_toys,
-                        seed=random.randint(0,1000000)
-                    ) for _ in range(njobs)
+                        ntoys=job_toys,
+                        seed=job_seed
+                    ) for job_toys, job_seed in _split_toys(ntoys, njobs, seed)
                 ]
 
 		if not makeEnv:
@@ -595,6 +773,8 @@ class TwoDAlphabet:
         _runDirSetup(run_dir)
 
         with cd(run_dir):
+            if not condor:
+                card_or_w = self._compiledWorkspace(card_or_w)
             limit_cmd = _runLimit(blindData, verbosity, setParams, card_or_w, condor) # runs on this line if location == 'local'
             
             if condor:
@@ -610,16 +790,70 @@ class TwoDAlphabet:
                 )
                 condor.submit()
                 
-    def Impacts(self, subtag, rMin=-15, rMax=15, cardOrW='initialFitWorkspace.root --snapshotName initialFit', defMinStrat=0, extra=''):
+    def RunLimits(self, jobs, nCores=None, blindData=True, verbosity=0, setParams={}, workspaceDir='../'):
+        '''Make the cards and run the limits for a list of jobs in a pool of local processes.
+        The cards are made in this process. Each job then runs in its own directory (`<tag>/<subtag>/`)
+        without changing the working directory of this process and streams the output of
+        text2workspace and combine to text2workspace.log and Limit.log in that directory.
+
+        Args:
+            jobs (list(tuple)): List of (subtag, selection) pairs. The selection can be a Ledger (ex. the output of
+                Ledger.select()), a tuple of a function and its arguments to pass to self.ledger.select(), or None
+                if the card already exists in the subtag directory.
+            nCores (int, optional): Number of jobs to run at once. Defaults to None in which case the `nCores` option is used.
+            blindData (bool, optional): Run blinded limits. Defaults to True.
+            verbosity (int, optional): Combine verbosity. Defaults to 0.
+            setParams (dict, optional): Parameter values to set in all jobs. Defaults to {}.
+            workspaceDir (str, optional): Location of base.root relative to the subtag directory. Defaults to '../'.
+
+        Returns:
+            pandas.DataFrame: Summary of the limits (one row per job) which is also saved to `<tag>/limits_summary.csv`.
+        '''
+        limit_jobs = []
+        for subtag, selection in jobs:
+            if subtag == '':
+                raise RuntimeError('The subtag for limits must be non-empty so that the limit will be run in a nested directory.')
+            run_dir = _runDirSetup(self.tag+'/'+subtag)
+            # Cards are written here since the Ledger objects cannot be sent to other processes
+            if isinstance(selection, tuple):
+                selection = self.ledger.select(selection[0], *selection[1:])
+            if selection != None:
+                MakeCard(selection, run_dir, workspaceDir)
+
+            limit_jobs.append({
+                'subtag': subtag, 'run_dir': run_dir,
+                'blindData': blindData, 'verbosity': verbosity, 'setParams': setParams,
+                'rebuildWorkspace': not self.options.cacheWorkspaces
+            })
+
+        summary = run_limit_jobs(limit_jobs, self.options.nCores if nCores == None else nCores)
+        summary.to_csv(self.tag+'/limits_summary.csv')
+        print (summary.to_string())
+        return summary
+
+    def Impacts(self, subtag, rMin=-15, rMax=15, cardOrW='initialFitWorkspace.root --snapshotName initialFit', defMinStrat=0, extra='',
+                      nCores=None, resume=False):
+        '''Impacts of all systematics with combineTool.py. The initial fit runs first and then the fit for each
+        nuisance parameter runs in a pool of `nCores` local processes (defaults to the `nCores` option), each in its
+        own scratch directory (`impacts/<parameter>/`). The outputs are moved back to `<tag>/<subtag>/` and
+        merged into impacts.json. The wall time of each fit is saved to impacts_timing.csv.
+
+        If any parameter fit fails, nothing is merged (so no parameter is silently missing from impacts.json).
+        Check the logs of the failed fits and call again with `resume=True` to only rerun those fits.
+
+        Args:
+            resume (bool, optional): Keep the outputs of a previous (ex. interrupted or partly failed) call and only run
+                the initial fit and the parameter fits that do not have outputs yet. Defaults to False.
+
+        Raises:
+            RuntimeError: If any of the parameter fits failed.
+        '''
         # param_str = '' if setParams == {} else '--setParameters '+','.join(['%s=%s'%(p,v) for p,v in setParams.items()])
         with cd(self.tag+'/'+subtag):
             subset = LoadLedger('')
-            impact_nuis_str = '--named='+','.join(subset.GetAllSystematics())
-            if cardOrW.endswith('.txt'):
-                execute_cmd('text2workspace.py -b %s -o prefitWorkspace.root --channel-masks --X-no-jmax'%cardOrW)
-                card_or_w = 'prefitWorkspace.root'
-            else:
-                card_or_w = cardOrW
+            params = subset.GetAllSystematics()
+            impact_nuis_str = '--named='+','.join(params)
+            card_or_w = self._compiledWorkspace(cardOrW)
 
             base_opts = [
                 '-M Impacts', '--rMin %s'%rMin,
@@ -628,17 +862,27 @@ class TwoDAlphabet:
                 impact_nuis_str, extra #param_str,
                 # '-t -1 --bypassFrequentistFit' if blindData else ''
             ]
-            # Remove old runs if they exist
-            execute_cmd('rm *_paramFit_*.root *_initialFit_*.root')
+            if not resume:
+                # Remove old runs if they exist
+                execute_cmd('rm -r *_paramFit_*.root *_initialFit_*.root impacts/')
             # Step 1
-            execute_cmd('combineTool.py %s --doInitialFit'%(' '.join(base_opts)))
-            # Dumb hack - combineTool --doFits will go looking for the wrong file if you run on a toy
-            _combineTool_impacts_fix('higgsCombine_initialFit_Test.MultiDimFit.mH0.root')
+            if not os.path.exists('higgsCombine_initialFit_Test.MultiDimFit.mH0.root'):
+                execute_cmd('combineTool.py %s --doInitialFit'%(' '.join(base_opts)))
+                # Dumb hack - combineTool --doFits will go looking for the wrong file if you run on a toy
+                _combineTool_impacts_fix('higgsCombine_initialFit_Test.MultiDimFit.mH0.root')
             
-            # Step 2
-            execute_cmd('combineTool.py %s --doFits'%(' '.join(base_opts)))
-            # Dumb hack - combineTool next step will go looking for the wrong file if you run on a toy
-            _combineTool_impacts_fix('higgsCombine_paramFit_Test_*.MultiDimFit.mH0.root')
+            # Step 2 - one scratch directory per parameter so that the renaming (see _combineTool_impacts_fix) does not race
+            jobs = []
+            for param in params:
+                param_opts = [o for o in base_opts if o not in [impact_nuis_str, '-d %s'%card_or_w]]
+                jobs.append({
+                    'param': param, 'scratch': 'impacts/'+param,
+                    'cmd': 'combineTool.py %s -d ../../%s --named=%s --doFits'%(' '.join(param_opts), card_or_w, param)
+                })
+            timing = run_impact_fits(jobs, self.options.nCores if nCores == None else nCores)
+            timing.to_csv('impacts_timing.csv')
+            print (timing.to_string())
+            check_impact_fits(timing)
 
             # Grab the output
             execute_cmd('combineTool.py %s -o impacts.json'%(' '.join(base_opts)))
@@ -647,33 +891,77 @@ class TwoDAlphabet:
 class Ledger():
     def __init__(self, df):
         self.df = df
-        self.alphaObjs = pandas.DataFrame(columns=['process','region','obj','norm','process_type','color','combine_idx','title'])
+        self.alphaObjs = pandas.DataFrame(columns=['process','region','owner','obj','norm','process_type','color','combine_idx','title'])
         self.alphaParams = pandas.DataFrame(columns=['name','constraint','owner'])
+        self.alphaFuncs = pandas.DataFrame(columns=['name','formula','forcePositive','params','nominal','owner'])
+        self._syst_effects = None
+        self._syst_parent = None # (parent Ledger, mask of its df) for subsets (see _systEffects)
 
     def append(self, toAppend):
         self.df.append(toAppend, ignore_index=True if isinstance(toAppend, dict) else False)
 
     def select(self,f,*args):
-        def _kept_owner(row, owner_names):
-            if row.owner in owner_names:
-                return True
-            else:
-                return False
-
-        eval_lambda = lambda row: f(row,args)
-        df = self.df.loc[self.df.apply(eval_lambda, axis=1)]
-        new_ledger = Ledger(df)
-        new_ledger.alphaObjs = self.alphaObjs.loc[self.alphaObjs.apply(eval_lambda, axis=1)]
-        owner_names = new_ledger.alphaObjs.apply(lambda owner_row: owner_row.process+'_'+owner_row.region, axis=1).to_list()
-
-        new_ledger.alphaParams = self.alphaParams.loc[ # Keep params if owner object was kept
-                                        self.alphaParams.apply(
-                                            lambda row: _kept_owner(row, owner_names),
-                                            axis=1
-                                        )
-                                    ]
+        '''Make a subset of the Ledger with the rows (of the histograms and alphabet objects)
+        for which `f(row,args)` is True. The alphabet parameters are kept if their owner is kept.
+
+        `f` is evaluated row by row. If it is marked with vectorized_selection() (so it can be evaluated on
+        a whole DataFrame at once, ex. `vectorized_selection(lambda df,args: df.region.eq(args[0]))`),
+        it is instead called once per table to get a boolean mask. For common selections, see query().
+
+        Args:
+            f (function): Function of the row (pandas.Series) and `args` which returns a bool
+                (or of the DataFrame and `args` which returns a boolean Series if marked with vectorized_selection()).
+            *args: Extra arguments passed to `f` as a tuple.
+
+        Returns:
+            Ledger: Subset.
+        '''
+        return self._subset(_selection_mask(self.df,f,args), _selection_mask(self.alphaObjs,f,args))
+
+    def query(self, process=None, process_regex=None, process_type=None, region=None, region_regex=None, variation=None, scope=None):
+        '''Make a subset of the Ledger from vectorized selections on the histograms and alphabet objects.
+        Each argument that is not None is a requirement and all requirements must pass for a row to be kept.
+        The alphabet parameters are kept if their owner is kept.
+
+        If `scope` is given, only the rows of those process types need to pass the requirements and
+        the rest are always kept. For example, picking one signal and one transfer function option
+        while keeping everything else:
+            ::
+
+                subset = ledger.query(process_regex='MX_2000_MY_800', scope='SIGNAL').query(process_regex='^(?!Background_)|^Background_0x0$')
+
+        Args:
+            process (str or list(str), optional): Process name(s) to keep. Defaults to None.
+            process_regex (str, optional): Regex that the process name must contain (see re.search). Defaults to None.
+            process_type (str or list(str), optional): Process type(s) to keep (SIGNAL, BKG, DATA). Defaults to None.
+            region (str or list(str), optional): Region name(s) to keep. Defaults to None.
+            region_regex (str, optional): Regex that the region name must contain. Defaults to None.
+            variation (str or list(str), optional): Systematic variation(s) to keep (including "nominal").
+                Does not apply to the alphabet objects. Defaults to None.
+            scope (str or list(str), optional): Process type(s) which the requirements apply to. Defaults to None (all).
+
+        Returns:
+            Ledger: Subset.
+        '''
+        criteria = dict(process=process, process_regex=process_regex, process_type=process_type,
+                        region=region, region_regex=region_regex, variation=variation, scope=scope)
+        return self._subset(_query_mask(self.df,**criteria), _query_mask(self.alphaObjs,**criteria))
+
+    def _subset(self, df_mask, alpha_mask):
+        new_ledger = Ledger(self.df.loc[df_mask])
+        if 'syst_type' in self.df.columns: # evaluated for the parent (once) if the subset needs them
+            new_ledger._syst_parent = (self, df_mask)
+        new_ledger.alphaObjs = self.alphaObjs.loc[alpha_mask]
+        # Keep params if owner object was kept
+        new_ledger.alphaParams = self.alphaParams.loc[self.alphaParams.owner.isin(new_ledger._alphaOwners())]
+        new_ledger.alphaFuncs = self.alphaFuncs.loc[self.alphaFuncs.owner.isin(new_ledger._alphaOwners())]
         return new_ledger
 
+    def _alphaOwners(self):
+        if 'owner' in self.alphaObjs.columns and not self.alphaObjs.owner.isnull().any():
+            return self.alphaObjs.owner
+        return self.alphaObjs.process+'_'+self.alphaObjs.region # ledgers saved before the owner column existed
+
     def GetRegions(self):
         return list(self.df.region.unique())
 
@@ -769,9 +1057,31 @@ class Ledger():
         out = pandas.concat([signal_map, bkg_map])
         return out
 
+    def _systEffects(self):
+        '''Card entry (the value in the column named by `syst_type`, ex. lnN) of each
+        systematic variation row of the histogram table. Evaluated once per Ledger, on the first call.
+        Subsets made by select() and query() take their entries from those of the parent.
+
+        Returns:
+            pandas.Series: Card entries in the same order as the non-nominal rows of `df`.
+        '''
+        if self._syst_effects is None and self._syst_parent != None:
+            parent, df_mask = self._syst_parent
+            self._syst_effects = parent._systEffects().loc[df_mask.values[parent.df.variation.ne('nominal').values]]
+            self._syst_parent = None
+        elif self._syst_effects is None:
+            systs = self.df.loc[self.df.variation.ne('nominal')]
+            effects = pandas.Series(index=systs.index, dtype=object)
+            for syst_type in systs.syst_type.unique():
+                is_type = systs.syst_type.eq(syst_type)
+                effects.loc[is_type] = systs.loc[is_type, syst_type].astype(object)
+            self._syst_effects = effects
+        return self._syst_effects
+
     def _saveAlphas(self,outDir=''):
         self.alphaObjs.to_csv(outDir+'/ledger_alphaObjs.csv')
         self.alphaParams.to_csv(outDir+'/ledger_alphaParams.csv')
+        self.alphaFuncs.to_csv(outDir+'/ledger_alphaFuncs.csv')
 
     def Save(self, outDir):
         if 'index' in self.df.columns:
@@ -784,11 +1094,59 @@ class Ledger():
 
         self._saveAlphas(outDir)
 
+def _as_list(x):
+    return [x] if isinstance(x, str) else list(x)
+
+def vectorized_selection(f):
+    '''Mark a selection function for Ledger.select() as one that takes the full DataFrame
+    (instead of one row) and returns a boolean Series. Can be used as a decorator.
+
+    Args:
+        f (function): Function of the DataFrame and the selection arguments.
+
+    Returns:
+        function: `f`.
+    '''
+    f.vectorized = True
+    return f
+
+def _selection_mask(df, f, args):
+    '''Boolean mask of the rows of `df` passing `f(row,args)`. Functions marked with
+    vectorized_selection() are evaluated on the full DataFrame and are only applied row
+    by row if that fails (with a TypeError, ValueError, or AttributeError) or does not
+    return a boolean Series aligned with `df`.'''
+    if df.empty:
+        return pandas.Series([], index=df.index, dtype=bool)
+    mask = None
+    if getattr(f, 'vectorized', False):
+        try:
+            mask = f(df,args)
+        except (TypeError, ValueError, AttributeError) as e:
+            print ('WARNING: Selection %s could not be evaluated on the full table (%s). Applying it row by row.'%(getattr(f,'__name__',f), e))
+    if not (isinstance(mask, pandas.Series) and mask.dtype == bool and mask.index.equals(df.index)):
+        mask = df.apply(lambda row: f(row,args), axis=1).astype(bool)
+    return mask
+
+def _query_mask(df, process=None, process_regex=None, process_type=None, region=None, region_regex=None, variation=None, scope=None):
+    '''Boolean mask of the rows of `df` passing the requirements of Ledger.query().'''
+    mask = pandas.Series(True, index=df.index)
+    if process != None:       mask &= df.process.isin(_as_list(process))
+    if process_regex != None: mask &= df.process.astype(str).str.contains(process_regex, regex=True)
+    if process_type != None:  mask &= df.process_type.isin(_as_list(process_type))
+    if region != None:        mask &= df.region.isin(_as_list(region))
+    if region_regex != None:  mask &= df.region.astype(str).str.contains(region_regex, regex=True)
+    if variation != None and 'variation' in df.columns:
+        mask &= df.variation.isin(_as_list(variation))
+    if scope != None:         mask |= ~df.process_type.isin(_as_list(scope))
+    return mask
+
 def LoadLedger(indir=''):
     df = pandas.read_csv(indir+'ledger_df.csv', index_col=0)
     ledger = Ledger(df)
     ledger.alphaObjs = pandas.read_csv(indir+'ledger_alphaObjs.csv', index_col=0)
     ledger.alphaParams = pandas.read_csv(indir+'ledger_alphaParams.csv', index_col=0)
+    if os.path.exists(indir+'ledger_alphaFuncs.csv'): # not saved by older versions
+        ledger.alphaFuncs = pandas.read_csv(indir+'ledger_alphaFuncs.csv', index_col=0)
 
     return ledger
 
@@ -806,10 +1164,24 @@ def _runDirSetup(runDir):
     
     return runDir
 
+def _toyEngineArgs(card_or_w, **kwargs):
+    '''Arguments for the ToyEngine from a workspace (possibly followed by `--snapshotName <name>`).'''
+    snapshot = re.search(r'--snapshotName\s+(\S+)', card_or_w)
+    kwargs.update({'workspaceFile': card_or_w.split()[0], 'snapshot': snapshot.group(1) if snapshot else None})
+    return kwargs
+
+def _adaptiveOptions(adaptive):
+    '''Split the `adaptive` options of GoodnessOfFit and SignalInjection into those for run_adaptive() and for the stopping rule.'''
+    scheduler_keys = ['batchSize','minToys']
+    return ({k:v for k,v in adaptive.items() if k in scheduler_keys},
+            {k:v for k,v in adaptive.items() if k not in scheduler_keys})
+
 def MakeCard(ledger, subtag, workspaceDir):
     combine_idx_map = ledger._getCombineIdxMap()
-    
-    
+    combine_idx_map = dict(zip(combine_idx_map.process[::-1], combine_idx_map.combine_idx[::-1])) # first entry per process wins
+    alpha_procs = set(ledger.alphaObjs.process.unique())
+    skip_proc = lambda proc: '1_area' in subtag and '_10' in proc # keep 10 TeV signals out of 1 TeV signal data card
+
     card_new = open('%s/card.txt'%subtag,'w')
     # imax (bins), jmax (backgrounds+signals), kmax (systematics) 
     imax = 3*len(ledger.GetRegions()) # pass, fail for each 'X' axis category    
@@ -830,15 +1202,11 @@ def MakeCard(ledger, subtag, workspaceDir):
     
     alpha_obj_title_map = {}
     for proc,reg in ledger.GetProcRegPairs():
-        
-        if '1_area' in subtag:
-            if '_10' in proc: continue
-            
+        if skip_proc(proc): continue
         
         for cat in ['LOW','SIG','HIGH']:
-            if proc in ledger.alphaObjs.process.unique():
+            if proc in alpha_procs:
                 this_line = shape_line.replace(' w:{p}_{r}_$SYSTEMATIC','').replace('w:{p}','w:{hname_proc}')
-                title = ledger.alphaObjs[ledger.alphaObjs.process.eq(proc) & ledger.alphaObjs.region.eq(reg)].title.iloc[0]
                 alpha_obj_title_map[(proc,reg)] = proc
                 card_new.write(this_line.format(p=proc, r=reg+'_'+cat, file=workspaceDir+'base.root', hname_proc=proc))
             elif proc == 'data_obs':
@@ -866,29 +1234,29 @@ def MakeCard(ledger, subtag, workspaceDir):
     rate_line        = '{0:20} {1:20}'.format('rate','')
     syst_lines = OrderedDict()
 
+    # One table of (process, region) x systematic with the card entries (or '-' if the process does not have the systematic)
+    syst_rows = ledger.df.loc[ledger.df.variation.ne('nominal'), ['process','region','variation','syst_type']]
+    syst_table = {}
+    if not syst_rows.empty:
+        syst_table = syst_rows.assign(effect=ledger._systEffects().values).drop_duplicates(['process','region','variation'])
+        syst_table = syst_table.set_index(['process','region','variation']).effect.unstack('variation').astype(object)
+        syst_table = syst_table.where(syst_table.notnull(), '-').to_dict('index')
+
     # Fill syst_lines with keys to initialized strings
-    for syst,syst_group in ledger.df.groupby(by='variation',sort=True):
-        if syst == 'nominal': continue
-        syst_type = syst_group.iloc[0].syst_type
-        syst_lines[syst] = '{0:20} {1:20} '.format(syst, syst_type)
+    syst_types = syst_rows.drop_duplicates('variation').set_index('variation').syst_type
+    for syst in sorted(syst_types.index):
+        syst_lines[syst] = '{0:20} {1:20} '.format(syst, syst_types[syst])
 
     # Work with template bkgs first
-    for pair, group in ledger.df.groupby(['process','region']):
-        
-        proc, region = pair
-        
-        if proc == 'data_obs': continue
-                
-        if '1_area' in subtag:
-            if '_10' in proc: continue
-            
-            
-            
-        combine_idx = combine_idx_map[combine_idx_map.process.eq(proc)].combine_idx.iloc[0]
-        
+    for proc, region in sorted(set(zip(ledger.df.process, ledger.df.region))):
+        if proc == 'data_obs' or skip_proc(proc): continue
+
+        combine_idx = combine_idx_map[proc]
         if '1_area' in subtag:
             if '_1' in proc: combine_idx += 1
 
+        proc_effects = syst_table.get((proc,region), {})
+
         for cat in ['LOW','SIG','HIGH']:
             chan = '%s_%s'%(region,cat)
 
@@ -898,29 +1266,15 @@ def MakeCard(ledger, subtag, workspaceDir):
             rate_line += '{0:20} '.format('-1')
 
             for syst in syst_lines.keys():
-                if syst in group.variation.unique():
-                    syst_effect = group.loc[group.variation.eq(syst)].apply(lambda row: row[row.syst_type],axis=1).iloc[0]
-                else:
-                    syst_effect = '-'
-
-                syst_lines[syst] += '{0:20} '.format(syst_effect)
-
+                syst_lines[syst] += '{0:20} '.format(proc_effects.get(syst,'-'))
 
     # Now work with alpha objects
     # NOTE: duplicated code but no good way to combine without making things confusing
-    
-    isCentral = False
-    
-    for pair,group in ledger.alphaObjs.groupby(['process', 'region']):
+    for pair in sorted(set(zip(ledger.alphaObjs.process, ledger.alphaObjs.region))):
         proc,region = pair
+        if skip_proc(proc): continue
         
-        if 'cen' in region:
-            isCentral = True
-        
-        if '1_area' in subtag:
-            if '_10' in proc: continue
-        
-        combine_idx = combine_idx_map[combine_idx_map.process.eq(alpha_obj_title_map[pair])].combine_idx.iloc[0]
+        combine_idx = combine_idx_map[alpha_obj_title_map[pair]]
         
         for cat in ['LOW','SIG','HIGH']:
             chan = '%s_%s'%(region, cat)
@@ -932,8 +1286,6 @@ def MakeCard(ledger, subtag, workspaceDir):
 
             for syst in syst_lines.keys():
                 syst_lines[syst] += '{0:20} '.format('-')
-                
-                
 
     card_new.write(bin_line+'\n')
     card_new.write(processName_line+'\n')
@@ -952,18 +1304,7 @@ def MakeCard(ledger, subtag, workspaceDir):
     ######################################################
     for param in ledger.alphaParams.itertuples():
         card_new.write('{0:40} {1}\n'.format(param.name, param.constraint))
-       
-    
 
-        
-    new_proc = ''
-    for proc,reg in ledger.GetProcRegPairs():
-        
-        # keep 10 TeV signals out of 1 TeV signal data card
-        if '1_area' in subtag:
-            if '_10' in proc: continue
-        
-    
     card_new.close()
     ledger.Save(subtag)
 
@@ -977,9 +1318,12 @@ def _runMLfit(cardOrW, blinding, verbosity, rMin, rMax, setParams, usePreviousFi
     '''
     if defMinStrat not in [0, 1, 2]:
 	raise RuntimeError("Invalid cminDefaultMinimizerStrategy passed ({}) - please ensure that defMinStrat = 0, 1, or 2".format(defMinStrat))
-    if usePreviousFit: param_options = ''
-    else:              param_options = '--text2workspace "--channel-masks" '
-    params_to_set = ','.join(['mask_%s_SIG=1'%r for r in blinding]+['%s=%s'%(p,v) for p,v in setParams.items()]+['r=1'])
+    if usePreviousFit or not cardOrW.endswith('.txt'): param_options = ''
+    else:                                               param_options = '--text2workspace "--channel-masks" '
+    # The POI may be redefined (ex. by TwoDAlphabet.MasterSignalOptions())
+    poi = re.search(r'--redefineSignalPOIs\s+([^\s,]+)', extra)
+    poi = poi.group(1) if poi else 'r'
+    params_to_set = ','.join(['mask_%s_SIG=1'%r for r in blinding]+['%s=%s'%(p,v) for p,v in setParams.items()]+['%s=1'%poi])
     param_options += '--setParameters '+params_to_set
 
     fit_cmd = 'combine -M FitDiagnostics {card_or_w} {param_options} --saveWorkspace --cminDefaultMinimizerStrategy {defMinStrat} --rMin {rmin} --rMax {rmax} -v {verbosity} {extra}'
@@ -1001,20 +1345,23 @@ def _runMLfit(cardOrW, blinding, verbosity, rMin, rMax, setParams, usePreviousFi
 
     execute_cmd(fit_cmd, out='FitDiagnostics.log')
 
-def _runLimit(blindData, verbosity, setParams, card_or_w='card.txt', condor=False):
+def _limitCmd(blindData, verbosity, setParams, card_or_w='card.txt'):
     # card_or_w could be `morphedWorkspace.root --snapshotName morphedModel`
     param_options = ''
     if len(setParams) > 0:
         param_options = '--setParameters '+','.join('%s=%s'%(k,v) for k,v in setParams.items())
 
     limit_cmd = 'combine -M AsymptoticLimits -d {card_or_w} --saveWorkspace --cminDefaultMinimizerStrategy 0 {param_opt} {blind_opt} -v {verb}' 
-    limit_cmd = limit_cmd.format(
+    return limit_cmd.format(
         card_or_w=card_or_w,
         blind_opt='--run=blind' if blindData else '',
         param_opt=param_options,
         verb=verbosity
     )
 
+def _runLimit(blindData, verbosity, setParams, card_or_w='card.txt', condor=False):
+    limit_cmd = _limitCmd(blindData, verbosity, setParams, card_or_w)
+
     # Run combine if not on condor
     if not condor:   
         with open('Limit_command.txt','w') as out:
@@ -1023,6 +1370,162 @@ def _runLimit(blindData, verbosity, setParams, card_or_w='card.txt', condor=Fals
 
     return limit_cmd
 
+_limit_columns = ['obs','exp-2','exp-1','exp0','exp+1','exp+2']
+_limit_log_labels = {
+    'Observed Limit': 'obs',
+    '2.5': 'exp-2',
+    '16.0': 'exp-1',
+    '50.0': 'exp0',
+    '84.0': 'exp+1',
+    '97.5': 'exp+2'
+}
+
+def _parseLimits(logfile):
+    '''Read the limits printed by `combine -M AsymptoticLimits` from its log.
+
+    Args:
+        logfile (str): Path to the log.
+
+    Returns:
+        dict: Map of the limit (obs, exp-2, exp-1, exp0, exp+1, exp+2) to its value. Missing limits are NaN.
+    '''
+    out = {c:numpy.nan for c in _limit_columns}
+    if not os.path.exists(logfile):
+        return out
+
+    with open(logfile) as f:
+        for line in f:
+            match = re.match(r'\s*(?:Expected\s+([\d.]+)%|(Observed Limit)):\s*r\s*<\s*(\S+)', line)
+            if match:
+                label = match.group(1) if match.group(1) else match.group(2)
+                if label in _limit_log_labels:
+                    out[_limit_log_labels[label]] = float(match.group(3))
+    return out
+
+def _runLimitJob(job):
+    '''Make (or reuse, see build_workspace()) the workspace and the limit for one job
+    of TwoDAlphabet.RunLimits() from the card.txt in `job['run_dir']`. Runs entirely in `job['run_dir']` via execute_cmd_in()
+    so that several jobs can run at once.
+
+    Args:
+        job (dict): Job information (see TwoDAlphabet.RunLimits()).
+
+    Returns:
+        dict: Subtag, return code, and limits.
+    '''
+    run_dir = job['run_dir']
+    for log in ['text2workspace.log','Limit.log']:
+        if os.path.exists(run_dir+'/'+log):
+            os.remove(run_dir+'/'+log)
+
+    try:
+        workspace = build_workspace(run_dir+'/card.txt', rebuild=job.get('rebuildWorkspace',False))
+    except RuntimeError as e:
+        print (e)
+        returncode = 1
+    else:
+        limit_cmd = _limitCmd(job['blindData'], job['verbosity'], job['setParams'], workspace)
+        with open(run_dir+'/Limit_command.txt','w') as out:
+            out.write(limit_cmd)
+        returncode = execute_cmd_in(limit_cmd, run_dir, 'Limit.log')
+
+    out = {'subtag': job['subtag'], 'returncode': returncode}
+    out.update(_parseLimits(run_dir+'/Limit.log'))
+    return out
+
+def run_limit_jobs(jobs, nCores=1):
+    '''Run _runLimitJob() for each job in a pool of `nCores` processes.
+
+    Args:
+        jobs (list(dict)): Job information (see TwoDAlphabet.RunLimits()).
+        nCores (int, optional): Number of jobs to run at once. Defaults to 1 (serial).
+
+    Returns:
+        pandas.DataFrame: One row per job (in the input order) with the subtag, return code, and limits.
+    '''
+    if nCores > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nCores,len(jobs)))
+        try:
+            results = pool.map(_runLimitJob, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_runLimitJob(job) for job in jobs]
+
+    return pandas.DataFrame(results, columns=['subtag','returncode']+_limit_columns)
+
+def _impactFitOutput(param):
+    return 'higgsCombine_paramFit_Test_%s.MultiDimFit.mH0.root'%param
+
+def _runImpactFit(job):
+    '''Run the fit for one parameter of TwoDAlphabet.Impacts() in `job['scratch']` (streaming the output to impact_fit.log there)
+    and move the output to the current directory. Skipped if the output already exists. The initial fit
+    from the current directory is linked into `job['scratch']` since combineTool.py looks for it there.
+
+    Args:
+        job (dict): Parameter name, scratch directory, and combineTool.py command.
+
+    Returns:
+        dict: Parameter name, return code, whether it was skipped, and the wall time in seconds.
+    '''
+    output = _impactFitOutput(job['param'])
+    if os.path.exists(output):
+        return {'param': job['param'], 'returncode': 0, 'skipped': True, 'seconds': 0.0}
+
+    if not os.path.exists(job['scratch']):
+        os.makedirs(job['scratch'])
+    initial_fit = 'higgsCombine_initialFit_Test.MultiDimFit.mH0.root'
+    if os.path.exists(initial_fit) and not os.path.lexists(os.path.join(job['scratch'], initial_fit)):
+        os.symlink(os.path.relpath(initial_fit, job['scratch']), os.path.join(job['scratch'], initial_fit))
+    start = time.time()
+    returncode = execute_cmd_in(job['cmd'], job['scratch'], 'impact_fit.log')
+    _combineTool_impacts_fix(os.path.join(job['scratch'], output))
+    if os.path.exists(os.path.join(job['scratch'], output)):
+        os.rename(os.path.join(job['scratch'], output), output)
+    elif returncode == 0:
+        returncode = 1
+
+    return {'param': job['param'], 'returncode': returncode, 'skipped': False, 'seconds': time.time()-start}
+
+def run_impact_fits(jobs, nCores=1):
+    '''Run _runImpactFit() for each job in a pool of `nCores` processes.
+
+    Args:
+        jobs (list(dict)): Job information (see TwoDAlphabet.Impacts()).
+        nCores (int, optional): Number of fits to run at once. Defaults to 1 (serial).
+
+    Returns:
+        pandas.DataFrame: One row per parameter (in the input order) with the return code, whether it was skipped, and the wall time.
+    '''
+    if nCores > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nCores,len(jobs)))
+        try:
+            results = pool.map(_runImpactFit, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_runImpactFit(job) for job in jobs]
+
+    return pandas.DataFrame(results, columns=['param','returncode','skipped','seconds'])
+
+def check_impact_fits(timing, scratch='impacts/'):
+    '''Check the results of run_impact_fits() before the outputs are merged.
+
+    Args:
+        timing (pandas.DataFrame): Output of run_impact_fits().
+        scratch (str, optional): Directory with the scratch directory of each parameter. Defaults to 'impacts/'.
+
+    Raises:
+        RuntimeError: If any fit has a non-zero return code. The message lists the failed parameters
+            and their logs.
+    '''
+    failed = timing.loc[timing.returncode.ne(0)].param.to_list()
+    if len(failed) > 0:
+        raise RuntimeError('Impact fits failed for %s parameter(s). Check the logs and rerun with resume=True to only redo these fits:\n\t%s'%(
+            len(failed), '\n\t'.join('%s (%s%s/impact_fit.log)'%(p,scratch,p) for p in failed)))
+
 def get_process_attr(df, procName, attrName):
     return df.loc[df.process.eq(procName)][attrName].iloc[0]
 
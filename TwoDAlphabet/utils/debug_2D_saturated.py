@@ -3,6 +3,7 @@ per-bin over the full 2D space.'''
 
 import sys,os,ROOT,math,array
 import header
+from TwoDAlphabet.binning import stitch_hist_arrays, set_hist_arrays
 
 def stitchHists(name,thisHistList,blinded=[]):
     # Required that thisHistList be in order of desired stitching
@@ -24,20 +25,8 @@ def stitchHists(name,thisHistList,blinded=[]):
     aybins = array.array('d',ybins)
     stitched_hist = ROOT.TH2F(name,name,len(xbins)-1,axbins,len(ybins)-1,aybins)
 
-    bin_jump = 0
-    for i,h in enumerate(thisHistList):
-        if i in blinded:
-            bin_jump += thisHistList[i].GetNbinsX()
-            continue
-        
-        for ybin in range(1,h.GetNbinsY()+1):
-            for xbin in range(1,h.GetNbinsX()+1):
-                stitched_xindex = xbin + bin_jump
-
-                stitched_hist.SetBinContent(stitched_xindex,ybin,h.GetBinContent(xbin,ybin))
-                stitched_hist.SetBinError(stitched_xindex,ybin,h.GetBinError(xbin,ybin))
-
-        bin_jump += thisHistList[i].GetNbinsX()
+    content, errors = stitch_hist_arrays(thisHistList,blinded)
+    set_hist_arrays(stitched_hist,content,errors)
 
     return stitched_hist
 
@@ -281,6 +281,20 @@ def test_limit(SRorCR):
             condor=False
         )
 
+def test_limits_parallel(SRorCR, nCores=4):
+    '''Same as test_limit() but the limits for all of the signals are run in a pool
+    of `nCores` local processes, each in its own `<signame>_area` directory. The limits
+    are collected into a summary table (also saved to limits_summary.csv in the working area).
+    '''
+    poly_order = '0x0'
+    params_to_set = _load_CR_rpf_as_SR(poly_order) if SRorCR == 'SR' else _load_CR_rpf(poly_order)
+    working_area = 'XHYfits_'+SRorCR
+    twoD = TwoDAlphabet(working_area, '%s/runConfig.json'%working_area, loadPrevious=True)
+
+    jobs = [(signame[:-3]+'_area', (_select_signal, signame[:-3], poly_order)) for signame in twoD.iterWorkspaceObjs['SIGNAME']]
+    summary = twoD.RunLimits(jobs, nCores=nCores, blindData=True, setParams=params_to_set)
+    return summary
+
 def test_GoF(SRorCR):
     '''Perform a Goodness of Fit test using an existing working area.
     Requires using data so SRorCR is enforced to be 'CR' to avoid accidental unblinding.
@@ -0,0 +1,70 @@
+'''Benchmark Config.FullTable() on synthetic configs of increasing size.
+Each config has NSIG signals and 3 eras (GLOBAL lists substituted into the
+process names) and NSYST shape systematics per process. The number of rows
+in the final table and the time to build it are reported for each size.
+
+Run from the top of the repository:
+    python test/benchmarks/bench_config_table.py [-s NSIG,NSIG,...] [-u NSYST]
+'''
+import json, os, shutil, sys, tempfile, time
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+from TwoDAlphabet.config import Config
+
+def _make_config(nsig,nsyst):
+    systs = ['syst%s'%i for i in range(nsyst)]
+    config = {
+        'GLOBAL': {
+            'SIGNAME': ['MX_%s'%(1000+100*i) for i in range(nsig)],
+            'ERA': ['16','17','18'],
+            'FILE': 'THselection_$process.root',
+            'FILE_UP': 'THselection_$process_$syst_up.root',
+            'FILE_DOWN': 'THselection_$process_$syst_down.root',
+            'HIST': 'MthvMh_$region__nominal',
+            'HIST_UP': 'MthvMh_$region__$syst_up',
+            'HIST_DOWN': 'MthvMh_$region__$syst_down',
+            'path': 'test/data'
+        },
+        'NAME': 'bench',
+        'OPTIONS': {},
+        'PROCESSES': {
+            'data_obs': {'SYSTEMATICS': [], 'SCALE': 1.0, 'COLOR': 1, 'TYPE': 'DATA', 'TITLE': 'Data', 'LOC': 'path/FILE:HIST'},
+            'ttbar_ERA': {'SYSTEMATICS': ['lumi']+systs, 'SCALE': 1.0, 'COLOR': 2, 'TYPE': 'BKG', 'TITLE': 'ttbar', 'LOC': 'path/FILE:HIST'},
+            'SIGNAME_ERA': {'SYSTEMATICS': ['lumi']+systs, 'SCALE': 1.0, 'COLOR': 1, 'TYPE': 'SIGNAL', 'TITLE': 'signal', 'LOC': 'path/FILE:HIST'}
+        },
+        'REGIONS': {},
+        'SYSTEMATICS': {'lumi': {'VAL': 1.018}},
+        'BINNING': {'default': {'X': {'NAME': 'x', 'TITLE': 'x', 'BINS': [0,1,2,3], 'SIGSTART': 1, 'SIGEND': 2},
+                                'Y': {'NAME': 'y', 'TITLE': 'y', 'BINS': [0,1,2]}}}
+    }
+    for r in ['pass','fail']:
+        config['REGIONS']['SR_%s'%r] = {'PROCESSES': ['data_obs','ttbar_ERA','SIGNAME_ERA'], 'BINNING': 'default'}
+    for s in systs:
+        config['SYSTEMATICS'][s] = {'UP': 'path/FILE_UP:HIST_UP', 'DOWN': 'path/FILE_DOWN:HIST_DOWN', 'SIGMA': 1.0}
+    return config
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-s', '--signals', type='string', action='store',
+                    default   =   '1,10,50,150',
+                    dest      =   'signals',
+                    help      =   'Comma separated list of the numbers of signals')
+    parser.add_option('-u', '--systematics', type='int', action='store',
+                    default   =   20,
+                    dest      =   'nsyst',
+                    help      =   'Number of shape systematics per process')
+    (options, args) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print ('{0:>8} {1:>10} {2:>12}'.format('signals','rows','time [s]'))
+        for nsig in [int(n) for n in options.signals.split(',')]:
+            path = os.path.join(tmpdir,'bench_%s.json'%nsig)
+            with open(path,'w') as f:
+                json.dump(_make_config(nsig,options.nsyst), f)
+
+            start = time.time()
+            table = Config(path).FullTable()
+            print ('{0:8} {1:10} {2:12.3f}'.format(nsig, table.shape[0], time.time()-start))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,106 @@
+'''Benchmark ParametricFunction, which compiles its formula once and passes the
+bin centers as constants, against the original construction where the bin centers
+are substituted into a separate formula for every bin. Each transfer function
+option in example.py (`_rpf_options`) is built on an NX by NY binning and the
+model build time and the evaluation rate of a binned Poisson NLL built from the
+bins are reported.
+
+Run from the top of the repository:
+    python test/benchmarks/bench_parametric_function.py [-x NX] [-y NY] [-n NEVALS]
+'''
+import ROOT, os, random, sys, time
+from optparse import OptionParser
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+from example import _rpf_options
+from TwoDAlphabet.alphawrap import ParametricFunction, _subspace
+from TwoDAlphabet.binning import Binning
+
+class ParametricFunctionPerBin(ParametricFunction):
+    '''Original implementation with one distinct formula per bin, kept here as the reference.'''
+    def __init__(self,name,binning,formula,constraints={},forcePositive=True):
+        super(ParametricFunction,self).__init__(name,binning,forcePositive)
+        self.formula = formula
+        self.nuisances = self._createFuncVars(constraints)
+        self.arglist = ROOT.RooArgList()
+        for n in self.nuisances: self.arglist.add(n['obj'])
+
+        for cat in _subspace:
+            cat_name = name+'_'+cat
+            for ybin in range(1,len(self.binning.ybinList)):
+                for xbin in range(1,len(self.binning.xbinByCat[cat])):
+                    bin_name = '%s_bin_%s-%s'%(cat_name,xbin,ybin)
+                    xConst,yConst = self.mappedBinCenter(xbin,ybin,cat)
+                    if forcePositive: final_formula = "max(1e-9,%s)"%(self._replaceXY(xConst,yConst))
+                    else:             final_formula = self._replaceXY(xConst,yConst)
+                    self.binVars[bin_name] = ROOT.RooFormulaVar(bin_name, bin_name, final_formula, self.arglist)
+
+    def _replaceXY(self,x,y):
+        f = self.formula.replace(' ','')
+        f = f.replace('+x','+%s'%x).replace('+y','+%s'%y)
+        f = f.replace('*x','*%s'%x).replace('*y','*%s'%y)
+        f = f.replace('-x','-%s'%x).replace('-y','-%s'%y)
+        f = f.replace('/x','/%s'%x).replace('/y','/%s'%y)
+        f = f.replace('(x','(%s'%x).replace('(y','(%s'%y)
+        return f
+
+def _make_binning(nx,ny):
+    binning_dict = {
+        'X': {'NAME': 'xaxis', 'TITLE': 'X', 'MIN': 60, 'MAX': 260, 'NBINS': nx, 'SIGSTART': 100, 'SIGEND': 140},
+        'Y': {'NAME': 'yaxis', 'TITLE': 'Y', 'MIN': 800, 'MAX': 3000, 'NBINS': ny}
+    }
+    template = ROOT.TH2F('template','template',nx,60,260,ny,800,3000)
+    return Binning('bench', binning_dict, template)
+
+def _make_nll(obj):
+    '''Binned Poisson NLL (up to a constant) with "data" taken as the starting bin values.'''
+    terms, storage = ROOT.RooArgList(), []
+    for bin_name, bin_var in obj.binVars.items():
+        data = ROOT.RooConstVar(bin_name+'_data', bin_name+'_data', max(1.0, round(bin_var.getVal()*1000)))
+        term = ROOT.RooFormulaVar(bin_name+'_nll', bin_name+'_nll', '@0*1000-@1*log(@0*1000)', ROOT.RooArgList(bin_var, data))
+        terms.add(term)
+        storage.extend([data, term])
+    return ROOT.RooAddition(obj.name+'_nll', obj.name+'_nll', terms), storage
+
+def _eval_rate(obj,nevals):
+    nll, storage = _make_nll(obj)
+    params = [n['obj'] for n in obj.nuisances]
+    start = time.time()
+    for _ in range(nevals):
+        for p in params:
+            p.setVal(random.uniform(max(p.getMin(),-0.5), min(p.getMax(),0.5)))
+        nll.getVal()
+    return nevals/(time.time()-start)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-x', '--nx', type='int', action='store',
+                    default   =   60,
+                    dest      =   'nx',
+                    help      =   'Number of X bins')
+    parser.add_option('-y', '--ny', type='int', action='store',
+                    default   =   40,
+                    dest      =   'ny',
+                    help      =   'Number of Y bins')
+    parser.add_option('-n', '--nevals', type='int', action='store',
+                    default   =   200,
+                    dest      =   'nevals',
+                    help      =   'Number of NLL evaluations')
+    (options, args) = parser.parse_args()
+    ROOT.gROOT.SetBatch(True)
+    ROOT.RooMsgService.instance().setGlobalKillBelow(ROOT.RooFit.WARNING)
+    random.seed(12345)
+
+    binning = _make_binning(options.nx, options.ny)
+    print ('{0:6} {1:>14} {2:>14} {3:>8} {4:>16} {5:>16}'.format('option','per-bin [s]','compiled [s]','speedup','per-bin [NLL/s]','compiled [NLL/s]'))
+    for opt_name, opt in sorted(_rpf_options.items()):
+        start = time.time()
+        per_bin = ParametricFunctionPerBin('perbin_'+opt_name, binning, opt['form'], constraints=opt['constraints'])
+        t_per_bin = time.time()-start
+
+        start = time.time()
+        compiled = ParametricFunction('compiled_'+opt_name, binning, opt['form'], constraints=opt['constraints'])
+        t_compiled = time.time()-start
+
+        print ('{0:6} {1:14.3f} {2:14.3f} {3:8.1f} {4:16.1f} {5:16.1f}'.format(
+            opt_name, t_per_bin, t_compiled, t_per_bin/t_compiled,
+            _eval_rate(per_bin,options.nevals), _eval_rate(compiled,options.nevals)))
@@ -0,0 +1,93 @@
+'''Benchmark the array-based copy_hist_with_new_bins against the original
+bin-by-bin implementation using the histograms in test/data/.
+
+Run from the top of the repository:
+    python test/benchmarks/bench_rebinning.py [-n NREPEAT]
+'''
+import ROOT, array, glob, time
+from math import sqrt
+from optparse import OptionParser
+from TwoDAlphabet.binning import copy_hist_with_new_bins, get_bins_from_hist, get_hist_arrays
+
+def copy_hist_with_new_bins_loop(copyName,XorY,inHist,new_bins):
+    '''Original triple loop implementation, kept here as the reference.'''
+    axis_to_rebin = XorY
+    axis_to_hold = "X" if XorY=="Y" else "Y"
+    static_array = array.array('f',get_bins_from_hist(axis_to_hold,inHist))
+    static_nbins = len(static_array)-1
+    rebin_array = array.array('f',new_bins)
+    rebin_nbins = len(rebin_array)-1 
+    if XorY == "X":
+        hist_copy = ROOT.TH2F(copyName+'_temp',copyName+'_temp',rebin_nbins,rebin_array,static_nbins,static_array)
+    else:
+        hist_copy = ROOT.TH2F(copyName+'_temp',copyName+'_temp',static_nbins,static_array,rebin_nbins,rebin_array)
+    hist_copy.Sumw2()
+    old_axis = getattr(inHist,'Get%saxis'%axis_to_rebin)()
+    rebin_axis = getattr(hist_copy,'Get%saxis'%axis_to_rebin)()
+    for static_bin in range(1,static_nbins+1):
+        for rebin in range(1,rebin_nbins+1):
+            new_bin_content = 0
+            new_bin_errorsq = 0
+            new_bin_min = rebin_axis.GetBinLowEdge(rebin)
+            new_bin_max = rebin_axis.GetBinUpEdge(rebin)
+            for old_bin in range(1,old_axis.GetNbins()+1):
+                old_bin_min = old_axis.GetBinLowEdge(old_bin)
+                old_bin_max = old_axis.GetBinUpEdge(old_bin)
+                if old_bin_min >= new_bin_max:
+                    break
+                elif old_bin_min >= new_bin_min and old_bin_min < new_bin_max:
+                    if old_bin_max <= new_bin_max:
+                        if axis_to_rebin == "X":
+                            new_bin_content += inHist.GetBinContent(old_bin,static_bin)
+                            new_bin_errorsq += inHist.GetBinError(old_bin,static_bin)**2
+                        else:
+                            new_bin_content += inHist.GetBinContent(static_bin,old_bin)
+                            new_bin_errorsq += inHist.GetBinError(static_bin,old_bin)**2
+            if new_bin_content > 0:
+                if axis_to_rebin == "X":
+                    hist_copy.SetBinContent(rebin,static_bin,new_bin_content)
+                    hist_copy.SetBinError(rebin,static_bin,sqrt(new_bin_errorsq))
+                else:
+                    hist_copy.SetBinContent(static_bin,rebin,new_bin_content)
+                    hist_copy.SetBinError(static_bin,rebin,sqrt(new_bin_errorsq))
+    hist_copy.SetName(copyName)
+    return hist_copy
+
+def _time(f,nrepeat,*args):
+    start = time.time()
+    for _ in range(nrepeat):
+        out = f(*args)
+    return (time.time()-start)/nrepeat, out
+
+def _max_diff(h1,h2):
+    c1,e1 = get_hist_arrays(h1)
+    c2,e2 = get_hist_arrays(h2)
+    return max(abs(c1-c2).max(), abs(e1-e2).max())
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--nrepeat', type='int', action='store',
+                    default   =   3,
+                    dest      =   'nrepeat',
+                    help      =   'Number of times to repeat each rebinning')
+    (options, args) = parser.parse_args()
+    ROOT.gROOT.SetBatch(True)
+
+    print ('{0:60} {1:>4} {2:>10} {3:>10} {4:>8} {5:>10}'.format('histogram','axis','loop [s]','numpy [s]','speedup','max diff'))
+    total_loop, total_numpy = 0, 0
+    for fname in sorted(glob.glob('test/data/*.root')):
+        f = ROOT.TFile.Open(fname)
+        for key in f.GetListOfKeys():
+            h = key.ReadObj()
+            if not h.InheritsFrom('TH2'): continue
+            h.SetDirectory(0)
+            for axis in ['X','Y']:
+                old_bins = get_bins_from_hist(axis,h)
+                new_bins = old_bins[::2] if (len(old_bins)-1)%2 == 0 else old_bins[:-1:2]+[old_bins[-1]]
+                t_loop,  h_loop  = _time(copy_hist_with_new_bins_loop,options.nrepeat,h.GetName()+'_loop',axis,h,new_bins)
+                t_numpy, h_numpy = _time(copy_hist_with_new_bins,options.nrepeat,h.GetName()+'_numpy',axis,h,new_bins)
+                total_loop += t_loop; total_numpy += t_numpy
+                print ('{0:60} {1:>4} {2:10.4f} {3:10.4f} {4:8.1f} {5:10.2e}'.format(
+                    fname.split('/')[-1]+':'+h.GetName(), axis, t_loop, t_numpy, t_loop/t_numpy, _max_diff(h_loop,h_numpy)))
+        f.Close()
+    print ('Total: loop = %.3f s, numpy = %.3f s, speedup = %.1f'%(total_loop,total_numpy,total_loop/total_numpy if total_numpy > 0 else float('nan')))
@@ -0,0 +1,85 @@
+import numpy
+from TwoDAlphabet.alphawrap import eval_transfer_func, transfer_func_bands, _formula_to_numpy, ParametricFunction
+from TwoDAlphabet.binning import Binning
+from ROOT import TH2F, RooFormulaVar
+import pytest
+
+basedict = {
+    "X": {
+        "NAME": "xaxis",
+        "TITLE": "xaxis",
+        "MIN": 0,
+        "MAX": 24,
+        "NBINS": 12,
+        "SIGSTART": 14,
+        "SIGEND": 16
+    },
+    "Y": {
+        "NAME": "yaxis",
+        "TITLE": "yaxis",
+        "MIN": 0,
+        "MAX": 20,
+        "NBINS": 10
+    }
+}
+template = TH2F('test_alphawrap','test_alphawrap',12,0,24,10,0,20)
+binning = Binning('test_alphawrap',basedict,template)
+
+def test__formula_to_numpy():
+    assert _formula_to_numpy('0.1*(@0+@1*x)*(1+@2*y^2)') == '0.1*(p[0]+p[1]*x)*(1+p[2]*y**2)'
+
+def test_eval_transfer_func():
+    vals = eval_transfer_func('0.1*(@0+@1*x)*(1+@2*y)', binning, [1,2,3])
+    assert vals.shape == (10,12)
+    # x bin 1 center = 1 -> 1/24, y bin 3 center = 5 -> 5/20
+    assert vals[2][0] == pytest.approx(0.1*(1+2*(1./24))*(1+3*0.25))
+    assert (eval_transfer_func('0.1*(@0)', binning, [1]) == 0.1).all()
+    assert (eval_transfer_func('@0', binning, [-1]) == 1e-9).all()
+    assert (eval_transfer_func('@0', binning, [-1], forcePositive=False) == -1).all()
+    with pytest.raises(ValueError):
+        eval_transfer_func('@0*@1', binning, [1])
+
+def test_eval_transfer_func_SAMPLES():
+    samples = numpy.array([[1,0],[1,1],[2,1]])
+    vals = eval_transfer_func('@0+@1*x', binning, samples)
+    assert vals.shape == (3,10,12)
+    for i in range(3):
+        assert (vals[i] == eval_transfer_func('@0+@1*x', binning, samples[i])).all()
+
+def test_transfer_func_bands():
+    mean, rms = transfer_func_bands('@0+@1*y', binning, [[1,0],[3,0]])
+    assert (mean == 2).all()
+    assert (rms == 1).all()
+
+def _rewrite(formula, npars):
+    obj = ParametricFunction.__new__(ParametricFunction)
+    obj.formula = formula
+    obj.nuisances = [None]*npars
+    return obj._formulaWithXYArgs()
+
+def test_ParametricFunction__formulaWithXYArgs():
+    assert _rewrite('x*@0+@1', 2) == ('@2*@0+@1', True, False)
+    assert _rewrite('@0 + x*@1 + y*@2', 3) == ('@0+@3*@1+@4*@2', True, True)
+    assert _rewrite('exp(@0*x)*pow(y,@1)', 2) == ('exp(@0*@2)*pow(@3,@1)', True, True)
+    assert _rewrite('@0*y', 1) == ('@0*@1', False, True)
+    assert _rewrite('@0+@1*x', 2) == ('@0+@1*@2', True, False)
+    # Other names and parameter references are left alone
+    assert _rewrite('@0*xmax+@1*y1+max(@0,x)', 2) == ('@0*xmax+@1*y1+max(@0,@2)', True, False)
+    assert _rewrite('@1*@0', 2) == ('@1*@0', False, False)
+
+def _substituted(formula, x, y):
+    '''The original construction with the bin center substituted into the formula.'''
+    f = formula.replace(' ','')
+    for op in ['+','*','-','/','(']:
+        f = f.replace(op+'x',op+str(x)).replace(op+'y',op+str(y))
+    return 'max(1e-9,%s)'%f
+
+@pytest.mark.parametrize('formula', ['0.1*(@0+@1*x)*(1+@2*y)', '@0*exp(@1*x)+@2*y', '@0+@1*x+@2*x*x'])
+def test_ParametricFunction_SUBSTITUTION(formula):
+    name = 'pf%s'%abs(hash(formula))
+    pf = ParametricFunction(name, binning, formula)
+    for i,val in enumerate([0.7,0.3,0.2]):
+        pf.setFuncParam(i,val)
+    x, y = pf.mappedBinCenter(2,3,'SIG')
+    old = RooFormulaVar(name+'_old', name+'_old', _substituted(formula, repr(x), repr(y)), pf.arglist)
+    assert pf.getBinVar(2,3,'SIG').getVal() == pytest.approx(old.getVal())
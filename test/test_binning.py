@@ -151,6 +151,19 @@ def test_SplittingHists_VALUE():
     with pytest.raises(ValueError):
         test = stitch_hists_in_x(filled,[low,sig,high])
 
+def test__stitch_hist_arrays():
+    low = copy_hist_with_new_bins('low','X',filled,[0,2,4,6,8])
+    sig = copy_hist_with_new_bins('sig','X',filled,[8,10,12])
+    high = copy_hist_with_new_bins('high','X',filled,[12,14,16,18,20,22,24])
+    content, errors = stitch_hist_arrays([low,sig,high])
+    assert (content.shape == (12,14))
+    assert (content[1:-1,1:-1] == 1).all()
+    assert (content[0].sum() == content[-1].sum() == content[:,0].sum() == content[:,-1].sum() == 0)
+    content, errors = stitch_hist_arrays([low,sig,high],blinded=[1])
+    assert (content[1:-1,5:7] == 0).all()
+    assert (errors[1:-1,5:7] == 0).all()
+    assert (content.sum() == 10*10)
+
 def test__make_blinded_hist():
     nbins_start = filled.GetNbinsX()
     h = make_blinded_hist(filled,[8,10])
@@ -180,6 +193,30 @@ def test__copy_hist_with_new_bins_VALUE2():
     with pytest.raises(ValueError):
         h = copy_hist_with_new_bins('test','Y',template,[3,4,6,8])
 
+def test__copy_hist_with_new_bins_ERRORS():
+    h = copy_hist_with_new_bins('test','X',filled,[2,6,8])
+    assert (h.GetBinContent(1,1) == 2)
+    assert (abs(h.GetBinError(1,1) - 2**0.5) < 1e-6)
+
+def test__hist_arrays():
+    content, errors = get_hist_arrays(filled)
+    assert (content.shape == (filled.GetNbinsY()+2, filled.GetNbinsX()+2))
+    assert (content.sum() == filled.Integral())
+    assert (content[1,1] == filled.GetBinContent(1,1))
+    h = set_hist_arrays(template.Clone('arrays_test'), 2*content, 2*errors)
+    assert (h.Integral() == 2*filled.Integral())
+    assert (h.GetBinError(1,1) == 2*filled.GetBinError(1,1))
+
+def test__hist_arrays_VALUE():
+    content, errors = get_hist_arrays(filled)
+    with pytest.raises(ValueError):
+        set_hist_arrays(template.Clone('arrays_test'), content[1:], errors[1:])
+
+def test__rebin_matrix():
+    assert (rebin_matrix('X',[0,2,4,6,8],[2,6,8]).tolist() == [[0,0],[1,0],[1,0],[0,1]])
+    with pytest.raises(ValueError):
+        rebin_matrix('X',[0,2,4,6,8],[3,4,6])
+
 def test__get_min_bin_width():
     assert(get_min_bin_width(template.ProjectionY()) == 2)
 
@@ -210,4 +247,26 @@ def test__remap_to_unity():
     assert(h.GetXaxis().GetXmin() == 0)
     assert(h.GetXaxis().GetXmax() == 1)
     assert(h.GetYaxis().GetXmin() == 0)
-    assert(h.GetYaxis().GetXmax() == 1)
\ No newline at end of file
+    assert(h.GetYaxis().GetXmax() == 1)
+
+def test__slice_idxs_from_edges():
+    assert (slice_idxs_from_edges([0,2,4,6,8],[0,4,8]) == [0,2,4])
+    with pytest.raises(ValueError):
+        slice_idxs_from_edges([0,2,4,6,8],[0,3,8])
+    with pytest.raises(ValueError):
+        slice_idxs_from_edges([0,2,4,6,8],[4,0,8])
+
+def test__project_slices():
+    h = filled.Clone('project_slices_test')
+    h.SetBinContent(3,2,5)
+    content, errors = get_hist_arrays(h)
+    idxs = [0,1,4,10]
+    for axis in ['X','Y']:
+        sliceIdxs = idxs if axis == 'X' else [0,6,12]
+        proj_content, proj_errors = project_slices(content, errors, sliceIdxs, axis)
+        assert (proj_content.shape[0] == len(sliceIdxs)-1)
+        for i in range(len(sliceIdxs)-1):
+            ref = getattr(h,'Projection'+axis)('ref%s%s'%(axis,i),sliceIdxs[i]+1,sliceIdxs[i+1],'e')
+            ref_content, ref_errors = get_hist_arrays(ref)
+            assert (numpy.allclose(proj_content[i],ref_content))
+            assert (numpy.allclose(proj_errors[i],ref_errors))
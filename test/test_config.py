@@ -210,6 +210,24 @@ class TestOrganizedHist():
         with pytest.raises(NameError):
             assert self.objBase.Get(process='Data_Run2',region='CR_pass',systematic='nominal',subspace='TEST') != None
 
+    def test_Query(self):
+        assert self.objBase.Query(process='Data_Run2',region='CR_pass',subspace='SIG') == ['Data_Run2_CR_pass_SIG']
+        assert set(self.objBase.Query(process='ttbar_16',region='CR_fail',subspace='FULL',systematic=['TptReweightUp','TptReweightDown'])) == set(['ttbar_16_CR_fail_FULL_TptReweightUp','ttbar_16_CR_fail_FULL_TptReweightDown'])
+        info = self.objBase.GetInfo('ttbar_16_CR_fail_HIGH_TptReweightUp')
+        assert (info.process, info.region, info.subspace, info.systematic) == ('ttbar_16','CR_fail','HIGH','TptReweightUp')
+        assert self.objBase.BinningLookup('ttbar_16_CR_fail_HIGH_TptReweightUp') == info.binning
+        with pytest.raises(NameError):
+            self.objBase.GetInfo('FAKE')
+
+def test__expand():
+    c = Config('test/twoDtest.json')
+    c.iterWorkspaceObjs = OrderedDict([('SIGNAME',['MX_1','MX_2']),('ERA',['16','17'])])
+    assert c._expand('SIGNAME_ERA') == ('MX_1_16','MX_1_17','MX_2_16','MX_2_17')
+    assert c._expand('ttbar') == ('ttbar',)
+    assert c._expand('SIGNAME_ERA') is c._expand('SIGNAME_ERA') # memoized
+    rows = c._iterObjReplaceProducer({'PROCESS':'SIGNAME','REGION':'SR_ERA','N':1}, lambda d: (d['PROCESS'],d['REGION'],d['N']))
+    assert sorted(rows) == [('MX_1','SR_16',1),('MX_1','SR_17',1),('MX_2','SR_16',1),('MX_2','SR_17',1)]
+
 def test__keyword_replace():
     d = {'process':['ttbar'],
          'region':['SR'],
@@ -320,4 +338,114 @@ def test_config_loop_replace():
     assert config_loop_replace(config, "is", "IS")["THIS"] == "IS"
     assert "DICTIONARY" in config_loop_replace(config, "dictionary", "DICTIONARY")['a']
     with pytest.raises(TypeError):
-        config_loop_replace("dummy",1,2)
\ No newline at end of file
+        config_loop_replace("dummy",1,2)
+_binning_dict = {
+    "X": {"NAME": "xaxis", "TITLE": "xaxis", "MIN": 0, "MAX": 24, "NBINS": 12, "SIGSTART": 14, "SIGEND": 16},
+    "Y": {"NAME": "yaxis", "TITLE": "yaxis", "MIN": 0, "MAX": 20, "NBINS": 10}
+}
+
+def _make_sources(tmp_path, nfiles=2):
+    '''Source files with two finely binned, weighted histograms each.'''
+    import numpy
+    filenames = []
+    for i in range(nfiles):
+        filename = str(tmp_path/('source_%s.root'%i))
+        f = ROOT.TFile.Open(filename,'RECREATE')
+        rng = numpy.random.RandomState(i)
+        for proc in ['a','b']:
+            h = ROOT.TH2F('%s_%s'%(proc,i), '', 24, 0, 24, 20, 0, 20)
+            h.Sumw2()
+            h.GetXaxis().SetTitle('m_{X}')
+            h.GetYaxis().SetTitle('m_{Y}')
+            for x,y,w in zip(rng.uniform(0,24,500), rng.uniform(0,20,500), rng.uniform(0.5,1.5,500)):
+                h.Fill(x,y,w)
+            h.Write()
+        f.Close()
+        filenames.append(filename)
+    return filenames
+
+def _make_hist_map(filenames, scale=0.5):
+    return {filename: pandas.DataFrame([{
+                'source_histname': '%s_%s'%(proc,i), 'out_histname': '%s%s_CR_FULL'%(proc,i),
+                'process': proc+str(i), 'region': 'CR', 'systematic': '',
+                'scale': scale, 'color': i+2, 'binning': 'default'} for proc in ['a','b']])
+            for i,filename in enumerate(filenames)}
+
+def _make_binnings():
+    template = ROOT.TH2F('config_template','',24,0,24,20,0,20)
+    return {'default': Binning('default',_binning_dict,template)}
+
+def test_OrganizedHists_PARALLEL(tmp_path):
+    binnings = _make_binnings()
+    hist_map = _make_hist_map(_make_sources(tmp_path))
+    hists = {}
+    for nCores in [1,2]:
+        outdir = tmp_path/('nCores%s'%nCores)
+        outdir.mkdir()
+        hists[nCores] = OrganizedHists(str(outdir)+'/', binnings, hist_map, nCores=nCores, useCache=False)
+
+    serial, parallel = hists[1], hists[2]
+    assert serial.GetHistNames() == parallel.GetHistNames()
+    assert len(serial.GetHistNames()) == 16 # 4 FULL and their LOW, SIG, HIGH
+    for hname in serial.GetHistNames():
+        hs, hp = serial.Get(hname), parallel.Get(hname)
+        for a, b in zip(get_hist_arrays(hs), get_hist_arrays(hp)):
+            assert (a == b).all()
+        assert hs.GetEntries() == hp.GetEntries()
+        assert hs.GetXaxis().GetTitle() == hp.GetXaxis().GetTitle()
+        assert hs.GetYaxis().GetTitle() == hp.GetYaxis().GetTitle()
+        assert hs.GetFillColor() == hp.GetFillColor()
+
+def test_OrganizedHists_CACHE(tmp_path, monkeypatch):
+    import copy
+    import TwoDAlphabet.config as config
+    ingested = []
+    ingest = config._ingest_source_file
+    def _ingest(job):
+        ingested.extend(row['out_histname'] for row in job[1])
+        return ingest(job)
+    monkeypatch.setattr(config, '_ingest_source_file', _ingest)
+
+    binnings = _make_binnings()
+    filenames = _make_sources(tmp_path)
+    outdir = tmp_path/'cache'
+    outdir.mkdir()
+    outdir = str(outdir)+'/'
+    def _build(binnings, scale=0.5):
+        del ingested[:]
+        hists = OrganizedHists(outdir, binnings, _make_hist_map(filenames, scale))
+        content = {hname: get_hist_arrays(hists.Get(hname))[0] for hname in hists.GetHistNames()}
+        hists.file.Close()
+        return sorted(ingested), content
+
+    made, reference = _build(binnings)
+    assert made == ['a0_CR_FULL','a1_CR_FULL','b0_CR_FULL','b1_CR_FULL']
+
+    # Unchanged inputs are reused
+    made, content = _build(binnings)
+    assert made == []
+    assert sorted(content) == sorted(reference)
+    for hname in reference:
+        assert (content[hname] == reference[hname]).all()
+    assert not os.path.exists(outdir+'organized_hists_prev.root')
+
+    # A changed source file only remakes its own histograms
+    os.utime(filenames[0], (0,0))
+    assert _build(binnings)[0] == ['a0_CR_FULL','b0_CR_FULL']
+    # A changed scale or binning remakes everything
+    assert len(_build(binnings, scale=2.0)[0]) == 4
+    coarse = copy.deepcopy(_binning_dict)
+    coarse['Y']['NBINS'] = 5
+    binnings = {'default': Binning('default', coarse, ROOT.TH2F('config_template_coarse','',24,0,24,20,0,20))}
+    assert len(_build(binnings, scale=2.0)[0]) == 4
+
+    # A failed build leaves the previous one in place to be reused
+    def _fail(job):
+        raise IOError('Cannot read %s'%job[0])
+    monkeypatch.setattr(config, '_ingest_source_file', _fail)
+    with pytest.raises(IOError):
+        OrganizedHists(outdir, binnings, _make_hist_map(filenames, scale=3.0))
+    assert os.path.exists(outdir+'organized_hists.root')
+    assert not os.path.exists(outdir+'organized_hists_prev.root')
+    monkeypatch.setattr(config, '_ingest_source_file', _ingest)
+    assert _build(binnings, scale=2.0)[0] == []
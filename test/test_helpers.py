@@ -1,9 +1,10 @@
 
+import os, stat
 from argparse import ArgumentParser
 from typing import Type
 from ROOT import TH2F, RooArgList, RooRealVar, TH1F
 import pytest
-from TwoDAlphabet.helpers import is_filled_list, open_json, arg_dict_to_list, parse_arg_dict, make_RDH, dict_copy, nested_dict, roofit_form_to_TF1, set_hist_maximums
+from TwoDAlphabet.helpers import is_filled_list, open_json, arg_dict_to_list, parse_arg_dict, make_RDH, dict_copy, nested_dict, roofit_form_to_TF1, set_hist_maximums, build_workspace
 
 test_dict = {
     "NAME": "bare",
@@ -87,4 +88,37 @@ def test__is_filled_list():
         is_filled_list('not a dict','test_key')
     assert is_filled_list({'test_key':'test_val'},'test_key') == False
     assert is_filled_list({'test_key':[]},'test_key') == False
-    assert is_filled_list({'test_key':['test_val']},'test_key') == True
\ No newline at end of file
+    assert is_filled_list({'test_key':['test_val']},'test_key') == True
+
+def _write(path, text):
+    with open(str(path),'w') as f:
+        f.write(text)
+
+def _read(path):
+    with open(str(path)) as f:
+        return f.read()
+
+def test__build_workspace(tmp_path, monkeypatch):
+    # Stand-in for text2workspace.py which counts the number of builds
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    t2w = bindir/'text2workspace.py'
+    _write(t2w, '#!/bin/sh\necho built >> %s/builds.txt\nwhile [ $# -gt 0 ]; do\n    if [ "$1" = "-o" ]; then touch $2; fi\n    shift\ndone\n'%tmp_path)
+    t2w.chmod(t2w.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bindir)+os.pathsep+os.environ['PATH'])
+
+    _write(tmp_path/'base.root', 'base')
+    for subtag in ['a','b']:
+        (tmp_path/subtag).mkdir()
+        _write(tmp_path/subtag/'card.txt', 'shapes * * ../base.root w:$PROCESS\n')
+
+    wa = build_workspace(str(tmp_path/'a'/'card.txt'))
+    wb = build_workspace(str(tmp_path/'b'/'card.txt'))
+    assert wa == wb
+    assert os.path.dirname(wa) == str(tmp_path/'workspace_cache')
+    assert _read(tmp_path/'builds.txt').count('built') == 1
+
+    _write(tmp_path/'base.root', 'changed base')
+    assert build_workspace(str(tmp_path/'a'/'card.txt')) != wa
+    assert build_workspace(str(tmp_path/'a'/'card.txt'), '--channel-masks') != wa
+    assert _read(tmp_path/'builds.txt').count('built') == 3
@@ -0,0 +1,109 @@
+import pytest
+import numpy
+from PIL import Image
+import pandas
+from TwoDAlphabet.plot import HistCache, _plan_plot_update, make_can, _region_slice_grid
+
+class _Key(object):
+    def __init__(self, name):
+        self.name = name
+    def GetName(self):
+        return self.name
+
+class _File(object):
+    '''Stand-in for a TFile that counts the reads.'''
+    def __init__(self, names):
+        self.names = names
+        self.reads = 0
+        self.listed = 0
+    def GetName(self):
+        return 'all_plots.root'
+    def GetListOfKeys(self):
+        self.listed += 1
+        return [_Key(n) for n in self.names]
+    def Get(self, name):
+        self.reads += 1
+        return {'name': name}
+
+def test_HistCache():
+    f = _File(['a','b','c'])
+    hists = HistCache(f, maxMB=2.5/1024) # room for two objects
+    assert 'a' in hists and 'z' not in hists
+    with pytest.raises(LookupError):
+        hists.Get('z')
+
+    assert hists.Get('a') is hists.Get('a')
+    hists.Get('b')
+    hists.Get('a') # b is now the least recently used
+    hists.Get('c') # evicts b
+    assert f.reads == 3
+    hists.Get('a')
+    hists.Get('b')
+    assert f.reads == 4
+    assert f.listed == 1
+
+    stats = hists.Stats()
+    assert (stats['hits'], stats['misses'], stats['cached']) == (3, 4, 2)
+    assert stats['hit_rate'] == 3.0/7
+
+def _state(settings='s', **pairs):
+    return {'settings': settings, 'shapes': 'f',
+            'inputs': {k: v[0] for k,v in pairs.items()},
+            'styles': {k: v[1] for k,v in pairs.items()}}
+
+def test__plan_plot_update():
+    old = _state(**{'ttbar/SR': ('a','1'), 'data_obs/SR': ('b','1')})
+    pairs = ['data_obs/SR','ttbar/SR']
+    assert _plan_plot_update(None, old, pairs) == ('rebuild', pairs, [])
+    assert _plan_plot_update(old, _state('t', **{'ttbar/SR': ('a','1'), 'data_obs/SR': ('b','1')}), pairs) == ('rebuild', pairs, [])
+    assert _plan_plot_update(old, old, pairs) == ('load', [], [])
+    # Changed inputs or style
+    new = _state(**{'ttbar/SR': ('c','1'), 'data_obs/SR': ('b','2')})
+    assert _plan_plot_update(old, new, pairs) == ('update', pairs, [])
+    # Added and removed pairs
+    new = _state(**{'ttbar/SR': ('a','1'), 'signal/SR': ('d','1')})
+    assert _plan_plot_update(old, new, ['ttbar/SR','signal/SR']) == ('update', ['signal/SR'], ['data_obs/SR'])
+
+def test_make_can(tmp_path):
+    # Pads in memory (as from pad_image()) and on disk can be mixed
+    red = numpy.zeros((7,8,3), dtype='uint8')
+    red[:,:,0] = 255
+    blue = numpy.zeros((7,8,3), dtype='uint8')
+    blue[:,:,2] = 255
+    Image.fromarray(blue, 'RGB').save(str(tmp_path/'blue.png'))
+
+    make_can(str(tmp_path/'can'), [red, str(tmp_path/'blue.png'), red])
+    assert (tmp_path/'can.pdf').read_bytes().startswith(b'%PDF')
+
+@pytest.mark.parametrize('npads,grid', [(1,(1,1)), (3,(3,1)), (4,(2,2)), (6,(3,2)), (12,(4,3)), (18,(5,4)), (30,(6,5)), (40,(7,6)), (70,(9,8))])
+def test_make_can_GRID(tmp_path, monkeypatch, npads, grid):
+    sizes = []
+    new = Image.new
+    def _new(mode, size, *args, **kwargs):
+        sizes.append(size)
+        return new(mode, size, *args, **kwargs)
+    monkeypatch.setattr(Image, 'new', _new)
+
+    make_can(str(tmp_path/'can'), [numpy.zeros((7,8,3), dtype='uint8')]*npads)
+    assert sizes[-1] == (grid[0]*8, grid[1]*7) # the grid is made last
+
+def test_make_can_SHAPE(tmp_path, monkeypatch):
+    sizes = []
+    new = Image.new
+    def _new(mode, size, *args, **kwargs):
+        sizes.append(size)
+        return new(mode, size, *args, **kwargs)
+    monkeypatch.setattr(Image, 'new', _new)
+
+    pad = numpy.zeros((7,8,3), dtype='uint8')
+    make_can(str(tmp_path/'can'), [pad]*5+[None], 3, 2)
+    assert sizes[-1] == (3*8, 2*7)
+
+def test__region_slice_grid():
+    # Two regions with 5 slices (given out of order) and one with 2
+    pads = pandas.DataFrame(
+        [{'pad':'%s_%s'%(r,i), 'region':r, 'slice':i} for r in ['B','A'] for i in [10,2,0,1,3]]+
+        [{'pad':'C_%s'%i, 'region':'C', 'slice':i} for i in [1,0]])
+    padnames, padx, pady = _region_slice_grid(pads)
+    assert (padx, pady) == (5, 3)
+    assert padnames == ['A_0','A_1','A_2','A_3','A_10','B_0','B_1','B_2','B_3','B_10','C_0','C_1',None,None,None]
@@ -0,0 +1,119 @@
+import numpy, pytest, ROOT
+from TwoDAlphabet import toyengine
+from TwoDAlphabet.toyengine import _split_toys, write_tree, run_adaptive, run_gof, ToyEngine, _gof_columns
+from TwoDAlphabet.toys import PValueStop
+from TwoDAlphabet.toys import read_tree_branches
+
+def test__split_toys():
+    chunks = _split_toys(1000, 3, 123456)
+    assert [n for n,_ in chunks] == [334,333,333]
+    assert [s for _,s in chunks] == [123456,123457,123458]
+    assert _split_toys(2, 8, 10) == [(1,10),(1,11)]
+    assert _split_toys(5, 0, 10) == [(5,10)]
+
+def test_write_tree(tmp_path):
+    filename = str(tmp_path/'higgsCombine_gof_toys.GoodnessOfFit.mH120.1.root')
+    write_tree(filename, 'limit', {'limit': [1.5,2.5,3.5], 'iToy': [1,2,3]})
+    assert read_tree_branches(filename, 'limit', ['limit','iToy']) == {'limit': [1.5,2.5,3.5], 'iToy': [1.0,2.0,3.0]}
+
+def _tiny_workspace(filename):
+    '''One channel with 10 bins: a signal in bins 3-5 and a background in bins 1-8
+    (nothing is expected in bins 9 and 10) with a Gaussian constrained normalization.'''
+    w = ROOT.RooWorkspace('w')
+    w.factory('x[0,10]')
+    w.var('x').setBins(10)
+    w.factory("EXPR::sig('(x>2)*(x<5)*1.0', x)")
+    w.factory("EXPR::bkg('(x<8)*1.0', x)")
+    w.factory('r[1,-5,5]')
+    w.factory('theta[0,-5,5]')
+    w.factory('theta_In[0,-5,5]')
+    w.var('theta_In').setConstant(True)
+    w.factory("expr::nsig('20*r', r)")
+    w.factory("expr::nbkg('100*(1+0.1*theta)', theta)")
+    w.factory('SUM::core(nsig*sig, nbkg*bkg)')
+    w.factory('Gaussian::theta_Pdf(theta_In, theta, 1)')
+    w.factory('PROD::model(core, theta_Pdf)')
+
+    mc = ROOT.RooStats.ModelConfig('ModelConfig', w)
+    mc.SetPdf('model')
+    mc.SetObservables('x')
+    mc.SetParametersOfInterest('r')
+    mc.SetNuisanceParameters('theta')
+    mc.SetGlobalObservables('theta_In')
+    getattr(w,'import')(mc)
+
+    # Asimov data at r = 1, theta = 0
+    data = w.pdf('model').generateBinned(ROOT.RooArgSet(w.var('x')), ROOT.RooFit.ExpectedData())
+    data.SetName('data_obs')
+    getattr(w,'import')(data)
+    w.writeToFile(filename)
+
+def test_ToyEngine(tmp_path):
+    filename = str(tmp_path/'workspace.root')
+    _tiny_workspace(filename)
+    engine = ToyEngine(filename)
+    x = engine.w.var('x')
+
+    assert engine.Fit(engine.data) == 0
+    assert engine.poi.getVal() == pytest.approx(1, abs=1e-2)
+    assert engine.Saturated(engine.data) == pytest.approx(0, abs=1e-3)
+
+    ROOT.RooRandom.randomGenerator().SetSeed(1)
+    engine.SetGenerationPoint(fitData=False, rGen=1)
+    toy = engine.Generate()
+    assert toy.sumEntries() > 0
+    assert engine.w.var('theta_In').getVal() != 0 # generated from the constraint term
+    assert engine.Fit(toy) == 0
+    assert engine.Saturated(toy) > 0
+
+    # Events where nothing is expected
+    x.setVal(9.5)
+    hist = ROOT.RooDataHist('outside','outside',ROOT.RooArgSet(x))
+    hist.add(ROOT.RooArgSet(x), 3)
+    assert numpy.isfinite(engine.Saturated(hist))
+
+def test_run_gof_NOTOYS(monkeypatch):
+    monkeypatch.setattr(toyengine, 'run_gof_data', lambda engineArgs, seed: {})
+    _, toys = run_gof({}, 0)
+    assert toys == {c:[] for c in _gof_columns}
+
+class _FakeEngine(object):
+    def __init__(self, **kwargs):
+        self._lastMin = None
+    def SetGenerationPoint(self, fitData=True, rGen=None):
+        pass
+
+def _fake_gof_toys(engine, ntoys, seed):
+    # Half of the toys are above 10 in every batch
+    return {'limit': [5.0+10*(i%2) for i in range(ntoys)], 'quantileExpected': [-1]*ntoys,
+            'iToy': list(range(1,ntoys+1)), 'iSeed': [seed]*ntoys}
+
+@pytest.mark.parametrize('nCores', [1,2])
+def test_run_adaptive(monkeypatch, nCores):
+    monkeypatch.setattr(toyengine, 'ToyEngine', _FakeEngine)
+    monkeypatch.setitem(toyengine._toy_loops, 'gof', _fake_gof_toys)
+
+    toys, reason = run_adaptive('gof', {}, PValueStop(10.0, threshold=0.05), batchSize=20, minToys=40, maxToys=1000, seed=7, nCores=nCores)
+    assert 'above' in reason
+    assert len(toys['limit']) == 40
+    assert sorted(set(toys['iSeed'])) == [7,8]
+
+    toys, reason = run_adaptive('gof', {}, PValueStop(10.0, threshold=None, precision=0), batchSize=30, maxToys=100, seed=7, nCores=nCores)
+    assert 'maxToys' in reason
+    assert len(toys['limit']) == 100
+    assert sorted(set(toys['iSeed'])) == [7,8,9,10]
+
+def test__gofToys_RESET(monkeypatch):
+    # Each batch starts without the warm start left by the previous batch of the worker
+    starts = []
+    class _Engine(_FakeEngine):
+        def Generate(self):
+            starts.append(self._lastMin)
+            return None
+        def Fit(self, data):
+            self._lastMin = 'minimum'
+            return 1
+    engine = _Engine()
+    toyengine._gofToys(engine, 2, 1)
+    toyengine._gofToys(engine, 2, 2)
+    assert starts == [None,'minimum',None,'minimum']
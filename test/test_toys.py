@@ -0,0 +1,101 @@
+import os, tarfile, json
+from TwoDAlphabet import toys
+import numpy
+from TwoDAlphabet.toys import ToyHarvester, empirical_pvalue, injection_pulls, PValueStop, PullMeanStop
+
+# Each "ROOT file" holds its toy values as text so the harvester can be tested without ROOT files.
+def _read_text(filename, treeName, branches):
+    with open(filename) as f:
+        values = [float(v) for v in f.read().split()]
+    return {b:values for b in branches}
+
+def _make_tarball(path, members):
+    srcdir = path+'_src'
+    os.makedirs(srcdir)
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, values in members.items():
+            src = os.path.join(srcdir, name)
+            with open(src,'w') as f:
+                f.write(' '.join(str(v) for v in values))
+            tar.add(src, arcname='tmp/out/'+name)
+
+def test_ToyHarvester(tmp_path, monkeypatch):
+    calls = []
+    def _read(*args):
+        calls.append(args[0])
+        return _read_text(*args)
+    monkeypatch.setattr(toys, 'read_tree_branches', _read)
+    monkeypatch.chdir(tmp_path)
+
+    _make_tarball('job_0.tgz', {'gof.0.root': [1.0,2.0], 'other.root': [100.0]})
+    harvester = ToyHarvester('state.json', 'limit', ['limit'], 'gof.*.root').Update('job_*.tgz')
+    assert harvester.count == 2
+    assert len(calls) == 1
+    assert not os.path.exists('tmp') # nothing extracted in place
+    with open('state.json') as f: # only the stamps, the values are in state.json.data/
+        assert 'data' not in json.load(f)['files']['job_0.tgz::tmp/out/gof.0.root']
+
+    # Only the new tarball is read and the state is picked up by a new harvester
+    _make_tarball('job_1.tgz', {'gof.1.root': [3.0,4.0]})
+    harvester = ToyHarvester('state.json', 'limit', ['limit'], 'gof.*.root').Update('job_*.tgz')
+    assert len(calls) == 2
+    assert sorted(harvester.Values().tolist()) == [1.0,2.0,3.0,4.0]
+    assert harvester.PValue(3.0)[0] == 0.5
+    assert harvester.Summary(3.0)['quantiles']['50'] == 2.5
+
+    # Unreadable files are retried on the next call
+    with open('job_2.tgz','w') as f:
+        f.write('still transferring')
+    harvester.Update('job_*.tgz')
+    assert 'job_2.tgz' not in harvester.files
+    assert harvester.count == 4
+
+def test_ToyHarvester_SAVES(tmp_path, monkeypatch):
+    monkeypatch.setattr(toys, 'read_tree_branches', _read_text)
+    monkeypatch.chdir(tmp_path)
+    for i in range(5):
+        with open('gof.%s.root'%i,'w') as f:
+            f.write('%s %s'%(i,i+0.5))
+
+    saves = []
+    save = ToyHarvester.Save
+    monkeypatch.setattr(ToyHarvester, 'Save', lambda self: saves.append(1) or save(self))
+    harvester = ToyHarvester('state.json', 'limit', ['limit'], saveEvery=2).Update('gof.*.root')
+    assert len(saves) == 3 # after the 2nd and 4th files and at the end
+    harvester.Update('gof.*.root')
+    assert len(saves) == 3 # nothing new
+
+    # A changed input replaces its values
+    with open('gof.0.root','w') as f:
+        f.write('7 8 9')
+    os.utime('gof.0.root', (0,0))
+    harvester = ToyHarvester('state.json', 'limit', ['limit']).Update('gof.*.root')
+    assert harvester.count == 11
+    assert sorted(harvester.Values().tolist())[-3:] == [7.0,8.0,9.0]
+
+def test_empirical_pvalue():
+    # Skewed distribution where a Gaussian approximation of the tail is poor
+    values = numpy.random.RandomState(1).chisquare(3, 100000)
+    pvalue, err = empirical_pvalue(values, 7.815, seed=2)
+    assert abs(pvalue-0.05) < 3*err
+    assert abs(err-numpy.sqrt(0.05*0.95/values.size)) < 0.2*err
+
+    assert empirical_pvalue([1.0, 2.0, numpy.nan], 3.0) == (0.0, 0.5)
+    pvalue, err = empirical_pvalue([], 3.0)
+    assert numpy.isnan(pvalue) and numpy.isnan(err)
+
+def test_PValueStop():
+    stop = PValueStop(10.0, precision=0.01, threshold=0.05)
+    # p = 0.5 is clearly above the threshold
+    assert 'above' in stop({'limit': [5.0,15.0]*50})
+    # p = 0.05 needs more toys to decide or reach the precision
+    assert stop({'limit': [15.0]*5+[5.0]*95}) == None
+    assert 'precision' in stop({'limit': [15.0]*100+[5.0]*1900})
+
+def test_PullMeanStop():
+    fits = {'r': [1.5,0.5]*50, 'rHiErr': [1.0]*100, 'rLoErr': [1.0]*100, 'fit_status': [0]*99+[-1]}
+    pulls, biases = injection_pulls(fits, 1.0)
+    assert len(pulls) == 99
+    assert sorted(set(pulls.tolist())) == [-0.5,0.5]
+    assert PullMeanStop(1.0, precision=0.1)(fits) != None
+    assert PullMeanStop(1.0, precision=0.01)(fits) == None
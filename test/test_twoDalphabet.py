@@ -0,0 +1,296 @@
+import os, stat
+import pandas, pytest
+from TwoDAlphabet.twoDalphabet import run_limit_jobs, _parseLimits
+
+# Local stand-ins for text2workspace.py and combine which print the same
+# limit lines as `combine -M AsymptoticLimits` (scaled by the run directory name).
+_text2workspace = '''#!/bin/sh
+echo "text2workspace $@"
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then echo "$PWD" > $2; fi
+    shift
+done
+'''
+_combine = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-d" ]; then test -f $2 || exit 1; fi
+    shift
+done
+scale=$(basename $PWD | sed 's/[^0-9]//g')
+echo " -- AsymptoticLimits ( CLs ) --"
+echo "Observed Limit: r < ${scale}.5000"
+echo "Expected  2.5%: r < ${scale}.1000"
+echo "Expected 16.0%: r < ${scale}.2000"
+echo "Expected 50.0%: r < ${scale}.3000"
+echo "Expected 84.0%: r < ${scale}.4000"
+echo "Expected 97.5%: r < ${scale}.6000"
+'''
+
+def _write(path, text):
+    with open(str(path),'w') as f:
+        f.write(text)
+
+def _read(path):
+    with open(str(path)) as f:
+        return f.read()
+
+@pytest.fixture
+def standins(tmp_path, monkeypatch):
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    for name, script in [('text2workspace.py',_text2workspace),('combine',_combine)]:
+        path = bindir/name
+        _write(path, script)
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bindir)+os.pathsep+os.environ['PATH'])
+    return tmp_path
+
+def _make_jobs(tmp_path, subtags):
+    _write(tmp_path/'base.root', 'base')
+    jobs = []
+    for subtag in subtags:
+        run_dir = tmp_path/subtag
+        run_dir.mkdir()
+        _write(run_dir/'card.txt', 'imax 1\nshapes * * ../base.root w:$PROCESS\n'+subtag)
+        jobs.append({'subtag': subtag, 'run_dir': str(run_dir),
+                     'blindData': True, 'verbosity': 0, 'setParams': {}})
+    return jobs
+
+@pytest.mark.parametrize('nCores', [1,3])
+def test_run_limit_jobs(standins, nCores):
+    cwd = os.getcwd()
+    summary = run_limit_jobs(_make_jobs(standins, ['sig1','sig2','sig3']), nCores)
+    assert os.getcwd() == cwd
+    assert summary.subtag.tolist() == ['sig1','sig2','sig3']
+    assert (summary.returncode == 0).all()
+    assert summary['exp0'].tolist() == [1.3,2.3,3.3]
+    assert summary['obs'].tolist() == [1.5,2.5,3.5]
+    assert os.path.exists(str(standins/'sig2'/'Limit.log'))
+    assert os.path.exists(str(standins/'sig2'/'text2workspace.log'))
+    assert len(os.listdir(str(standins/'workspace_cache'))) == 3
+
+def test_run_limit_jobs_FAIL(standins):
+    jobs = _make_jobs(standins, ['sig1'])
+    _write(standins/'bin'/'text2workspace.py', '#!/bin/sh\nexit 1\n')
+    summary = run_limit_jobs(jobs, 1)
+    assert summary.returncode.tolist() == [1]
+    assert summary['exp0'].isnull().all()
+
+def test__parseLimits(tmp_path):
+    log = tmp_path/'Limit.log'
+    _write(log, 'Expected 50.0%: r < 0.1234\nObserved Limit: r < 1e-2\n')
+    limits = _parseLimits(str(log))
+    assert limits['exp0'] == 0.1234
+    assert limits['obs'] == 0.01
+    assert limits['exp+2'] != limits['exp+2'] # NaN
+
+def _make_ledger():
+    from TwoDAlphabet.twoDalphabet import Ledger
+    import pandas
+    df = pandas.DataFrame({
+        'process':      ['data_obs','ttbar','ttbar','MX_2000','MX_3000']*2,
+        'process_type': ['DATA','BKG','BKG','SIGNAL','SIGNAL']*2,
+        'region':       ['CR_pass']*5+['CR_fail']*5,
+        'variation':    ['nominal','nominal','lumi','nominal','nominal']*2,
+    })
+    ledger = Ledger(df)
+    ledger.alphaObjs = pandas.DataFrame({
+        'process':      ['Background_0x0','Background_1x0'],
+        'region':       ['CR_fail','CR_fail'],
+        'owner':        ['Background_0x0_CR_fail','Background_1x0_CR_fail'],
+        'process_type': ['BKG','BKG'],
+    })
+    ledger.alphaParams = pandas.DataFrame({
+        'name':  ['p0_0x0','p0_1x0','p1_1x0'],
+        'constraint': ['flatParam']*3,
+        'owner': ['Background_0x0_CR_fail','Background_1x0_CR_fail','Background_1x0_CR_fail'],
+    })
+    ledger.alphaFuncs = pandas.DataFrame({
+        'name': ['rpf_0x0','rpf_1x0'], 'formula': ['@0','@0+@1*x'], 'forcePositive': [True,True],
+        'params': ['p0_0x0','p0_1x0 p1_1x0'], 'nominal': ['0.1','0.1 0.2'],
+        'owner': ['Background_0x0_CR_fail','Background_1x0_CR_fail'],
+    })
+    return ledger
+
+def _select_signal(row, args):
+    if row.process_type == 'SIGNAL':
+        return args[0] in row.process
+    elif 'Background_' in row.process:
+        return row.process == 'Background_'+args[1]
+    return True
+
+def test_Ledger_query():
+    ledger = _make_ledger()
+    subset = ledger.query(process_regex='MX_2000', scope='SIGNAL').query(process_regex='^(?!Background_)|^Background_1x0$')
+    assert sorted(subset.df.process.unique()) == ['MX_2000','data_obs','ttbar']
+    assert subset.alphaObjs.process.tolist() == ['Background_1x0']
+    assert subset.alphaParams.name.tolist() == ['p0_1x0','p1_1x0']
+
+    subset = ledger.query(process_type='BKG', region='CR_fail', variation='nominal')
+    assert subset.df.shape[0] == 1
+    assert subset.alphaObjs.shape[0] == 2
+    assert subset.alphaParams.shape[0] == 3
+
+def test_Ledger_select():
+    from TwoDAlphabet.twoDalphabet import vectorized_selection
+    ledger = _make_ledger()
+    calls = []
+    def _counted(row, args):
+        calls.append(row.process)
+        return _select_signal(row, args)
+    subset = ledger.select(_counted, 'MX_2000', '1x0')
+    assert len(calls) == ledger.df.shape[0]+ledger.alphaObjs.shape[0] # once per row
+    query = ledger.query(process_regex='MX_2000', scope='SIGNAL').query(process_regex='^(?!Background_)|^Background_1x0$')
+    assert subset.df.equals(query.df)
+    assert subset.alphaParams.equals(query.alphaParams)
+    # Errors in row-wise callbacks are not swallowed
+    with pytest.raises(KeyError):
+        ledger.select(lambda row, args: row['missing'])
+    # Vectorized callback
+    subset = ledger.select(vectorized_selection(lambda df, args: df.region.eq(args[0])), 'CR_pass')
+    assert subset.df.shape[0] == 5
+    assert subset.alphaObjs.shape[0] == 0
+    assert subset.alphaParams.shape[0] == 0
+
+def test_Ledger__systEffects():
+    ledger = _make_ledger()
+    ledger.df['syst_type'] = ledger.df.variation.map({'nominal': None, 'lumi': 'lnN'})
+    ledger.df['lnN'] = ledger.df.variation.map({'nominal': None, 'lumi': 1.02})
+    # Only evaluated when needed
+    subset = ledger.query(region='CR_fail').query(process_type='BKG')
+    assert ledger._syst_effects is None
+    assert ledger._systEffects().tolist() == [1.02,1.02]
+    # Subsets reuse the values evaluated for the parent rather than evaluating them again
+    ledger._syst_effects = pandas.Series(['shared_pass','shared_fail'], index=ledger._syst_effects.index)
+    assert subset._systEffects().tolist() == ['shared_fail']
+    assert ledger.query(variation='nominal')._systEffects().empty
+
+def test_MakeCard(tmp_path):
+    from TwoDAlphabet.twoDalphabet import MakeCard
+    ledger = _make_ledger()
+    ledger.df['syst_type'] = ledger.df.variation.map({'nominal': None, 'lumi': 'lnN'})
+    ledger.df['lnN'] = ledger.df.variation.map({'nominal': None, 'lumi': 1.02})
+    subset = ledger.query(process_regex='MX_2000', scope='SIGNAL').query(process_regex='^(?!Background_)|^Background_1x0$')
+    MakeCard(subset, str(tmp_path), '../')
+    lines = {l.split()[0]:l.split() for l in _read(tmp_path/'card.txt').splitlines() if l.strip()}
+    fail, pas = ['CR_fail_LOW','CR_fail_SIG','CR_fail_HIGH'], ['CR_pass_LOW','CR_pass_SIG','CR_pass_HIGH']
+    # MX_2000, ttbar, Background_1x0
+    assert lines['bin'][1:] == fail+pas+fail+pas+fail
+    assert lines['lumi'][1:] == ['lnN']+['-']*6+['1.02']*6+['-']*3
+    assert lines['p1_1x0'] == ['p1_1x0','flatParam']
+
+# Stand-in for `combineTool.py -M Impacts --doFits` which makes a seeded output (like a fit to a toy)
+_combineTool = '''#!/bin/sh
+for arg in "$@"; do
+    case $arg in --named=*) param=${arg#--named=};; esac
+done
+test -f higgsCombine_initialFit_Test.MultiDimFit.mH0.root || exit 2
+test "$param" = "bad" && exit 1
+echo "$param" > higgsCombine_paramFit_Test_${param}.MultiDimFit.mH0.123456.root
+'''
+
+def test_run_impact_fits(tmp_path, monkeypatch):
+    from TwoDAlphabet.twoDalphabet import run_impact_fits, check_impact_fits
+    bindir = tmp_path/'bin'
+    bindir.mkdir()
+    _write(bindir/'combineTool.py', _combineTool)
+    (bindir/'combineTool.py').chmod(0o755)
+    monkeypatch.setenv('PATH', str(bindir)+os.pathsep+os.environ['PATH'])
+    monkeypatch.chdir(tmp_path)
+    _write(tmp_path/'higgsCombine_initialFit_Test.MultiDimFit.mH0.root', 'initial')
+
+    jobs = [{'param': p, 'scratch': 'impacts/'+p, 'cmd': 'combineTool.py -M Impacts --named=%s --doFits'%p}
+                for p in ['lumi','jes','bad']]
+    timing = run_impact_fits(jobs, 3)
+    assert timing.param.tolist() == ['lumi','jes','bad']
+    assert timing.returncode.tolist() == [0,0,1]
+    assert not timing.skipped.any()
+    assert _read(tmp_path/'higgsCombine_paramFit_Test_jes.MultiDimFit.mH0.root').strip() == 'jes'
+    assert (tmp_path/'impacts'/'lumi'/'impact_fit.log').exists()
+    assert _read(tmp_path/'impacts'/'lumi'/'higgsCombine_initialFit_Test.MultiDimFit.mH0.root') == 'initial'
+
+    with pytest.raises(RuntimeError, match='bad'):
+        check_impact_fits(timing)
+
+    # Resume
+    timing = run_impact_fits(jobs, 1)
+    assert timing.skipped.tolist() == [True,True,False]
+    check_impact_fits(timing.iloc[:2])
+
+def test__transferFuncs(tmp_path):
+    from TwoDAlphabet.twoDalphabet import TwoDAlphabet, LoadLedger
+    class _Unloaded(TwoDAlphabet):
+        def __init__(self):
+            self._binningMap = {'CR_fail': 'default'}
+            self.binnings = {'default': 'binning'}
+    ledger = _make_ledger()
+    ledger.Save(str(tmp_path))
+    loaded = LoadLedger(str(tmp_path)+'/')
+    assert loaded.alphaFuncs.name.tolist() == ['rpf_0x0','rpf_1x0']
+
+    # Owned by two objects (in the loaded area and a subset of it) but listed once
+    loaded.alphaObjs = loaded.alphaObjs.append(dict(loaded.alphaObjs.iloc[1], owner='Background_1x0_CR_pass'), ignore_index=True)
+    loaded.alphaFuncs = loaded.alphaFuncs.append(dict(loaded.alphaFuncs.iloc[1], owner='Background_1x0_CR_pass'), ignore_index=True)
+    tfs = _Unloaded()._transferFuncs(loaded.query(process_regex='Background_1x0'))
+    assert tfs == [{'name': 'rpf_1x0', 'formula': '@0+@1*x', 'forcePositive': True,
+                    'params': ['p0_1x0','p1_1x0'], 'nominal': [0.1,0.2], 'binning': 'binning'}]
+
+def test_InitQCDHists():
+    from ROOT import TH2F
+    from TwoDAlphabet.twoDalphabet import TwoDAlphabet
+    def _hist(name, fills):
+        h = TH2F(name, name, 3, 0, 3, 2, 0, 2)
+        h.Sumw2()
+        for (xbin, ybin), val in fills.items():
+            h.SetBinContent(xbin, ybin, val)
+            h.SetBinError(xbin, ybin, abs(val)**0.5)
+        return h
+    data = {(x,y):10.0 for x in range(1,4) for y in range(1,3)}
+    data[(0,0)] = 1.0 # underflow
+    hists = {
+        'data_obs': _hist('data_obs_initqcd', data),
+        # Exceeds data in the last bin (and the underflow) and then ...
+        'ttbar': _hist('ttbar_initqcd', {(1,1):4.0, (3,2):12.0, (0,0):5.0}),
+        # ... a negative background adds some back after the floor
+        'negw': _hist('negw_initqcd', {(3,2):-1.0})
+    }
+    class _OrganizedHists(object):
+        def Get(self, process, region, systematic):
+            return hists[process]
+    class _Options(object):
+        qcdFloor = 1e-5
+    class _Unloaded(TwoDAlphabet):
+        def __init__(self):
+            self.df = pandas.DataFrame({'process': ['data_obs','ttbar','negw','ttbar'], 'region': ['CR']*4,
+                                        'process_type': ['DATA','BKG','BKG','BKG'],
+                                        'variation': ['nominal','nominal','nominal','jesUp']})
+            self.organizedHists = _OrganizedHists()
+            self.options = _Options()
+
+    qcd = _Unloaded().InitQCDHists()['CR']
+    assert qcd.GetName() == 'qcd_initqcd'
+    assert qcd.GetBinContent(1,1) == pytest.approx(6.0)
+    assert qcd.GetBinError(1,1) == pytest.approx((10.0+4.0)**0.5)
+    assert qcd.GetBinContent(2,2) == pytest.approx(10.0)
+    # Floored after ttbar (error reset to data) and then the negative background is subtracted
+    assert qcd.GetBinContent(3,2) == pytest.approx(1e-5+1.0)
+    assert qcd.GetBinError(3,2) == pytest.approx((10.0+1.0)**0.5)
+    # Under/overflow are not floored
+    assert qcd.GetBinContent(0,0) == pytest.approx(-4.0)
+    # The inputs are untouched
+    assert hists['data_obs'].GetBinContent(3,2) == 10.0
+
+def test_toy_methods_BADOPTIONS():
+    from TwoDAlphabet.twoDalphabet import TwoDAlphabet
+    class _Unloaded(TwoDAlphabet): # options are checked before anything else is used
+        def __init__(self):
+            pass
+    twoD = _Unloaded()
+    with pytest.raises(ValueError):
+        twoD.GoodnessOfFit('sub', 10, extra='--X-rtd MINIMIZER_analytic', inProcess=True)
+    with pytest.raises(ValueError):
+        twoD.SignalInjection('sub', 1, 10, extra='--X-rtd MINIMIZER_analytic', inProcess=True)
+    with pytest.raises(ValueError):
+        twoD.GoodnessOfFit('sub', 10, adaptive={})
+    with pytest.raises(ValueError):
+        twoD.SignalInjection('sub', 1, 10, adaptive={})